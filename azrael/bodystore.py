@@ -0,0 +1,314 @@
+# Copyright 2016, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Store the rigid bodies in Leonard as a structure of arrays.
+
+The state variables of all bodies (eg position, velocity, mass) as well as
+their forces live in contiguous NumPy arrays. This allows vectorised updates
+for many bodies at once. For the code that still needs per-object access,
+the store also behaves like a ``{objID: RigidBodyData}`` dictionary.
+"""
+import logging
+import numpy as np
+
+from collections.abc import Mapping, MutableMapping
+from azrael.aztypes import RigidBodyData, Forces
+
+# Create module logger.
+logit = logging.getLogger('azrael.' + __name__)
+
+
+class BodyStore(MutableMapping):
+    """
+    Structure of arrays for rigid bodies, their forces and AABBs.
+
+    Every body occupies one slot, ie one row in every array. The ``slots``
+    dictionary maps the objIDs to their slot. The slots of removed bodies go
+    onto a free list and new bodies re-use them. The arrays double their
+    capacity whenever they run out of slots. References to the arrays
+    therefore become stale once new bodies arrive.
+
+    The numeric fields of ``RigidBodyData`` are arrays with the same name
+    (eg ``position`` is an Nx3 array), and so are the fields of ``Forces``.
+    The collision shapes and AABBs are Python objects in lists.
+
+    Accessing a body via its objID returns a ``RigidBodyData`` view of its
+    slot, ie a copy. Assigning a ``RigidBodyData`` instance overwrites the
+    slot. Use ``setFields`` to modify individual fields without compiling a
+    new tuple first.
+
+    The ``forces`` and ``aabbs`` attributes provide the same kind of
+    dictionary access to the ``Forces`` and AABBs of every body. Deleting a
+    body also deletes its forces and AABBs.
+
+    The store also tracks which bodies changed since they were last written
+    to the datastore (see ``changed`` and ``markSynced``). New bodies and
+    bodies with modified properties (eg mass or collision shapes) are always
+    *dirty*. Changes to the motion state (``motionFields``) only count once
+    they exceed a threshold.
+
+    Finally, ``restTime`` holds the number of seconds every body has been at
+    rest. The store only resets it for new bodies; Leonard updates it.
+    """
+    # Number of elements of every numeric field in ``RigidBodyData``
+    # (0 denotes scalars).
+    bodyFields = {
+        'scale': 0, 'imass': 0, 'restitution': 0, 'com': 3, 'inertia': 3,
+        'paxis': 4, 'rotation': 4, 'position': 3, 'velocityLin': 3,
+        'velocityRot': 3, 'linFactor': 3, 'rotFactor': 3, 'version': 0,
+    }
+
+    # The fields that change in every physics step.
+    motionFields = ('position', 'rotation', 'velocityLin', 'velocityRot')
+
+    def __init__(self):
+        # Mapping between objIDs and slots.
+        self.slots = {}
+        self.slotIDs = []
+        self.freeSlots = []
+
+        # The numeric body fields and forces.
+        for name, dim in self.bodyFields.items():
+            dtype = np.int64 if name == 'version' else np.float64
+            shape = (0, dim) if dim > 0 else (0, )
+            setattr(self, name, np.zeros(shape, dtype))
+        for name in Forces._fields:
+            setattr(self, name, np.zeros((0, 3), np.float64))
+
+        # The collision shapes and AABBs of every slot.
+        self.cshapes = []
+        self.aabbList = []
+
+        # The motion state of every slot when it was last synced, and the
+        # slots that must be synced regardless.
+        self.synced = {name: getattr(self, name).copy()
+                       for name in self.motionFields}
+        self.dirty = np.zeros(0, bool)
+
+        # How long each body has been at rest (in seconds).
+        self.restTime = np.zeros(0, np.float64)
+
+        # Dictionary views for the forces and AABBs.
+        self.forces = _ForceView(self)
+        self.aabbs = _AABBView(self)
+
+    def _grow(self):
+        """
+        Double the number of slots.
+        """
+        old = len(self.slotIDs)
+        num = max(old, 16)
+        for name in list(self.bodyFields) + list(Forces._fields):
+            arr = getattr(self, name)
+            pad = np.zeros((num, ) + arr.shape[1:], arr.dtype)
+            setattr(self, name, np.concatenate((arr, pad)))
+        for name, arr in self.synced.items():
+            pad = np.zeros((num, ) + arr.shape[1:], arr.dtype)
+            self.synced[name] = np.concatenate((arr, pad))
+        self.dirty = np.concatenate((self.dirty, np.zeros(num, bool)))
+        self.restTime = np.concatenate((self.restTime, np.zeros(num)))
+        self.slotIDs.extend([None] * num)
+        self.cshapes.extend([None] * num)
+        self.aabbList.extend([None] * num)
+        self.freeSlots.extend(range(old + num - 1, old - 1, -1))
+
+    def _addSlot(self, objID: str):
+        """
+        Return a new slot for ``objID``. Its forces are zero.
+        """
+        if len(self.freeSlots) == 0:
+            self._grow()
+        slot = self.freeSlots.pop()
+        self.slots[objID] = slot
+        self.slotIDs[slot] = objID
+        for name in Forces._fields:
+            getattr(self, name)[slot] = 0
+        self.dirty[slot] = True
+        self.restTime[slot] = 0
+        return slot
+
+    def __getitem__(self, objID: str):
+        slot = self.slots[objID]
+        values = []
+        for name in RigidBodyData._fields:
+            if name == 'cshapes':
+                values.append(self.cshapes[slot])
+            elif self.bodyFields[name] > 0:
+                values.append(tuple(getattr(self, name)[slot].tolist()))
+            else:
+                values.append(getattr(self, name)[slot].item())
+        return RigidBodyData._make(values)
+
+    def bodies(self, slots: np.ndarray):
+        """
+        Return the ``RigidBodyData`` views of all ``slots``.
+
+        This is equivalent to, but much faster than, accessing every body
+        individually.
+
+        :param ndarray slots: slot indices.
+        :return: list of ``RigidBodyData`` instances.
+        :rtype: list
+        """
+        slots = np.asarray(slots, np.int64)
+        columns = []
+        for name in RigidBodyData._fields:
+            if name == 'cshapes':
+                columns.append([self.cshapes[_] for _ in slots.tolist()])
+            elif self.bodyFields[name] > 0:
+                values = getattr(self, name)[slots].tolist()
+                columns.append([tuple(_) for _ in values])
+            else:
+                columns.append(getattr(self, name)[slots].tolist())
+        return [RigidBodyData._make(_) for _ in zip(*columns)]
+
+    def __setitem__(self, objID: str, body: RigidBodyData):
+        if objID not in self.slots:
+            self._addSlot(objID)
+        self.setFields(objID, **dict(zip(body._fields, body)))
+
+    def __delitem__(self, objID: str):
+        slot = self.slots.pop(objID)
+        self.slotIDs[slot] = None
+        self.cshapes[slot] = None
+        self.aabbList[slot] = None
+        self.freeSlots.append(slot)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, objID):
+        return objID in self.slots
+
+    def setFields(self, objID: str, **fields):
+        """
+        Overwrite the ``fields`` of body ``objID``.
+
+        The field names are those of ``RigidBodyData``.
+
+        :param str objID: ID of body.
+        :param fields: the new values, eg ``position=(1, 2, 3)``.
+        :raises: KeyError if the body does not exist.
+        """
+        slot = self.slots[objID]
+        for name, value in fields.items():
+            if name == 'cshapes':
+                self.cshapes[slot] = value
+            else:
+                getattr(self, name)[slot] = value
+            if name not in self.motionFields:
+                self.dirty[slot] = True
+
+    def indices(self, objIDs=None):
+        """
+        Return the slots of ``objIDs`` (defaults to all bodies).
+
+        The slots of all bodies are in iteration order. Use them to access
+        the arrays directly, eg ``store.position[store.indices()]``.
+
+        :param iterable objIDs: the bodies.
+        :return: slot indices.
+        :rtype: ndarray
+        :raises: KeyError if a body does not exist.
+        """
+        if objIDs is None:
+            return np.fromiter(self.slots.values(), np.int64, len(self.slots))
+        return np.fromiter(map(self.slots.__getitem__, objIDs), np.int64)
+
+    def changed(self, threshold: float=0):
+        """
+        Return the slots of all bodies that changed since the last sync.
+
+        A body has changed if it is dirty, or if any component of its motion
+        state differs by more than ``threshold`` from the synced value.
+
+        :param float threshold: tolerance for the motion state.
+        :return: slot indices (in iteration order).
+        :rtype: ndarray
+        """
+        slots = self.indices()
+        changed = self.dirty[slots]
+        for name in self.motionFields:
+            delta = getattr(self, name)[slots] - self.synced[name][slots]
+            changed |= np.any(np.abs(delta) > threshold, axis=1)
+        return slots[changed]
+
+    def markSynced(self, slots: np.ndarray):
+        """
+        Record the current motion state of ``slots`` as synced.
+
+        :param ndarray slots: slot indices.
+        """
+        for name in self.motionFields:
+            self.synced[name][slots] = getattr(self, name)[slots]
+        self.dirty[slots] = False
+
+
+class _ForceView(Mapping):
+    """
+    Provide the ``{objID: Forces}`` dictionary for the bodies in ``store``.
+
+    The force components are lists.
+    """
+    def __init__(self, store: BodyStore):
+        self.store = store
+
+    def __getitem__(self, objID: str):
+        slot = self.store.slots[objID]
+        return Forces._make(
+            getattr(self.store, _)[slot].tolist() for _ in Forces._fields)
+
+    def __setitem__(self, objID: str, forces: Forces):
+        slot = self.store.slots[objID]
+        for name, value in zip(Forces._fields, forces):
+            getattr(self.store, name)[slot] = value
+
+    def __iter__(self):
+        return iter(self.store.slots)
+
+    def __len__(self):
+        return len(self.store.slots)
+
+    def __contains__(self, objID):
+        return objID in self.store.slots
+
+
+class _AABBView(Mapping):
+    """
+    Provide the ``{objID: AABBs}`` dictionary for the bodies in ``store``.
+    """
+    def __init__(self, store: BodyStore):
+        self.store = store
+
+    def __getitem__(self, objID: str):
+        return self.store.aabbList[self.store.slots[objID]]
+
+    def __setitem__(self, objID: str, aabbs: dict):
+        self.store.aabbList[self.store.slots[objID]] = aabbs
+
+    def __iter__(self):
+        return iter(self.store.slots)
+
+    def __len__(self):
+        return len(self.store.slots)
+
+    def __contains__(self, objID):
+        return objID in self.store.slots
@@ -74,12 +74,19 @@ class Clerk(config.AzraelProcess):
     Clerk relies on the `protocol` module to convert the ZeroMQ byte strings
     to meaningful quantities.
 
+    :param int leonardCmdPort: port on which Leonard receives the commands
+                               (defaults to the 'leonard_cmd' service in
+                               ``config``).
     :raises: None
     """
     @typecheck
-    def __init__(self):
+    def __init__(self, leonardCmdPort: int=None):
         super().__init__()
 
+        if leonardCmdPort is None:
+            leonardCmdPort = config.azService['leonard_cmd'].port
+        self.leonardCmdPort = leonardCmdPort
+
         # Dibbler is the interface to the geometry database.
         self.dibbler = dibbler.Dibbler()
 
@@ -282,6 +289,13 @@ class Clerk(config.AzraelProcess):
         self.logit.info('Listening on <{}>'.format(addr))
         del addr
 
+        # Push the commands for Leonard directly to it. They go to the
+        # datastore instead whenever Leonard is not listening.
+        addr = 'tcp://{}:{}'.format(
+            config.azService['leonard_cmd'].ip, self.leonardCmdPort)
+        leoAPI.setCommandChannel(leoAPI.CommandChannel(addr))
+        del addr
+
         # Digest loop.
         while True:
             # Wait for socket activity.
@@ -422,6 +422,22 @@ class DatastoreBase:
         """
         raise NotImplementedError
 
+    def modifyBulk(self, ops: dict):
+        """
+        Like ``modify`` but apply all modifications in a single request.
+
+        This is faster for many documents but only returns the number of
+        documents the modifications applied to, not the status of every
+        document. Like in ``modify``, a document counts if it exists and
+        satisfies its ``exists`` conditions, even if the modifications did
+        not change any of its values.
+
+        :param dict ops: document specific modifications.
+        :return: number of matched documents.
+        :rtype: int
+        """
+        raise NotImplementedError
+
     def remove(self, aids: (tuple, list)):
         """
         Remove the documents with the specified ``aids``.
@@ -698,6 +714,16 @@ class DatastoreInMemory(DatastoreBase):
         # Return the success status (True or False) for each AID.
         return RetVal(True, None, ret)
 
+    @typecheck
+    def modifyBulk(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.modify(ops)
+        if not ret.ok:
+            return ret
+        return RetVal(True, None, sum(ret.data.values()))
+
     @typecheck
     def remove(self, aids: (tuple, list)):
         """
@@ -1118,23 +1144,7 @@ class DatastoreMongo(DatastoreBase):
         # Issue the operations one-by-one.
         ret = {}
         for aid, op_tmp in ops.items():
-            # Compile the first part of the query that specifies which (nested)
-            # keys must exist.
-            query = {'.'.join(key): {'$exists': yes}
-                     for key, yes in op_tmp['exists'].items()}
-
-            # Add the AID to the query.
-            query['aid'] = aid
-
-            # Compile the update operations.
-            op = {
-                '$inc': {'.'.join(key): val for key, val in op_tmp['inc'].items()},
-                '$set': {'.'.join(key): val for key, val in op_tmp['set'].items()},
-                '$unset': {'.'.join(key): True for key in op_tmp['unset']},
-            }
-
-            # Prune the update operations (Mongo complains if they are empty).
-            op = {k: v for k, v in op.items() if len(v) > 0}
+            query, op = self._compileModifyOperator(aid, op_tmp)
 
             # If no updates are necessary then skip this object.
             if len(op) == 0:
@@ -1149,6 +1159,34 @@ class DatastoreMongo(DatastoreBase):
             ret[aid] = (r.matched_count == 1)
         return RetVal(True, None, ret)
 
+    @typecheck
+    def modifyBulk(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkMod(ops) is False:
+            self.logit.warning('Invalid MOD argument')
+            return RetVal(False, 'Argument error', None)
+
+        # Compile the operations for all documents that need an update.
+        requests = []
+        for aid, op_tmp in ops.items():
+            query, op = self._compileModifyOperator(aid, op_tmp)
+            if len(op) > 0:
+                requests.append(pymongo.UpdateOne(query, op, upsert=False))
+
+        # Issue all updates in a single (unordered) request.
+        if len(requests) == 0:
+            return RetVal(True, None, 0)
+        try:
+            r = self.db.bulk_write(requests, ordered=False)
+        except pymongo.errors.PyMongoError as err:
+            msg = 'Bulk modification failed: {}'.format(err)
+            self.logit.warning(msg)
+            return RetVal(False, msg, None)
+        return RetVal(True, None, r.matched_count)
+
     @typecheck
     def remove(self, aids: (tuple, list)):
         """
@@ -1246,6 +1284,33 @@ class DatastoreMongo(DatastoreBase):
             del doc['aid']
         return docs
 
+    def _compileModifyOperator(self, aid: str, op_tmp: dict):
+        """
+        Return the Mongo query and update operator for ``modify``.
+
+        :param str aid: the document to modify.
+        :param dict op_tmp: the modifications (see ``modify``).
+        :return: (query, update operator)
+        """
+        # Compile the first part of the query that specifies which (nested)
+        # keys must exist.
+        query = {'.'.join(key): {'$exists': yes}
+                 for key, yes in op_tmp['exists'].items()}
+
+        # Add the AID to the query.
+        query['aid'] = aid
+
+        # Compile the update operations.
+        op = {
+            '$inc': {'.'.join(key): val for key, val in op_tmp['inc'].items()},
+            '$set': {'.'.join(key): val for key, val in op_tmp['set'].items()},
+            '$unset': {'.'.join(key): True for key in op_tmp['unset']},
+        }
+
+        # Prune the update operations (Mongo complains if they are empty).
+        op = {k: v for k, v in op.items() if len(v) > 0}
+        return query, op
+
     def _compileProjectionOperator(self, prj):
         """
         Compile the key hierarchies in ``prj`` into a Mongo compatible projection
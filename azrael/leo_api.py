@@ -20,6 +20,11 @@ Specify and implement the necessary functions to create, access and manipulate
 state variables.
 """
 
+import os
+import zmq
+import time
+import queue
+import pickle
 import logging
 import numpy as np
 import azutils as util
@@ -33,6 +38,176 @@ from azrael.aztypes import CollShapeMeta, CollShapeSphere, CollShapeBox
 # Create module logger.
 logit = logging.getLogger('azrael.' + __name__)
 
+# The channel that pushes the commands to Leonard. The commands go to the
+# 'Commands' datastore if it is *None* (see ``setCommandChannel``).
+_channel = None
+
+
+class CommandChannel:
+    """
+    Push commands to Leonard without a datastore round trip.
+
+    The ``addCmd*`` functions push the commands into the channel and Leonard
+    drains them in bounded batches (see ``readCommands``). If ``addr`` is
+    *None* then the channel is a plain queue. This only works if the command
+    producers (eg Clerk) and Leonard run in the same process. Otherwise the
+    channel is a ZeroMQ PUSH/PULL pair: Leonard binds the PULL socket to
+    ``addr`` and all other processes connect a PUSH socket to it.
+
+    Every process creates its own sockets on demand, which makes it safe to
+    create the channel before forking processes.
+
+    Pushing never blocks. Instead, ``push`` returns *False* if Leonard is not
+    listening, or is more than ``maxsize`` messages behind. The callers then
+    fall back to the datastore (see ``_queueCommands``).
+
+    :param str addr: ZeroMQ address, eg 'tcp://127.0.0.1:5557'.
+    :param int maxsize: maximum number of pending messages.
+    """
+    def __init__(self, addr: str=None, maxsize: int=10000):
+        self.addr = addr
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize) if addr is None else None
+
+        # The ZeroMQ context and sockets of the process with ID ``pid``.
+        self.pid = None
+        self.ctx = None
+        self.socks = {}
+
+    def _socket(self, kind):
+        """
+        Return the ZeroMQ socket of type ``kind`` for the current process.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.ctx = zmq.Context()
+            self.socks = {}
+
+        if kind not in self.socks:
+            sock = self.ctx.socket(kind)
+            if kind == zmq.PUSH:
+                # Only queue messages for Leonard once it is connected.
+                sock.setsockopt(zmq.IMMEDIATE, 1)
+                sock.setsockopt(zmq.SNDHWM, self.maxsize)
+                sock.connect(self.addr)
+            else:
+                sock.setsockopt(zmq.RCVHWM, self.maxsize)
+                sock.bind(self.addr)
+            self.socks[kind] = sock
+        return self.socks[kind]
+
+    def bind(self):
+        """
+        Start listening for commands (only Leonard calls this).
+        """
+        if self.queue is None:
+            self._socket(zmq.PULL)
+
+    def push(self, docs: list):
+        """
+        Send the command documents ``docs`` to Leonard.
+
+        :param list docs: command documents (see ``readCommands``).
+        :return: *True* if the channel accepted the commands.
+        :rtype: bool
+        """
+        try:
+            if self.queue is not None:
+                self.queue.put_nowait(docs)
+            else:
+                self._socket(zmq.PUSH).send(pickle.dumps(docs), zmq.NOBLOCK)
+        except (queue.Full, zmq.error.Again):
+            return False
+        return True
+
+    def pull(self, maxcount: int=None):
+        """
+        Return the pending command documents without waiting for new ones.
+
+        Stop once there are at least ``maxcount`` documents. The others
+        remain in the channel.
+
+        :param int maxcount: maximum number of documents (*None* for all).
+        :return: command documents in the order they were sent.
+        :rtype: list
+        """
+        docs = []
+        while maxcount is None or len(docs) < maxcount:
+            try:
+                if self.queue is not None:
+                    docs.extend(self.queue.get_nowait())
+                else:
+                    msg = self._socket(zmq.PULL).recv(zmq.NOBLOCK)
+                    docs.extend(pickle.loads(msg))
+            except (queue.Empty, zmq.error.Again):
+                break
+        return docs
+
+    def close(self):
+        """
+        Close the sockets of the current process.
+        """
+        if self.pid != os.getpid():
+            return
+        for sock in self.socks.values():
+            sock.close(linger=0)
+        self.ctx.term()
+        self.pid, self.ctx, self.socks = None, None, {}
+
+
+def setCommandChannel(channel: CommandChannel):
+    """
+    Send all subsequent commands of this process via ``channel``.
+
+    Pass *None* to send them to the 'Commands' datastore instead.
+
+    :param CommandChannel channel: the channel to Leonard (or *None*).
+    """
+    global _channel
+    _channel = channel
+    resetCommandReader()
+
+
+def getCommandChannel():
+    """
+    Return the current command channel (may be *None*).
+
+    :return: the ``CommandChannel`` of this process.
+    """
+    return _channel
+
+
+def _queueCommands(docs: list):
+    """
+    Push the command documents ``docs`` to Leonard.
+
+    Every command receives a unique and monotonically increasing sequence
+    number from the 'cmdseq' counter. Leonard applies the commands in that
+    order, no matter whether they arrive via the command channel or the
+    command log (see ``readCommands``).
+
+    The commands only go to the command log in the datastore if there is no
+    command channel or the channel did not accept them.
+
+    :param list docs: command documents with (at least) 'cmd' and 'objID'.
+    :return: {key: bool} if the commands went to the datastore.
+    """
+    # Reserve a contiguous range of sequence numbers for the commands.
+    ret = datastore.getDSHandle('Counters').incrementCounter(
+        'cmdseq', len(docs))
+    if not ret.ok:
+        return ret
+    first = ret.data - len(docs) + 1
+    docs = [dict(doc, seq=first + idx) for idx, doc in enumerate(docs)]
+
+    if _channel is not None and _channel.push(docs):
+        return RetVal(True, None, None)
+
+    # Append the commands to the log.
+    ops = {str(_['seq']): {'data': _} for _ in docs}
+    db = datastore.getDSHandle('Commands')
+    return db.put(ops)
+
 
 def computeAABBs(cshapes: dict):
     """
@@ -111,45 +286,226 @@ def computeAABBs(cshapes: dict):
     return RetVal(True, None, aabbs)
 
 
-@typecheck
-def dequeueCommands():
+def readCommandLog():
     """
-    Return and de-queue all commands currently in the command queue.
+    Return and remove all commands in the command log.
 
-    :return QueuedCommands: a tuple with lists for each command.
+    The command log lives in the 'Commands' datastore and only contains the
+    commands that did not go through the command channel (see
+    ``_queueCommands``). It is usually short since Leonard removes the
+    commands once it has read them.
+
+    :return: command documents in sequence order.
+    :rtype: list
     """
-    # Convenience.
     db = datastore.getDSHandle('Commands')
-
-    # Fetch all pending commands.
     ret = db.getAll()
     if not ret.ok:
         return ret
-    docs = ret.data
+    docs = sorted(ret.data.values(), key=lambda _: _['seq'])
+    if len(docs) > 0:
+        db.remove([str(_['seq']) for _ in docs])
+    return RetVal(True, None, docs)
 
-    # Delete all the commands we have just fetched.
-    db.remove(list(docs.keys()))
 
-    # Decompose the command:objID key into its constituents and add them to the
-    # document. This will allow us to compile all spawn/remove/etc commands
-    # easily below.
-    for key in docs:
-        cmd, objID = key.split(':')
-        docs[key]['cmd'] = cmd
-        docs[key]['objID'] = objID
-        del cmd, objID
-    docs = docs.values()
+def resetCommandReader():
+    """
+    Discard the buffered commands and the read position of ``readCommands``.
+
+    The next call to ``readCommands`` resumes at the read position in the
+    'cmdread' counter.
+    """
+    _reader['next'] = None
+    _reader['pending'] = {}
+    _reader['gap'], _reader['since'] = None, None
+
+
+# The sequence number of the next command to return, the commands that
+# arrived ahead of it, and the first missing command and since when it is
+# missing (see ``readCommands``).
+_reader = {'next': None, 'pending': {}, 'gap': None, 'since': None}
+
+
+def coalesceCommands(docs: list):
+    """
+    Return ``docs`` without the redundant commands.
+
+    The commands for different objects are independent. For the same object,
+    only the last of several 'direct_force' (or 'booster_force') commands
+    matters because each one replaces the previous force. Similarly, several
+    'modify' commands collapse into the last one, which then contains the
+    union of all modified fields (later values take precedence). Duplicate
+    'spawn' commands are pointless since Leonard ignores them anyway.
+
+    None of this applies across 'spawn' and 'remove' commands for the same
+    object, ie commands before and after them never coalesce.
+
+    The remaining commands retain their relative order. This function does
+    not modify ``docs``.
+
+    :param list docs: command documents in the order of arrival.
+    :return: the coalesced command documents.
+    :rtype: list
+    """
+    out = list(docs)
+
+    # The index (into ``out``) of the last command of each type for every
+    # object since its last 'spawn' or 'remove' command.
+    pending = {}
+    for idx, doc in enumerate(docs):
+        cmd, objID = doc['cmd'], doc['objID']
+        latest = pending.setdefault(objID, {})
+        if cmd == 'remove':
+            pending[objID] = {}
+        elif cmd == 'spawn':
+            if 'spawn' in latest:
+                out[idx] = None
+            else:
+                pending[objID] = {'spawn': idx}
+        elif cmd in latest:
+            prev = latest[cmd]
+            if cmd == 'modify':
+                # Merge the body fields and keep the latest AABBs.
+                rbs = dict(out[prev]['rbs'], **doc['rbs'])
+                aabbs = doc['AABBs']
+                if aabbs is None:
+                    aabbs = out[prev]['AABBs']
+                out[idx] = dict(doc, rbs=rbs, AABBs=aabbs)
+            out[prev] = None
+            latest[cmd] = idx
+        else:
+            latest[cmd] = idx
+    return [_ for _ in out if _ is not None]
+
+
+@typecheck
+def readCommands(maxcount: int=None, poll: bool=True,
+                 gapTimeout: (int, float)=1):
+    """
+    Return and de-queue the pending commands in sequence order.
+
+    The commands arrive via the command channel or the command log (see
+    ``_queueCommands``). This function merges both by sequence number and
+    returns at most ``maxcount`` commands. It holds back all commands after a
+    missing one. The missing command may still be in transit in the channel,
+    or its producer may not have written it yet. Once it has been missing for
+    ``gapTimeout`` seconds (eg because the producer died) this function skips
+    it. If a skipped command arrives later then this function returns it
+    right away (and logs a warning).
+
+    The function only reads the command log if ``poll`` is *True*, if there
+    is no command channel, or if a command is missing. In the latter case it
+    reads the log once when the gap appears, and once more before it skips
+    the gap. It also stores the read position in the 'cmdread' counter
+    whenever it reads the log. A restarted Leonard resumes from there.
+
+    The commands are already coalesced (see ``coalesceCommands``).
+
+    :param int maxcount: maximum number of commands.
+    :param bool poll: whether to query the datastore.
+    :param float gapTimeout: time to wait for missing commands.
+    :return: command documents.
+    :rtype: list
+    """
+    # Resume at the read position of the datastore.
+    if _reader['next'] is None:
+        ret = datastore.getDSHandle('Counters').getCounter('cmdread')
+        if not ret.ok:
+            return RetVal(False, 'Cannot read the command log', None)
+        _reader['next'] = (ret.data or 0) + 1
+    pending = _reader['pending']
+
+    # Fetch the commands from the channel.
+    if _channel is not None:
+        for doc in _channel.pull(maxcount):
+            pending[doc['seq']] = doc
+
+    # Read the log as well if a command is missing, ie there are pending
+    # commands after it.
+    gap = _reader['next']
+    if gap in pending or all(_ < gap for _ in pending):
+        gap = None
+    if gap is not None:
+        if _reader['gap'] != gap:
+            _reader['gap'], _reader['since'] = gap, time.time()
+            poll = True
+        elif time.time() - _reader['since'] >= gapTimeout:
+            poll = True
+
+    if _channel is None or poll:
+        ret = readCommandLog()
+        if not ret.ok:
+            return ret
+        pending.update((_['seq'], _) for _ in ret.data)
+
+    docs = _releaseCommands(maxcount, gapTimeout)
+    if _channel is None or poll:
+        datastore.getDSHandle('Counters').setCounter(
+            'cmdread', _reader['next'] - 1)
+    return RetVal(True, None, coalesceCommands(docs))
+
+
+def _releaseCommands(maxcount: int, gapTimeout: (int, float)):
+    """
+    Remove the consecutive commands from the pending commands and return
+    them (see ``readCommands``).
+
+    :param int maxcount: maximum number of commands.
+    :param float gapTimeout: time to wait for missing commands.
+    :return: command documents in sequence order.
+    :rtype: list
+    """
+    pending = _reader['pending']
+
+    # Commands before the read position arrived after their gap was
+    # skipped. Return them right away.
+    late = sorted(_ for _ in pending if _ < _reader['next'])
+    if len(late) > 0:
+        msg = 'Applying {} late commands (#{}...)'
+        logit.warning(msg.format(len(late), late[0]))
+    docs = [pending.pop(_) for _ in late]
+
+    # Return the commands up to the first missing one. Skip it (and all
+    # other missing ones before the next pending command) if it has been
+    # missing for too long.
+    while len(pending) > 0 and (maxcount is None or len(docs) < maxcount):
+        seq = _reader['next']
+        if seq in pending:
+            docs.append(pending.pop(seq))
+            _reader['next'] = seq + 1
+            continue
+
+        if _reader['gap'] != seq:
+            _reader['gap'], _reader['since'] = seq, time.time()
+        if time.time() - _reader['since'] < gapTimeout:
+            break
+        _reader['next'] = min(pending)
+        msg = 'Skipping missing commands #{}-#{}'
+        logit.warning(msg.format(seq, _reader['next'] - 1))
+    return docs
+
+
+@typecheck
+def dequeueCommands(maxcount: int=None, poll: bool=True):
+    """
+    Return and de-queue the pending commands, sorted by category.
+
+    This is a convenience wrapper around ``readCommands``. It loses the
+    order between the commands of different categories.
+
+    :param int maxcount: maximum number of commands.
+    :param bool poll: whether to query the datastore.
+    :return QueuedCommands: a tuple with lists for each command.
+    """
+    ret = readCommands(maxcount, poll)
+    if not ret.ok:
+        return ret
 
     # Split the commands into categories.
-    spawn = [_ for _ in docs if _['cmd'] == 'spawn']
-    remove = [_ for _ in docs if _['cmd'] == 'remove']
-    modify = [_ for _ in docs if _['cmd'] == 'modify']
-    direct_force = [_ for _ in docs if _['cmd'] == 'direct_force']
-    booster_force = [_ for _ in docs if _['cmd'] == 'booster_force']
-
-    # Compile the output dictionary.
-    out = {'spawn': spawn, 'remove': remove, 'modify': modify,
-           'direct_force': direct_force, 'booster_force': booster_force}
+    out = {'spawn': [], 'remove': [], 'modify': [],
+           'direct_force': [], 'booster_force': []}
+    for doc in ret.data:
+        out[doc['cmd']].append(doc)
     return RetVal(True, None, out)
 
 
@@ -160,8 +516,8 @@ def addCmdSpawn(objData: (tuple, list)):
 
     The ``objData`` variables comprises a list of (objID, body) tuples.
 
-    Returns **False** if ``objID`` already exists, is already scheduled to
-    spawn, or if any of the parameters are invalid.
+    Returns **False** if any of the parameters are invalid. Leonard ignores
+    the spawn commands for objects that already exist.
 
     Other services, most notably Leonard, will periodically check for new
     announcements and incorporate them into the simulation as necessary.
@@ -183,30 +539,28 @@ def addCmdSpawn(objData: (tuple, list)):
             logit.warning(msg)
             return RetVal(False, msg, None)
 
-    # Compile the datastore ops.
-    ops = {}
+    # Compile the command documents.
+    docs = []
     for objID, body in objData:
         # Compile the AABBs. Return immediately if an error occurs.
         aabbs = computeAABBs(body.cshapes)
         if not aabbs.ok:
             return RetVal(False, 'Could not compile all AABBs', None)
 
-        # Insert this document.
-        data = {'rbs': body._asdict(), 'AABBs': aabbs.data}
-        key = 'spawn:{}'.format(objID)
-        ops[key] = {'data': data}
+        docs.append({'cmd': 'spawn', 'objID': objID,
+                     'rbs': body._asdict(), 'AABBs': aabbs.data})
 
-    # Store the spawn commands.
-    db = datastore.getDSHandle('Commands')
-    ret = db.put(ops)
+    # Send the spawn commands.
+    ret = _queueCommands(docs)
     if not ret.ok:
         return ret
 
-    # Notify the user if not all spawn commands could be written. This should
-    # not happen because all object IDs must be unique. If this error occurs
-    # then something is wrong with the atomic object count.
-    if False in ret.data.values():
-        msg = ('At least one spawn command for the same objID already '
+    # Notify the user if not all spawn commands could be written to the
+    # command log. This should not happen because all sequence numbers must
+    # be unique. If this error occurs then something is wrong with the
+    # atomic sequence counter.
+    if ret.data is not None and False in ret.data.values():
+        msg = ('At least one command with the same sequence number already '
                'exists --> serious bug')
         logit.error(msg)
         return RetVal(False, msg, None)
@@ -228,11 +582,7 @@ def addCmdRemoveObject(objID: str):
     :param str objID: ID of object to delete.
     :return: Success.
     """
-    db = datastore.getDSHandle('Commands')
-    key = 'remove:{}'.format(objID)
-    ops = {key: {'data': {}}}
-    db.put(ops)
-
+    _queueCommands([{'cmd': 'remove', 'objID': objID}])
     return RetVal(True, None, None)
 
 
@@ -273,15 +623,10 @@ def addCmdModifyBodyState(objID: str, body: dict):
     body = {k: v for (k, v) in body_sane._asdict().items() if k in body}
     del body_sane
 
-    # Add the new body state and AABBs to the 'command' database from where
-    # clients can read it at their leisure. Note that this will overwrite
-    # already pending update commands for the same object - tough luck.
-    db = datastore.getDSHandle('Commands')
-
-    data = {'rbs': body, 'AABBs': aabbs}
-    key = 'modify:{}'.format(objID)
-    ops = {key: {'data': data}}
-    db.put(ops)
+    # Send the new body state and AABBs to Leonard. It merges them with
+    # the pending updates for the same object (see ``coalesceCommands``).
+    _queueCommands([{'cmd': 'modify', 'objID': objID,
+                     'rbs': body, 'AABBs': aabbs}])
 
     # This function was successful if exactly one document was updated.
     return RetVal(True, None, None)
@@ -308,12 +653,9 @@ def addCmdDirectForce(objID: str, force: list, torque: list):
     if not (len(force) == len(torque) == 3):
         return RetVal(False, 'force or torque has invalid length', None)
 
-    # Compile datastore ops.
-    db = datastore.getDSHandle('Commands')
-    data = {'force': force, 'torque': torque}
-    key = 'direct_force:{}'.format(objID)
-    ops = {key: {'data': data}}
-    db.put(ops)
+    # Send the command to Leonard.
+    _queueCommands([{'cmd': 'direct_force', 'objID': objID,
+                     'force': force, 'torque': torque}])
 
     return RetVal(True, None, None)
 
@@ -345,11 +687,8 @@ def addCmdBoosterForce(objID: str, force: list, torque: list):
     if not (len(force) == len(torque) == 3):
         return RetVal(False, 'force or torque has invalid length', None)
 
-    # Compile datastore ops.
-    db = datastore.getDSHandle('Commands')
-    data = {'force': force, 'torque': torque}
-    key = 'booster_force:{}'.format(objID)
-    ops = {key: {'data': data}}
-    db.put(ops)
+    # Send the command to Leonard.
+    _queueCommands([{'cmd': 'booster_force', 'objID': objID,
+                     'force': force, 'torque': torque}])
 
     return RetVal(True, None, None)
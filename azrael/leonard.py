@@ -23,10 +23,12 @@ import sys
 import zmq
 import time
 import json
+import queue
+import heapq
 import signal
-import pickle
 import logging
-import networkx
+import threading
+import itertools
 import numpy as np
 
 import azrael.igor
@@ -34,18 +36,361 @@ import azrael.datastore
 import azrael.eventstore
 import azrael.vectorgrid
 import azrael.bullet_api
+import azrael.bodystore
+import azrael.wpcodec as wpcodec
 import azutils as util
 import azrael.config as config
 import azrael.leo_api as leoAPI
 
+from collections import namedtuple, deque
 from IPython import embed as ipshell
-from azrael.aztypes import _RigidBodyData, RigidBodyData
-from azrael.aztypes import typecheck, RetVal, WPMeta, WPDataOut, WPDataRet, Forces
+from azrael.aztypes import RigidBodyData
+from azrael.aztypes import typecheck, RetVal, WPMeta
+from azrael.aztypes import CollShapeMeta, CollShapePlane
 
 # Create module logger.
 logit = logging.getLogger('azrael.' + __name__)
 
 
+# Convenience: the world space AABBs of all dynamic bodies in a flat array
+# layout. Row `k` of `aabbMin`/`aabbMax` belongs to body `objIDs[rowBody[k]]`.
+_AABBTable = namedtuple('_AABBTable',
+                        'objIDs rowBody aabbMin aabbMax static ignored')
+
+# Convenience: the world space AABBs and planes of all static bodies. Row `k`
+# of `aabbMin`/`aabbMax` belongs to body `objIDs[rowBody[k]]` and plane `k` to
+# body `objIDs[planeBody[k]]`.
+_StaticTable = namedtuple('_StaticTable', 'objIDs rowBody aabbMin aabbMax '
+                          'planeBody planeNormal planeOfs')
+
+
+def _quatToMatrix(quats: np.ndarray):
+    """
+    Return the rotation matrices for all Quaternions in ``quats``.
+
+    This is the vectorised version of ``util.Quaternion.toMatrix``.
+
+    :param ndarray quats: Nx4 array of (x, y, z, w) Quaternions.
+    :return: Nx3x3 array of rotation matrices.
+    :rtype: ndarray
+    """
+    x, y, z, w = quats[:, 0], quats[:, 1], quats[:, 2], quats[:, 3]
+    out = np.empty((len(quats), 3, 3), np.float64)
+    out[:, 0, 0] = 1 - 2 * y * y - 2 * z * z
+    out[:, 0, 1] = 2 * x * y - 2 * z * w
+    out[:, 0, 2] = 2 * x * z + 2 * y * w
+    out[:, 1, 0] = 2 * x * y + 2 * z * w
+    out[:, 1, 1] = 1 - 2 * x * x - 2 * z * z
+    out[:, 1, 2] = 2 * y * z - 2 * x * w
+    out[:, 2, 0] = 2 * x * z - 2 * y * w
+    out[:, 2, 1] = 2 * y * z + 2 * x * w
+    out[:, 2, 2] = 1 - 2 * x * x - 2 * y * y
+    return out
+
+
+def _unionFind(numNodes: int, src: np.ndarray, dst: np.ndarray):
+    """
+    Return the connected component of every node in a graph.
+
+    The graph has ``numNodes`` nodes and edge ``k`` connects node ``src[k]``
+    with node ``dst[k]``. The component label of each node is the smallest
+    node index in its component.
+
+    This is an array based union-find: every iteration hooks the root of each
+    edge onto the smaller of the two roots, and then uses pointer jumping
+    until every node points directly to its root. The iteration stops once
+    no edge connects two different roots anymore.
+
+    :param int numNodes: number of nodes in the graph.
+    :param ndarray src: node indices where the edges start.
+    :param ndarray dst: node indices where the edges stop.
+    :return: component label for every node.
+    :rtype: ndarray
+    """
+    labels = np.arange(numNodes, dtype=np.int64)
+    src = np.asarray(src, np.int64)
+    dst = np.asarray(dst, np.int64)
+
+    while len(src) > 0:
+        # Only keep the edges that still connect two different trees.
+        root_src, root_dst = labels[src], labels[dst]
+        mask = (root_src != root_dst)
+        if not np.any(mask):
+            break
+        src, dst = src[mask], dst[mask]
+        root_src, root_dst = root_src[mask], root_dst[mask]
+
+        # Hook the larger root onto the smaller one. Since the parent index
+        # can only ever decrease this cannot create cycles.
+        hi = np.maximum(root_src, root_dst)
+        lo = np.minimum(root_src, root_dst)
+        np.minimum.at(labels, hi, lo)
+
+        # Pointer jumping: compress all paths until every node points
+        # directly to its root.
+        while True:
+            tmp = labels[labels]
+            if np.array_equal(tmp, labels):
+                break
+            labels = tmp
+    return labels
+
+
+def _stackVectors(vectors: list, dim: int):
+    """
+    Return the ``vectors`` as an Nx``dim`` array.
+
+    This is considerably faster than ``np.array(vectors)`` for many short
+    vectors.
+
+    :param list vectors: vectors (eg lists or tuples) of length ``dim``.
+    :param int dim: length of each vector.
+    :return: Nx``dim`` array.
+    :rtype: ndarray
+    """
+    num = len(vectors)
+    data = itertools.chain.from_iterable(vectors)
+    return np.fromiter(data, np.float64, num * dim).reshape(num, dim)
+
+
+def _groupsFromOrder(order: np.ndarray, num: int):
+    """
+    Return the sweep group of every interval given the sorted endpoint
+    ``order``.
+
+    The endpoints of ``num`` intervals are enumerated such that endpoint ``k``
+    is the start of interval ``k`` if ``k < num``, and the stop of interval
+    ``k - num`` otherwise. The ``order`` array lists all these endpoints in
+    sorted order.
+
+    Every start position is an increment of +1 and every stop position a
+    decrement of -1. A group is complete whenever the cumulative sum over the
+    sorted increments drops to zero.
+
+    :param ndarray order: permutation of ``range(2 * num)``.
+    :param int num: number of intervals.
+    :return: group index for every interval.
+    :rtype: ndarray
+    """
+    # The group index of an endpoint is the number of completed groups
+    # before it.
+    is_start = (order < num)
+    csum = np.cumsum(np.where(is_start, 1, -1))
+    closed = (csum == 0)
+    group = np.cumsum(closed) - closed
+
+    # Every interval belongs to the group of its start position.
+    out = np.empty(num, np.int64)
+    out[order[is_start]] = group[is_start]
+    return out
+
+
+def _sweepGroups(lo: np.ndarray, hi: np.ndarray, key: np.ndarray=None):
+    """
+    Return the sweep group of every interval [``lo[k]``, ``hi[k]``].
+
+    All intervals in a group form a chain of overlapping intervals. Touching
+    intervals count as overlapping.
+
+    If ``key`` is provided then intervals can only share a group if they also
+    share the same key. This makes it possible to sweep many independent
+    subsets of intervals in one go.
+
+    :param ndarray lo: start positions of the intervals.
+    :param ndarray hi: stop positions of the intervals.
+    :param ndarray key: integer key of every interval (optional).
+    :return: group index for every interval.
+    :rtype: ndarray
+    """
+    num = len(lo)
+    if num == 0:
+        return np.zeros(0, np.int64)
+
+    # Compile the endpoint arrays. The first `num` entries are the start
+    # positions, the remaining ones the stop positions.
+    pos = np.concatenate((lo, hi))
+    is_stop = np.zeros(2 * num, np.int8)
+    is_stop[num:] = 1
+
+    # Sort all endpoints by key, then position. Start positions precede stop
+    # positions at the same location to ensure touching intervals overlap.
+    if key is None:
+        order = np.lexsort((is_stop, pos))
+    else:
+        order = np.lexsort((is_stop, pos, np.concatenate((key, key))))
+    return _groupsFromOrder(order, num)
+
+
+def _linkGroups(rowBody: np.ndarray, numBodies: int, group: np.ndarray):
+    """
+    Return the collision set label of every body.
+
+    A body may own several rows (ie AABBs) and these may end up in different
+    sweep ``group``s. This function merges all groups that share at least one
+    body. The result is a label for every body; bodies with the same label
+    belong to the same collision set.
+
+    :param ndarray rowBody: body index of every row.
+    :param int numBodies: number of bodies.
+    :param ndarray group: sweep group of every row.
+    :return: label of every body.
+    :rtype: ndarray
+    """
+    if len(group) == 0:
+        return np.arange(numBodies, dtype=np.int64)
+
+    # Connect every body to the body with the smallest index in each of its
+    # groups. The connected components of this graph are the collision sets.
+    rep = np.full(group.max() + 1, numBodies, np.int64)
+    np.minimum.at(rep, group, rowBody)
+    return _unionFind(numBodies, rowBody, rep[group])
+
+
+def _sweepBodies(rowBody: np.ndarray, numBodies: int,
+                 aabbMin: np.ndarray, aabbMax: np.ndarray, orders=None,
+                 key: np.ndarray=None):
+    """
+    Return the collision set label of every body.
+
+    This runs the Sweeping algorithm in 'x', then 'y', then 'z' direction.
+    Every stage only sweeps the intervals of those bodies that overlapped in
+    all previous stages.
+
+    The optional ``orders`` argument contains the sorted endpoint order (see
+    ``_groupsFromOrder``) for each of the three axes. If available, the stages
+    only need to (stably) sort the endpoints by the labels of the previous
+    stage instead of sorting them from scratch.
+
+    The optional ``key`` assigns every AABB to a group; AABBs from different
+    groups never overlap.
+
+    :param ndarray rowBody: body index of every AABB.
+    :param int numBodies: number of bodies.
+    :param ndarray aabbMin: Nx3 array of minimum AABB positions.
+    :param ndarray aabbMax: Nx3 array of maximum AABB positions.
+    :param list[ndarray] orders: sorted endpoints for each axis (optional).
+    :param ndarray key: group of every AABB (optional).
+    :return: label of every body.
+    :rtype: ndarray
+    """
+    num = len(rowBody)
+    labels = np.arange(numBodies, dtype=np.int64)
+    for dim in range(3):
+        if orders is None:
+            group = _sweepGroups(aabbMin[:, dim], aabbMax[:, dim], key)
+        else:
+            order = orders[dim]
+            if key is not None:
+                tmp = np.concatenate((key, key))[order]
+                order = order[np.argsort(tmp, kind='stable')]
+            group = _groupsFromOrder(order, num)
+        labels = _linkGroups(rowBody, numBodies, group)
+        key = labels[rowBody]
+    return labels
+
+
+def _bodyBounds(rowBody: np.ndarray, numBodies: int,
+                aabbMin: np.ndarray, aabbMax: np.ndarray):
+    """
+    Return the box that encloses all AABBs of each body.
+
+    This is the first level of the two level broadphase: the broadphase
+    engines only compare these boxes with each other, and then compare the
+    individual AABBs of those bodies whose boxes overlap (see
+    ``_refineSweep`` and ``_refinePairs``). Bodies without AABBs have an
+    empty box, ie +inf for the minimum and -inf for the maximum.
+
+    :param ndarray rowBody: body index of every AABB.
+    :param int numBodies: number of bodies.
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :return: (bodyMin, bodyMax) as numBodies x 3 arrays.
+    :rtype: (ndarray, ndarray)
+    """
+    bodyMin = np.full((numBodies, 3), np.inf)
+    bodyMax = np.full((numBodies, 3), -np.inf)
+    if len(rowBody) == 0:
+        return bodyMin, bodyMax
+
+    # Group the AABBs by body and reduce every group.
+    order = np.argsort(rowBody, kind='stable')
+    row_body = rowBody[order]
+    first = np.flatnonzero(np.diff(row_body)) + 1
+    first = np.concatenate(([0], first))
+    body = row_body[first]
+    bodyMin[body] = np.minimum.reduceat(aabbMin[order], first)
+    bodyMax[body] = np.maximum.reduceat(aabbMax[order], first)
+    return bodyMin, bodyMax
+
+
+def _refineSweep(rowBody: np.ndarray, numBodies: int, aabbMin: np.ndarray,
+                 aabbMax: np.ndarray, labels: np.ndarray):
+    """
+    Return the collision set labels after sweeping the individual AABBs.
+
+    The ``labels`` are the result of sweeping the boxes that enclose all
+    AABBs of a body (see ``_bodyBounds``). This function sweeps the
+    individual AABBs of all sets with at least two bodies where one of them
+    has more than one AABB. Each set is swept independently. All other sets
+    are already final because their AABBs are the enclosing boxes.
+
+    :param ndarray rowBody: body index of every AABB.
+    :param int numBodies: number of bodies.
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :param ndarray labels: collision set label of every body.
+    :return: refined label of every body.
+    :rtype: ndarray
+    """
+    if numBodies == 0:
+        return labels
+
+    # Find the sets to refine.
+    num_rows = np.bincount(rowBody, minlength=numBodies)
+    set_size = np.bincount(labels)
+    refine = np.zeros(len(set_size), bool)
+    refine[labels[num_rows > 1]] = True
+    refine &= (set_size > 1)
+    refine = refine[labels]
+    if not np.any(refine):
+        return labels
+
+    # Sweep the AABBs of the selected bodies, one set at a time.
+    sub_body = np.flatnonzero(refine)
+    sub_idx = np.full(numBodies, -1, np.int64)
+    sub_idx[sub_body] = np.arange(len(sub_body))
+    rows = np.flatnonzero(refine[rowBody])
+    sub_labels = _sweepBodies(
+        sub_idx[rowBody[rows]], len(sub_body), aabbMin[rows], aabbMax[rows],
+        key=labels[rowBody[rows]])
+
+    # Offset the new labels to keep them distinct from the old ones.
+    labels = labels.copy()
+    labels[sub_body] = numBodies + sub_labels
+    return labels
+
+
+def _labelsToSets(objIDs: list, labels: np.ndarray):
+    """
+    Return the list of collision sets defined by the body ``labels``.
+
+    :param list objIDs: the body IDs.
+    :param ndarray labels: collision set label of every body.
+    :return: list of objID lists (eg [['1'], ['2', '3']])
+    :rtype: list[list]
+    """
+    if len(objIDs) == 0:
+        return []
+
+    # Group the body IDs by their label. Slicing a Python list is much
+    # faster than splitting a NumPy array when there are many small sets.
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    bounds = [0] + bounds.tolist() + [len(order)]
+    objIDs = [objIDs[_] for _ in order.tolist()]
+    return [objIDs[a:b] for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+
 @typecheck
 def sweeping(data: dict, dim: str):
     """
@@ -72,89 +417,348 @@ def sweeping(data: dict, dim: str):
     and `dim` must refer to one of them (eg dim = 'y' to find the sets that
     overlap in the 'y' dimension).
 
+    ..note:: ``computeCollisionSetsAABB`` does not use this function but
+             operates on the flat AABB arrays directly.
+
     :param dict{dict} data: dictionary of AABBs in 'x', 'y', 'z' dimension for
        each body.
     :param str dim: the axis to check (must be one of ['x', 'y', 'z'])
     :return: list of bodyID lists (eg [[1], [2, 3, 4]])
     :rtype: list[list]
     """
-    # Determine how many (xmin, xmax) tuples there will be to sort.
-    N = 0
+    # Flatten the intervals of all bodies into a single array.
+    objIDs, rowBody, intervals = [], [], []
     try:
-        for v in data.values():
-            if len(v[dim]) == 0:
+        for objID, v in data.items():
+            tmp = np.array(v[dim], np.float64)
+            if len(tmp) == 0:
                 continue
-
-            # Sanity check: the AABB data must correspond to a matrix (this
-            # check is pretty much redundant because the sanity checks must
-            # happen in the calling function for performance reasons).
-            assert np.array(v[dim], np.float64).ndim == 2
-            N += len(v[dim])
-    except (ValueError, TypeError):
+            assert tmp.ndim == 2 and tmp.shape[1] == 2
+            rowBody.append(np.full(len(tmp), len(objIDs), np.int64))
+            intervals.append(tmp)
+            objIDs.append(str(objID))
+    except (ValueError, TypeError, KeyError, AssertionError):
         return RetVal(False, 'Invalid Sweeping inputs', None)
-    N *= 2
-
-    # Pre-allocate arrays for start/stop position, objID, and an
-    # increment/decrement array used for convenient processing afterwards.
-    arr_pos = np.zeros(N, np.float64)
-    arr_ids = np.zeros(N, np.int64)
-    arr_inc = np.zeros(N, np.int8)
-
-    # Fill the arrays.
-    start = 0
-    for k, v in data.items():
-        for min_max_tuple in v[dim]:
-            stop = start + 2
-            arr_pos[start:stop] = min_max_tuple
-            arr_ids[start:stop] = k
-            arr_inc[start:stop] = [+1, -1]
-            start += 2
-
-    # Sort all three arrays according to the start/stop positions.
-    idx = np.argsort(arr_pos)
-    arr_ids = arr_ids[idx]
-    arr_inc = arr_inc[idx]
-
-    # Sweep over the sorted data and compile the list of object sets.
-    out = []
-    sumVal = 0
-    setObjs = set()
-    for (inc, objID) in zip(arr_inc, arr_ids):
-        # Update the index variable and add the current object to the set (need
-        # to convert it from NumPy int to Python int first).
-        sumVal += inc
-        setObjs.add(objID)
-
-        # A new set of overlapping AABBs is complete whenever `sumVal`
-        # reaches zero.
-        if sumVal == 0:
-            out.append(setObjs)
-            setObjs = set()
-
-        # Safety check: sumVal can never be negative.
-        assert sumVal >= 0
-
-    # Find all connected graphs. This will ensure that each body is in exactly
-    # only collision set only, whereas right now this is not necessarily the
-    # case. The reason for this is that a body may have multiple AABBs, and not
-    # all of them may touch with the same group of objects. Therefore,
-    # amalgamate those sets (ie find all connected sets with the NetworkX
-    # library).
-    g = networkx.Graph()
-    for cs in out:
-        if len(cs) == 0:
+
+    # Return immediately if there is nothing to sweep.
+    if len(objIDs) == 0:
+        return RetVal(True, None, [])
+    rowBody = np.concatenate(rowBody)
+    intervals = np.concatenate(intervals)
+
+    # Sweep the intervals and merge all groups that share a body. This ensures
+    # that each body is in exactly one collision set, even if its AABBs touch
+    # different groups of objects.
+    group = _sweepGroups(intervals[:, 0], intervals[:, 1])
+    labels = _linkGroups(rowBody, len(objIDs), group)
+    return RetVal(True, None, _labelsToSets(objIDs, labels))
+
+
+def _localRows(body, aabbs: dict, aabbMode: str):
+    """
+    Return the local AABB rows of ``body``.
+
+    Each row contains the position, half lengths and orientation (Quaternion)
+    of a box in body coordinates.
+
+    In 'conservative' mode the rows are the ``aabbs`` of the body. These are
+    large enough to contain their collision shape at any rotation.
+
+    In 'tight' mode the rows are the collision shapes of ``body`` (spheres
+    and boxes). The world space AABBs of these rows then take the current
+    rotation of the body into account (see ``_worldAABBs``).
+
+    :param RigidBodyData body: the body.
+    :param dict aabbs: the AABBs of the body.
+    :param str aabbMode: must be 'conservative' or 'tight'.
+    :return: list of rows, or None if the data is invalid.
+    :rtype: list[tuple]
+    """
+    try:
+        if aabbMode == 'conservative':
+            return [tuple(_) + (0, 0, 0, 1) for _ in sorted(aabbs.values())]
+
+        # The collision shapes of ``RigidBodyData`` instances are already
+        # compiled. Avoid compiling them again because this function runs
+        # for every body in every step.
+        rows = []
+        for name in sorted(body.cshapes):
+            cs = body.cshapes[name]
+            if not isinstance(cs, CollShapeMeta):
+                cs = CollShapeMeta(*cs)
+            cstype = cs.cstype.upper()
+            if cstype == 'SPHERE':
+                r = cs.csdata[0]
+                rows.append(tuple(cs.position) + (r, r, r, 0, 0, 0, 1))
+            elif cstype == 'BOX':
+                row = tuple(cs.position) + tuple(cs.csdata)
+                rows.append(row + tuple(cs.rotation))
+        return rows
+    except (TypeError, ValueError):
+        return None
+
+
+def _compileAABBTable(bodies: dict, AABBs: dict,
+                      aabbMode: str='conservative'):
+    """
+    Return the world space AABBs for all ``bodies`` as an ``_AABBTable``.
+
+    The table only contains dynamic bodies with at least one valid AABB. Static
+    bodies (ie imass=0) end up in the `static` list, and dynamic bodies
+    without (valid) AABBs in the `ignored` list.
+
+    AABBs where at least one half length is zero are invalid.
+
+    :param dict[RigidBodyDatas] bodies: the bodies to compile.
+    :param dict[AABBs]: the AABBs of all ``bodies``.
+    :param str aabbMode: 'conservative' or 'tight' (see ``_localRows``).
+    :return: ``_AABBTable`` instance.
+    """
+    bodies_static = []
+    bodies_ignored = []
+
+    # Gather the body parameters and local AABBs of all dynamic bodies. This
+    # is the only part that loops over the bodies in Python.
+    objIDs, positions, rotations, scales = [], [], [], []
+    rowBody, rows = [], []
+    for objID, body in bodies.items():
+        if body.imass == 0:
+            bodies_static.append(objID)
             continue
-        elif len(cs) == 1:
-            g.add_node(cs.pop())
-        else:
-            g.add_path(cs)
-    result = networkx.connected_components(g)
 
-    # NetworkX returned a generator yet the calling code
-    # expects a list of lists. Rectify.
-    result = [[str(a) for a in _] for _ in result]
+        # If the object has no AABBs then add it to the 'ignore' list (this
+        # means it will be an object that does not collide with anything).
+        body_rows = _localRows(body, AABBs[objID], aabbMode)
+        if body_rows is None:
+            return RetVal(False, 'Invalid AABB data', None)
+        if len(body_rows) == 0:
+            bodies_ignored.append(objID)
+            continue
+
+        idx = len(objIDs)
+        objIDs.append(objID)
+        positions.append(body.position)
+        rotations.append(body.rotation)
+        scales.append(body.scale)
+        rowBody.extend([idx] * len(body_rows))
+        rows.extend(body_rows)
+
+    # Return an empty table if there are no dynamic bodies with AABBs.
+    if len(rows) == 0:
+        empty = np.zeros((0, 3), np.float64)
+        table = _AABBTable([], np.zeros(0, np.int64), empty, empty,
+                           bodies_static, bodies_ignored)
+        return RetVal(True, None, table)
+
+    # Sanity check: each row has exactly 10 entries, namely its position,
+    # half lengths and orientation in body coordinates.
+    try:
+        rows = np.array(rows, np.float64)
+        assert rows.ndim == 2 and rows.shape[1] == 10
+    except (ValueError, TypeError, AssertionError):
+        return RetVal(False, 'Invalid AABB data', None)
+    rowBody = np.array(rowBody, np.int64)
+    aabbMin, aabbMax, valid = _worldAABBs(
+        rows, rowBody, np.array(positions, np.float64),
+        np.array(rotations, np.float64), np.array(scales, np.float64),
+        aabbMode)
+
+    # If no AABB of a body was valid then add it to the 'ignore' list. It
+    # will thus, by definition, not collide with anything.
+    has_aabb = np.zeros(len(objIDs), bool)
+    has_aabb[rowBody[valid]] = True
+    bodies_ignored += [objIDs[_] for _ in np.flatnonzero(~has_aabb)]
+
+    # Compile the table with the valid AABBs only and re-index the bodies
+    # accordingly.
+    new_idx = np.cumsum(has_aabb) - 1
+    table = _AABBTable(
+        objIDs=[objIDs[_] for _ in np.flatnonzero(has_aabb)],
+        rowBody=new_idx[rowBody[valid]],
+        aabbMin=aabbMin[valid],
+        aabbMax=aabbMax[valid],
+        static=bodies_static,
+        ignored=bodies_ignored,
+    )
+    return RetVal(True, None, table)
+
+
+def _worldAABBs(rows: np.ndarray, rowBody: np.ndarray, positions: np.ndarray,
+                rotations: np.ndarray, scales: np.ndarray,
+                aabbMode: str='conservative'):
+    """
+    Return the world space AABBs for all ``rows``.
+
+    Each row contains the position, half lengths and orientation of a box in
+    body coordinates (see ``_localRows``). The ``positions``, ``rotations``
+    and ``scales`` denote the state of each body, and ``rowBody`` specifies
+    which body each row belongs to.
+
+    In 'conservative' mode the half lengths of the rows are merely scaled.
+    In 'tight' mode the function computes the (tight) AABB of each box in its
+    current world space orientation.
+
+    An AABB is invalid if at least one of its (scaled) half lengths is zero.
+
+    :param ndarray rows: Nx10 array of boxes in body coordinates.
+    :param ndarray rowBody: body index of every row.
+    :param ndarray positions: Mx3 array of body positions.
+    :param ndarray rotations: Mx4 array of body Quaternions.
+    :param ndarray scales: M array of body scales.
+    :param str aabbMode: 'conservative' or 'tight'.
+    :return: (aabbMin, aabbMax, valid)
+    :rtype: (ndarray, ndarray, ndarray)
+    """
+    # Apply the body scale to the half lengths and flag every AABB where
+    # at least one half length is zero.
+    scale = scales[rowBody, None]
+    half_lengths = rows[:, 3:6] * scale
+    valid = np.all(half_lengths != 0, axis=1)
+
+    # Compute the AABB positions in world coordinates. This takes into
+    # account the position-, rotation, and scale of the body.
+    rot = _quatToMatrix(rotations)[rowBody]
+    ofs = np.einsum('nij,nj->ni', rot, rows[:, :3])
+    pos = positions[rowBody] + scale * ofs
+
+    # The extent of a rotated box along each world axis is the sum of its
+    # half lengths projected onto that axis.
+    if aabbMode == 'tight':
+        rot = np.einsum('nij,njk->nik', rot, _quatToMatrix(rows[:, 6:10]))
+        half_lengths = np.einsum('nij,nj->ni', np.abs(rot), half_lengths)
+    return pos - half_lengths, pos + half_lengths, valid
+
+
+def _compileStatics(objIDs: list, bodies: dict, AABBs: dict,
+                    aabbMode: str='conservative'):
+    """
+    Return the world space AABBs and planes of all static ``objIDs``.
 
-    return RetVal(True, None, result)
+    Static bodies with a Plane shape become planes. Their AABBs (which are
+    always empty) are ignored. All other static bodies contribute their valid
+    AABBs.
+
+    A plane is specified by its world space ``normal`` and offset ``ofs``.
+    All points ``x`` with ``dot(normal, x) <= ofs`` are behind the plane.
+
+    :param list objIDs: IDs of the static bodies.
+    :param dict[RigidBodyDatas] bodies: the bodies.
+    :param dict[AABBs]: the AABBs of all ``bodies``.
+    :param str aabbMode: 'conservative' or 'tight' (see ``_localRows``).
+    :return: ``_StaticTable`` instance.
+    """
+    positions, rotations, scales = [], [], []
+    rowBody, rows = [], []
+    planeBody, planeNormal, planeOfs = [], [], []
+    for idx, objID in enumerate(objIDs):
+        body = bodies[objID]
+        positions.append(body.position)
+        rotations.append(body.rotation)
+        scales.append(body.scale)
+
+        cshapes = [CollShapeMeta(*_) for _ in body.cshapes.values()]
+        planes = [_ for _ in cshapes if _.cstype.upper() == 'PLANE']
+        if len(planes) > 0:
+            for cs in planes:
+                plane = CollShapePlane(*cs.csdata)
+                normal = np.array(plane.normal, np.float64)
+                norm = np.linalg.norm(normal)
+                if norm == 0:
+                    continue
+                planeBody.append(idx)
+                planeNormal.append(normal / norm)
+                planeOfs.append(plane.ofs)
+            continue
+
+        body_rows = _localRows(body, AABBs[objID], aabbMode)
+        if body_rows is None:
+            return RetVal(False, 'Invalid AABB data', None)
+        rowBody.extend([idx] * len(body_rows))
+        rows.extend(body_rows)
+
+    num = len(objIDs)
+    positions = np.array(positions, np.float64).reshape(num, 3)
+    rotations = np.array(rotations, np.float64).reshape(num, 4)
+    scales = np.array(scales, np.float64)
+
+    # Compute the world space AABBs and only retain the valid ones.
+    try:
+        rows = np.array(rows, np.float64).reshape(len(rows), 10)
+    except (ValueError, TypeError):
+        return RetVal(False, 'Invalid AABB data', None)
+    rowBody = np.array(rowBody, np.int64)
+    aabbMin, aabbMax, valid = _worldAABBs(
+        rows, rowBody, positions, rotations, scales, aabbMode)
+
+    # Rotate the plane normals into world coordinates, and move the planes
+    # with their bodies.
+    planeBody = np.array(planeBody, np.int64)
+    normals = np.array(planeNormal, np.float64).reshape(len(planeBody), 3)
+    rot = _quatToMatrix(rotations)[planeBody]
+    normals = np.einsum('nij,nj->ni', rot, normals)
+    ofs = np.array(planeOfs, np.float64)
+    ofs += np.einsum('ni,ni->n', normals, positions[planeBody])
+
+    statics = _StaticTable(
+        objIDs=list(objIDs),
+        rowBody=rowBody[valid],
+        aabbMin=aabbMin[valid],
+        aabbMax=aabbMax[valid],
+        planeBody=planeBody,
+        planeNormal=normals,
+        planeOfs=ofs,
+    )
+    return RetVal(True, None, statics)
+
+
+def _finaliseCollisionSets(table: _AABBTable, labels: np.ndarray,
+                           bodies: dict, AABBs: dict,
+                           staticIndex: '_StaticIndex'=None,
+                           aabbMode: str='conservative'):
+    """
+    Return the collision sets for the body ``labels`` in ``table``.
+
+    This adds the ignored- and static bodies from ``table`` to the collision
+    sets defined by ``labels``.
+
+    Every collision set only receives the static bodies it touches. Static
+    bodies that touch nothing do not appear in any collision set.
+
+    :param _AABBTable table: the AABB table the labels were computed from.
+    :param ndarray labels: collision set label of every body in ``table``.
+    :param dict[RigidBodyDatas] bodies: the bodies.
+    :param dict[AABBs]: the AABBs of all ``bodies``.
+    :param _StaticIndex staticIndex: index for the static bodies (optional).
+    :param str aabbMode: 'conservative' or 'tight' (see ``_localRows``).
+    :return: list of collision sets.
+    :rtype: list[list]
+    """
+    # Add the ignored objects which, by definition, do not collide with
+    # anything. In other words, each ignored body creates a dedicated collision
+    # set with itself as the only member.
+    coll_sets = _labelsToSets(table.objIDs, labels)
+    coll_sets += [[_] for _ in table.ignored]
+    if len(table.static) == 0:
+        return RetVal(True, None, coll_sets)
+
+    # Update the spatial index for the static bodies.
+    ret = _compileStatics(table.static, bodies, AABBs, aabbMode)
+    if not ret.ok:
+        return ret
+    if staticIndex is None:
+        staticIndex = _StaticIndex()
+    staticIndex.update(ret.data)
+
+    # Find all static bodies that touch an AABB, and add them to the
+    # collision set of the respective body (once).
+    rows, statics = staticIndex.contacts(table.aabbMin, table.aabbMax)
+    set_idx = np.unique(labels, return_inverse=True)[1].ravel()
+    pairs = np.unique(np.column_stack(
+        (set_idx[table.rowBody[rows]], statics)), axis=0)
+    static_IDs = staticIndex.statics.objIDs
+    for (idx_set, idx_static) in pairs.tolist():
+        coll_sets[idx_set].append(static_IDs[idx_static])
+    return RetVal(True, None, coll_sets)
 
 
 @typecheck
@@ -165,123 +769,1505 @@ def computeCollisionSetsAABB(bodies: dict, AABBs: dict):
     Bodies with empty AABBs, or AABBs where at least one half length is zero do
     not collide with anything.
 
-    ..note:: *Every* static body will be added to *every* collision set. This
-             will improved in the future when it becomes a bottle neck.
+    Static bodies are only added to the collision sets they touch.
 
     :param dict[RigidBodyDatas] bodies: the bodies to check.
     :param dict[AABBs]: dictionary of AABBs.
     :return: each list contains a unique set of overlapping objects.
     :rtype: list of lists
     """
-    # Ensure we have an AABB for every body.
-    try:
-        AABBs = {k: AABBs[k] for k in bodies}
-    except KeyError:
-        return RetVal(False, 'Some AABBs are missing', None)
-
-    # The 'sweeping' function requires a list of dictionaries. Each dictionary
-    # must contain the position of the AABB (object local coordinates), as well
-    # as the min/max spatial extent in x/y/z direction.
-    sweep_data = {}
-    bodies_ignored = []
-    bodies_static = []
+    return BroadphaseSweeping().collisionSets(bodies, AABBs)
 
-    # Compile the necessary information for the Sweeping algorithm for each
-    # object provided to this function.
-    for objID in bodies:
-        if bodies[objID].imass == 0:
-            bodies_static.append(objID)
-            continue
 
-        # Convenience: unpack the body parameters needed here.
-        pos_rb = bodies[objID].position
-        scale = bodies[objID].scale
-        rot = bodies[objID].rotation
-        quat = util.Quaternion(*rot)
+class BroadphaseSweeping:
+    """
+    Broadphase that computes the collision sets from scratch every step.
+
+    This class also specifies the interface for all broadphase engines:
+    Leonard calls ``insert`` and ``remove`` whenever it spawns, modifies or
+    removes bodies, and ``collisionSets`` once per step.
+
+    :param str aabbMode: 'conservative' uses the AABBs as they are; 'tight'
+                         computes them from the collision shapes and the
+                         current body rotation (see ``_localRows``).
+    """
+    @typecheck
+    def __init__(self, aabbMode: str='conservative'):
+        assert aabbMode in ('conservative', 'tight')
+        self.aabbMode = aabbMode
+
+        # Spatial index for the static bodies.
+        self.staticIndex = _StaticIndex()
+
+    def insert(self, objID: str, body, aabbs: dict):
+        """
+        Add the body ``objID`` with ``aabbs`` to the broadphase.
+
+        Replace the body if it already exists.
+
+        :param str objID: ID of body.
+        :param RigidBodyData body: the body.
+        :param dict aabbs: the AABBs of the body.
+        """
+        pass
+
+    def remove(self, objID: str):
+        """
+        Remove the body ``objID`` from the broadphase.
+
+        It is safe to call this method for bodies that do not exist.
+
+        :param str objID: ID of body.
+        """
+        pass
+
+    def collisionSets(self, bodies: dict, AABBs: dict):
+        """
+        Return the broadphase collision sets for all ``bodies``.
+
+        The return value is identical to that of ``computeCollisionSetsAABB``.
+
+        :param dict[RigidBodyDatas] bodies: the bodies to check.
+        :param dict[AABBs]: dictionary of AABBs.
+        :return: each list contains a unique set of overlapping objects.
+        :rtype: list of lists
+        """
+        # Ensure we have an AABB for every body.
+        try:
+            AABBs = {k: AABBs[k] for k in bodies}
+        except KeyError:
+            return RetVal(False, 'Some AABBs are missing', None)
+
+        # Compile the world space AABBs of all bodies.
+        ret = _compileAABBTable(bodies, AABBs, self.aabbMode)
+        if not ret.ok:
+            return ret
+        table = ret.data
+
+        # Sweep the boxes that enclose all AABBs of a body in 'x', 'y', and
+        # 'z' direction to find the sets of overlapping bodies. Then sweep the
+        # individual AABBs of the sets that contain a body with more than one.
+        num_bodies = len(table.objIDs)
+        bodyMin, bodyMax = _bodyBounds(
+            table.rowBody, num_bodies, table.aabbMin, table.aabbMax)
+        labels = _sweepBodies(
+            np.arange(num_bodies), num_bodies, bodyMin, bodyMax)
+        labels = _refineSweep(table.rowBody, num_bodies, table.aabbMin,
+                              table.aabbMax, labels)
+        return _finaliseCollisionSets(
+            table, labels, bodies, AABBs, self.staticIndex, self.aabbMode)
+
+
+class _BroadphaseRows(BroadphaseSweeping):
+    """
+    Book keeping for broadphase engines that retain state across steps.
+
+    The class maintains a table of all AABBs in body coordinates. Each row
+    in that table belongs to a body slot. The ``insert`` and ``remove``
+    methods add and delete rows; the changes take effect at the next call to
+    ``collisionSets``.
+
+    Body slots are stable: a slot only changes its body once the old body
+    was removed. The derived classes therefore keep their state (eg sorted
+    endpoints or tree leaves) for the slots, not the rows. Each slot has one
+    box that encloses all AABBs of its body (see ``_slotBounds``).
+    """
+    def __init__(self, aabbMode: str='conservative'):
+        super().__init__(aabbMode)
+        self.reset()
+
+    def reset(self):
+        """
+        Remove all bodies.
+        """
+        # Mapping between objIDs and body slots, and the AABBs of every body.
+        self.slots = {}
+        self.aabbs = {}
+        self.slotIDs = []
+        self.freeSlots = []
+
+        # AABB table: the body slot (or -1 for unused rows) and the local AABB
+        # of every row.
+        self.rowBody = np.zeros(0, np.int64)
+        self.rows = np.zeros((0, 10), np.float64)
+
+        # Rows to add, and body slots to delete, in the next step.
+        self.pendingRows = []
+        self.pendingBody = []
+        self.deadSlots = []
+
+    def insert(self, objID: str, body, aabbs: dict):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        self.remove(objID)
+
+        # Claim a body slot.
+        if len(self.freeSlots) > 0:
+            slot = self.freeSlots.pop()
+            self.slotIDs[slot] = objID
+        else:
+            slot = len(self.slotIDs)
+            self.slotIDs.append(objID)
+        self.slots[objID] = slot
+        self.aabbs[objID] = aabbs
+
+        # Queue the AABBs of the new body. Invalid data will produce an error
+        # in the next step.
+        rows = _localRows(body, aabbs, self.aabbMode)
+        if rows is None:
+            rows = [None]
+        self.pendingRows.extend(rows)
+        self.pendingBody.extend([slot] * len(rows))
+
+    def remove(self, objID: str):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        if objID not in self.slots:
+            return
+
+        # Release the body slot. Its rows will be deleted at the next step.
+        # Note: the slot must not be re-used until then because the rows are
+        # identified by their slot.
+        slot = self.slots.pop(objID)
+        del self.aabbs[objID]
+        self.slotIDs[slot] = None
+        self.deadSlots.append(slot)
+
+    def _applyPending(self):
+        """
+        Add the pending rows to the AABB table and remove the dead ones.
+        """
+        # Add the new rows.
+        if len(self.pendingRows) > 0:
+            try:
+                rows = np.array(self.pendingRows, np.float64)
+                assert rows.ndim == 2 and rows.shape[1] == 10
+            except (ValueError, TypeError, AssertionError):
+                # Start from scratch; the next step will re-insert all bodies.
+                self.reset()
+                return RetVal(False, 'Invalid AABB data', None)
+            self.rows = np.vstack((self.rows, rows))
+            self.rowBody = np.concatenate(
+                (self.rowBody, np.array(self.pendingBody, np.int64)))
+            self.pendingRows, self.pendingBody = [], []
+
+        # Mark the rows of all removed bodies as unused.
+        if len(self.deadSlots) > 0:
+            dead = np.isin(self.rowBody, self.deadSlots)
+            self.rowBody[dead] = -1
+            self.freeSlots.extend(self.deadSlots)
+            self.deadSlots = []
+
+        # Compact the table once more than half of the rows are unused.
+        unused = (self.rowBody < 0)
+        if np.count_nonzero(unused) > max(64, len(self.rowBody) // 2):
+            keep = ~unused
+            self.rows = self.rows[keep]
+            self.rowBody = self.rowBody[keep]
+        return RetVal(True, None, None)
+
+    def _sync(self, bodies: dict, AABBs: dict):
+        """
+        Synchronise the bodies in the broadphase with ``bodies``.
+
+        Leonard keeps them in sync via ``insert`` and ``remove`` already, but
+        the caller may also pass a subset of bodies or replace their AABBs.
+        """
+        for objID in [_ for _ in self.slots if _ not in bodies]:
+            self.remove(objID)
+        try:
+            for objID in bodies:
+                if self.aabbs.get(objID, None) is not AABBs[objID]:
+                    self.insert(objID, bodies[objID], AABBs[objID])
+        except KeyError:
+            return RetVal(False, 'Some AABBs are missing', None)
+        return self._applyPending()
+
+    def _worldState(self, bodies: dict):
+        """
+        Return the world space AABBs of all rows.
+
+        The returned ``active`` array flags the valid AABBs of all dynamic
+        bodies. Only those take part in the broadphase. The ``static``
+        array flags all body slots that contain a static body.
+
+        :param dict bodies: the bodies.
+        :return: (aabbMin, aabbMax, active, static)
+        :rtype: (ndarray, ndarray, ndarray, ndarray)
+        """
+        # Compile the state of all body slots. Unused slots are neither
+        # static nor dynamic.
+        num_slots = len(self.slotIDs)
+        live = [k for (k, v) in enumerate(self.slotIDs) if v is not None]
+        live_bodies = [bodies[self.slotIDs[_]] for _ in live]
+        positions = np.zeros((num_slots, 3), np.float64)
+        rotations = np.zeros((num_slots, 4), np.float64)
+        scales = np.zeros(num_slots, np.float64)
+        imass = np.zeros(num_slots, np.float64)
+        if len(live) > 0:
+            pos = [_.position for _ in live_bodies]
+            rot = [_.rotation for _ in live_bodies]
+            positions[live] = _stackVectors(pos, 3)
+            rotations[live] = _stackVectors(rot, 4)
+            scales[live] = [_.scale for _ in live_bodies]
+            imass[live] = [_.imass for _ in live_bodies]
+        used = np.zeros(num_slots, bool)
+        used[live] = True
+        dynamic = used & (imass != 0)
+        static = used & (imass == 0)
+
+        # Compute the world space AABBs and flag the active ones.
+        row_slot = np.maximum(self.rowBody, 0)
+        aabbMin, aabbMax, valid = _worldAABBs(
+            self.rows, row_slot, positions, rotations, scales, self.aabbMode)
+        active = valid & (self.rowBody >= 0) & dynamic[row_slot]
+        return aabbMin, aabbMax, active, static
+
+    def _slotBounds(self, aabbMin: np.ndarray, aabbMax: np.ndarray,
+                    active: np.ndarray):
+        """
+        Return the box that encloses all ``active`` AABBs of every slot.
+
+        The returned ``slotActive`` array flags all slots with at least one
+        active AABB. The boxes of all other slots are empty (see
+        ``_bodyBounds``).
+
+        The arguments are the return values of ``_worldState``.
+
+        :return: (slotMin, slotMax, slotActive)
+        :rtype: (ndarray, ndarray, ndarray)
+        """
+        num_slots = len(self.slotIDs)
+        slotMin, slotMax = _bodyBounds(
+            self.rowBody[active], num_slots, aabbMin[active], aabbMax[active])
+        slotActive = np.zeros(num_slots, bool)
+        slotActive[self.rowBody[active]] = True
+        return slotMin, slotMax, slotActive
+
+    def _compileTable(self, aabbMin: np.ndarray, aabbMax: np.ndarray,
+                      active: np.ndarray, static: np.ndarray):
+        """
+        Return the ``_AABBTable`` for the ``active`` rows.
+
+        The arguments are the return values of ``_worldState``. Row ``k`` of
+        the table corresponds to the ``k``-th active row.
+
+        The table lists the bodies in the order of their slots, ie body ``k``
+        in the table occupies the ``k``-th slot with an active row.
+
+        :return: ``_AABBTable`` instance.
+        """
+        # Re-index the bodies: only dynamic bodies with at least one active
+        # row end up in the table.
+        row_slot = self.rowBody[active]
+        has_aabb = np.zeros(len(self.slotIDs), bool)
+        has_aabb[row_slot] = True
+        dynamic = np.array([_ is not None for _ in self.slotIDs], bool)
+        dynamic &= ~static
+        body_idx = np.cumsum(has_aabb) - 1
+        return _AABBTable(
+            objIDs=[self.slotIDs[_] for _ in np.flatnonzero(has_aabb)],
+            rowBody=body_idx[row_slot],
+            aabbMin=aabbMin[active],
+            aabbMax=aabbMax[active],
+            static=[self.slotIDs[_] for _ in np.flatnonzero(static)],
+            ignored=[self.slotIDs[_]
+                     for _ in np.flatnonzero(dynamic & ~has_aabb)],
+        )
+
+
+class BroadphaseIncremental(_BroadphaseRows):
+    """
+    Sweeping broadphase that keeps its sorted endpoints across steps.
+
+    Bodies barely move between two steps. This class therefore keeps the
+    sorted endpoints of the enclosing box of every body slot (see
+    ``_slotBounds``) for each axis from one step to the next, and merely
+    re-sorts them with an adaptive (stable) sort. The cost of that sort is
+    close to linear for nearly sorted data.
+
+    The endpoints of slot ``k`` are encoded as ``2 * k`` (start) and
+    ``2 * k + 1`` (stop) in the sorted endpoint arrays.
+
+    The collision sets are identical to those of ``BroadphaseSweeping``.
+    """
+    def reset(self):
+        """
+        See docu in ``_BroadphaseRows``.
+        """
+        super().reset()
+
+        # Sorted endpoints for each axis.
+        self.endpoints = [np.zeros(0, np.int64) for _ in range(3)]
+
+    def _sortEndpoints(self, slotMin: np.ndarray, slotMax: np.ndarray):
+        """
+        Re-sort the endpoints of each axis based on the new slot boxes.
+        """
+        # Append the endpoints of new slots to the (otherwise sorted) endpoint
+        # arrays. The sort will move them into place.
+        num_old = len(self.endpoints[0]) // 2
+        if num_old < len(slotMin):
+            new = np.arange(2 * num_old, 2 * len(slotMin))
+            self.endpoints = [np.concatenate((_, new)) for _ in self.endpoints]
+
+        for dim in range(3):
+            ep = self.endpoints[dim]
+            is_stop = (ep & 1).astype(bool)
+            slot = ep >> 1
+            val = np.where(is_stop, slotMax[slot, dim], slotMin[slot, dim])
+
+            # The endpoints are already (almost) sorted from the last step.
+            # The stable sort is thus fast and retains the previous order for
+            # endpoints with the same value.
+            perm = np.argsort(val, kind='stable')
+            ep, val, is_stop = ep[perm], val[perm], is_stop[perm]
+
+            # Touching intervals must overlap, ie start positions must precede
+            # stop positions with the same value. Fall back to a full sort in
+            # the (rare) case where the previous order violates this. The
+            # order of empty boxes (ie unused slots) is irrelevant.
+            tie = (val[1:] == val[:-1]) & is_stop[:-1] & ~is_stop[1:]
+            tie &= np.isfinite(val[1:])
+            if np.any(tie):
+                ep = ep[np.lexsort((is_stop, val))]
+            self.endpoints[dim] = ep
+
+    def collisionSets(self, bodies: dict, AABBs: dict):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        ret = self._sync(bodies, AABBs)
+        if not ret.ok:
+            return ret
+
+        # Compute the world space AABBs, the enclosing box of every slot, and
+        # update the sorted endpoints.
+        aabbMin, aabbMax, active, static = self._worldState(bodies)
+        slotMin, slotMax, slotActive = self._slotBounds(
+            aabbMin, aabbMax, active)
+        self._sortEndpoints(slotMin, slotMax)
+        table = self._compileTable(aabbMin, aabbMax, active, static)
+
+        # Convert the sorted endpoints of the active slots into the format
+        # `_sweepBodies` expects, ie start positions are 0..num_active-1 and
+        # the stop positions are num_active...2*num_active-1. Note that body
+        # `k` in the table is the `k`-th active slot.
+        num_active = np.count_nonzero(slotActive)
+        slot_idx = np.cumsum(slotActive) - 1
+        orders = []
+        for ep in self.endpoints:
+            ep = ep[slotActive[ep >> 1]]
+            orders.append((ep & 1) * num_active + slot_idx[ep >> 1])
+
+        # Sweep the slot boxes, then the individual AABBs where necessary.
+        labels = _sweepBodies(
+            np.arange(num_active), num_active, slotMin[slotActive],
+            slotMax[slotActive], orders)
+        labels = _refineSweep(table.rowBody, num_active, table.aabbMin,
+                              table.aabbMax, labels)
+        return _finaliseCollisionSets(
+            table, labels, bodies, AABBs, self.staticIndex, self.aabbMode)
+
+
+def _runOffsets(counts: np.ndarray):
+    """
+    Return the offset of every element within its run.
+
+    For instance, ``counts=[2, 3]`` returns ``[0, 1, 0, 1, 2]``.
+
+    :param ndarray counts: length of every run.
+    :return: offset of each element within its run.
+    :rtype: ndarray
+    """
+    counts = np.asarray(counts, np.int64)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def _overlapping(aabbMin: np.ndarray, aabbMax: np.ndarray,
+                 src: np.ndarray, dst: np.ndarray):
+    """
+    Return True for every pair of AABBs ``(src[k], dst[k])`` that overlap.
+
+    Touching AABBs overlap.
+
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :param ndarray src: AABB indices.
+    :param ndarray dst: AABB indices.
+    :return: boolean array.
+    :rtype: ndarray
+    """
+    below = aabbMin[src] <= aabbMax[dst]
+    above = aabbMin[dst] <= aabbMax[src]
+    return np.all(below & above, axis=1)
+
+
+def _refinePairs(src: np.ndarray, dst: np.ndarray, rowBody: np.ndarray,
+                 aabbMin: np.ndarray, aabbMax: np.ndarray,
+                 bodyMin: np.ndarray, bodyMax: np.ndarray):
+    """
+    Return True for every body pair ``(src[k], dst[k])`` where at least one
+    AABB of the first body overlaps with an AABB of the second.
+
+    This is the second level of the two level broadphase: the enclosing boxes
+    ``bodyMin``/``bodyMax`` (see ``_bodyBounds``) of the bodies in ``src``
+    and ``dst`` must already overlap. The AABBs are then only compared for
+    pairs where at least one body has more than one AABB, and only those
+    AABBs that overlap with the enclosing box of the other body.
+
+    :param ndarray src: body indices.
+    :param ndarray dst: body indices.
+    :param ndarray rowBody: body index of every AABB.
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :param ndarray bodyMin: Mx3 array of minimum enclosing box corners.
+    :param ndarray bodyMax: Mx3 array of maximum enclosing box corners.
+    :return: boolean array.
+    :rtype: ndarray
+    """
+    # The enclosing box of a body with only one AABB is that AABB.
+    num_rows = np.bincount(rowBody, minlength=len(bodyMin))
+    out = np.ones(len(src), bool)
+    pair = np.flatnonzero((num_rows[src] > 1) | (num_rows[dst] > 1))
+    if len(pair) == 0:
+        return out
+    num_pairs = len(pair)
+    order = np.argsort(rowBody, kind='stable')
+    first = np.cumsum(num_rows) - num_rows
+
+    def _clip(body, other):
+        # Return the AABBs of every `body` that overlap with the enclosing
+        # box of the `other` body, ordered by pair.
+        counts = num_rows[body]
+        pidx = np.repeat(np.arange(num_pairs), counts)
+        rows = order[np.repeat(first[body], counts) + _runOffsets(counts)]
+        other = other[pidx]
+        below = aabbMin[rows] <= bodyMax[other]
+        above = bodyMin[other] <= aabbMax[rows]
+        keep = np.all(below & above, axis=1)
+        return pidx[keep], rows[keep]
+    pidx_a, rows_a = _clip(src[pair], dst[pair])
+    pidx_b, rows_b = _clip(dst[pair], src[pair])
+
+    # Enumerate all combinations of the remaining AABBs of every pair.
+    num_a = np.bincount(pidx_a, minlength=num_pairs)
+    num_b = np.bincount(pidx_b, minlength=num_pairs)
+    counts = num_a * num_b
+    pidx = np.repeat(np.arange(num_pairs), counts)
+    ofs = _runOffsets(counts)
+    stride = num_b[pidx]
+    row_a = rows_a[(np.cumsum(num_a) - num_a)[pidx] + ofs // stride]
+    row_b = rows_b[(np.cumsum(num_b) - num_b)[pidx] + ofs % stride]
+
+    # A pair overlaps if any of its AABB combinations overlaps.
+    hit = _overlapping(aabbMin, aabbMax, row_a, row_b)
+    out[pair] = np.bincount(pidx[hit], minlength=num_pairs) > 0
+    return out
+
+
+def _gridCellSize(aabbMin: np.ndarray, aabbMax: np.ndarray):
+    """
+    Return a grid cell size suitable for the AABB distribution.
+
+    The cell size is twice the median of the largest edge of every AABB. Most
+    AABBs thus touch between one and eight cells.
+
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :return: cell size
+    :rtype: float
+    """
+    if len(aabbMin) == 0:
+        return 1.0
+    size = 2 * np.median(np.max(aabbMax - aabbMin, axis=1))
+    return float(size) if size > 0 else 1.0
+
+
+def _gridPairs(aabbMin: np.ndarray, aabbMax: np.ndarray,
+               cellSize: float, maxCells: int):
+    """
+    Return all pairs of overlapping AABBs.
+
+    Bin the AABBs into a uniform grid with ``cellSize``, and only test those
+    AABBs against each other that share a cell. A pair of AABBs usually
+    shares several cells; it is only tested in the cell that contains the
+    (component wise) maximum of both minimum corners.
+
+    AABBs that would occupy more than ``maxCells`` cells (eg a space station
+    among asteroids) are tested against all other AABBs instead.
+
+    :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+    :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+    :param float cellSize: edge length of the grid cells.
+    :param int maxCells: maximum number of cells an AABB may occupy.
+    :return: (src, dst) AABB indices of the overlapping pairs.
+    :rtype: (ndarray, ndarray)
+    """
+    num_aabbs = len(aabbMin)
+    lo = np.floor(aabbMin / cellSize).astype(np.int64)
+    hi = np.floor(aabbMax / cellSize).astype(np.int64)
+    span = hi - lo + 1
+    num_cells = np.prod(span.astype(np.float64), axis=1)
+    large = np.flatnonzero(num_cells > maxCells)
+    small = np.flatnonzero(num_cells <= maxCells)
+
+    # Enumerate all cells of all small AABBs.
+    counts = num_cells[small].astype(np.int64)
+    row = np.repeat(small, counts)
+    ofs = _runOffsets(counts)
+    sp = span[row]
+    cells = lo[row] + np.column_stack((
+        ofs // (sp[:, 1] * sp[:, 2]),
+        (ofs // sp[:, 2]) % sp[:, 1],
+        ofs % sp[:, 2]))
+
+    # Compute a unique key for every cell.
+    if len(cells) > 0:
+        cells_ofs = cells - cells.min(axis=0)
+        dims = cells_ofs.max(axis=0) + 1
+        if np.prod(dims.astype(np.float64)) < 2 ** 62:
+            key = (cells_ofs[:, 0] * dims[1] + cells_ofs[:, 1]) * dims[2]
+            key += cells_ofs[:, 2]
+        else:
+            key = np.unique(cells_ofs, axis=0, return_inverse=True)[1]
+            key = key.ravel()
+    else:
+        key = np.zeros(0, np.int64)
+
+    # Sort the entries by cell and determine the runs of identical cells.
+    order = np.argsort(key, kind='stable')
+    key, row, cells = key[order], row[order], cells[order]
+    first = np.ones(len(key), bool)
+    first[1:] = (key[1:] != key[:-1])
+    run_start = np.flatnonzero(first)
+    run_len = np.diff(np.append(run_start, len(key)))
+
+    # Pair every entry with all subsequent entries of the same cell, and
+    # discard all pairs that do not overlap. The test proceeds one axis at a
+    # time to discard most pairs early.
+    pos_in_run = _runOffsets(run_len)
+    num_partners = np.repeat(run_len, run_len) - pos_in_run - 1
+    pos = np.repeat(np.arange(len(key)), num_partners)
+    src, dst = row[pos], row[pos + 1 + _runOffsets(num_partners)]
+    for dim in range(3):
+        below = aabbMin[src, dim] <= aabbMax[dst, dim]
+        mask = below & (aabbMin[dst, dim] <= aabbMax[src, dim])
+        src, dst, pos = src[mask], dst[mask], pos[mask]
+
+    # Only keep each pair in one cell, namely the cell that contains the
+    # maximum of both minimum corners.
+    mask = np.all(cells[pos] == np.maximum(lo[src], lo[dst]), axis=1)
+    src, dst = [src[mask]], [dst[mask]]
+
+    # Test the large AABBs against all others.
+    for idx in large:
+        other = np.flatnonzero(_overlapping(
+            aabbMin, aabbMax, np.full(num_aabbs, idx), np.arange(num_aabbs)))
+        src.append(np.full(len(other), idx))
+        dst.append(other)
+    return np.concatenate(src), np.concatenate(dst)
+
+
+class BroadphaseGrid(BroadphaseSweeping):
+    """
+    Spatial hash broadphase.
+
+    Bin the enclosing box of every body (see ``_bodyBounds``) into a uniform
+    grid and only test those boxes for overlap that share a grid cell. Then
+    test the individual AABBs of the overlapping pairs (see
+    ``_refinePairs``). Bodies with overlapping AABBs end up in the same
+    collision set.
+
+    Unlike the sweeping algorithm, which connects all bodies whose AABBs
+    overlap in the x-dimension before it considers y and z, this engine
+    only connects bodies whose AABBs actually overlap. It is thus well suited
+    for dense, clustered scenes. The collision sets of this engine are
+    therefore never larger than those produced by the sweeping engines.
+
+    :param float cellSize: edge length of the grid cells (use None to derive
+                           it from the AABB distribution in every step).
+    :param int maxCells: AABBs that would occupy more than ``maxCells`` cells
+                         are tested against all other AABBs instead.
+    """
+    def __init__(self, cellSize: float=None, maxCells: int=64,
+                 aabbMode: str='conservative'):
+        super().__init__(aabbMode)
+        self.cellSize = cellSize
+        self.maxCells = maxCells
+
+    def collisionSets(self, bodies: dict, AABBs: dict):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        # Ensure we have an AABB for every body.
+        try:
+            AABBs = {k: AABBs[k] for k in bodies}
+        except KeyError:
+            return RetVal(False, 'Some AABBs are missing', None)
+
+        # Compile the world space AABBs of all bodies.
+        ret = _compileAABBTable(bodies, AABBs, self.aabbMode)
+        if not ret.ok:
+            return ret
+        table = ret.data
+
+        # Determine all bodies with overlapping boxes, then discard the pairs
+        # whose individual AABBs do not overlap. Connect the remaining ones.
+        num_bodies = len(table.objIDs)
+        bodyMin, bodyMax = _bodyBounds(
+            table.rowBody, num_bodies, table.aabbMin, table.aabbMax)
+        cellSize = self.cellSize
+        if cellSize is None:
+            cellSize = _gridCellSize(bodyMin, bodyMax)
+        src, dst = _gridPairs(bodyMin, bodyMax, cellSize, self.maxCells)
+        mask = _refinePairs(src, dst, table.rowBody, table.aabbMin,
+                            table.aabbMax, bodyMin, bodyMax)
+        labels = _unionFind(num_bodies, src[mask], dst[mask])
+        return _finaliseCollisionSets(
+            table, labels, bodies, AABBs, self.staticIndex, self.aabbMode)
+
+
+def _bvhBuild(boxMin: np.ndarray, boxMax: np.ndarray):
+    """
+    Return a bounding volume hierarchy for the ``boxMin``/``boxMax`` boxes.
+
+    The build is top down: split every node at the median of the box
+    centers along the axis where the centers are spread out the most. All
+    nodes of one tree level are split at the same time.
+
+    Nodes ``0`` to ``N - 1`` are the leaves, ie leaf ``k`` contains box
+    ``k``. All other nodes are internal nodes. The children of an internal
+    node are ``left[node]`` and ``right[node]``; leaves have no children
+    (ie -1). The ``height`` of a node is the length of the longest path to
+    one of its leaves.
+
+    :param ndarray boxMin: Nx3 array of minimum box corners.
+    :param ndarray boxMax: Nx3 array of maximum box corners.
+    :return: (left, right, parent, height, nodeMin, nodeMax, root)
+    """
+    num_leaves = len(boxMin)
+    num_nodes = max(2 * num_leaves - 1, 0)
+    left = np.full(num_nodes, -1, np.int64)
+    right = np.full(num_nodes, -1, np.int64)
+    parent = np.full(num_nodes, -1, np.int64)
+    if num_leaves == 0:
+        empty = np.zeros((0, 3), np.float64)
+        return left, right, parent, left.copy(), empty, empty, -1
+    if num_leaves == 1:
+        return (left, right, parent, np.zeros(1, np.int64),
+                boxMin.copy(), boxMax.copy(), 0)
+
+    centers = (boxMin + boxMax) / 2
+    perm = np.arange(num_leaves)
+
+    # The segments of ``perm`` that still need splitting, and their node IDs.
+    seg_start = np.zeros(1, np.int64)
+    seg_len = np.array([num_leaves], np.int64)
+    seg_node = np.array([num_leaves], np.int64)
+    next_node = num_leaves + 1
+    levels = []
+    while len(seg_start) > 0:
+        levels.append(seg_node)
+
+        # Find the axis along which the box centers of each segment are
+        # spread out the most.
+        seg_id = np.repeat(np.arange(len(seg_start)), seg_len)
+        pos = np.repeat(seg_start, seg_len) + _runOffsets(seg_len)
+        c = centers[perm[pos]]
+        ofs = np.cumsum(seg_len) - seg_len
+        spread = np.maximum.reduceat(c, ofs) - np.minimum.reduceat(c, ofs)
+        axis = np.argmax(spread, axis=1)
+
+        # Sort the boxes of every segment along that axis.
+        order = np.lexsort((c[np.arange(len(pos)), axis[seg_id]], seg_id))
+        perm[pos] = perm[pos[order]]
+
+        # Split every segment in half. Children with only one box are leaves.
+        half = seg_len // 2
+        child_start = np.concatenate((seg_start, seg_start + half))
+        child_len = np.concatenate((half, seg_len - half))
+        is_leaf = (child_len == 1)
+        child_node = np.zeros(len(child_start), np.int64)
+        child_node[is_leaf] = perm[child_start[is_leaf]]
+        num_new = np.count_nonzero(~is_leaf)
+        child_node[~is_leaf] = np.arange(next_node, next_node + num_new)
+        next_node += num_new
+
+        num_seg = len(seg_start)
+        left[seg_node] = child_node[:num_seg]
+        right[seg_node] = child_node[num_seg:]
+        parent[child_node] = np.concatenate((seg_node, seg_node))
+
+        seg_start = child_start[~is_leaf]
+        seg_len = child_len[~is_leaf]
+        seg_node = child_node[~is_leaf]
+
+    # Compute the boxes and heights of all internal nodes bottom up.
+    nodeMin = np.zeros((num_nodes, 3), np.float64)
+    nodeMax = np.zeros((num_nodes, 3), np.float64)
+    nodeMin[:num_leaves], nodeMax[:num_leaves] = boxMin, boxMax
+    height = np.zeros(num_nodes, np.int64)
+    for nodes in reversed(levels):
+        l, r = left[nodes], right[nodes]
+        nodeMin[nodes] = np.minimum(nodeMin[l], nodeMin[r])
+        nodeMax[nodes] = np.maximum(nodeMax[l], nodeMax[r])
+        height[nodes] = 1 + np.maximum(height[l], height[r])
+    return left, right, parent, height, nodeMin, nodeMax, num_leaves
+
+
+def _bvhQuery(left: np.ndarray, right: np.ndarray, nodeLeaf: np.ndarray,
+              nodeMin: np.ndarray, nodeMax: np.ndarray, root: int,
+              qmin: np.ndarray, qmax: np.ndarray):
+    """
+    Return all leaves whose box overlaps with one of the query boxes.
+
+    All queries traverse the tree at the same time, one level per iteration.
+
+    The tree is specified by the node arrays (see ``_bvhBuild``).
+    ``nodeLeaf`` contains the (non-negative) payload of every leaf and -1 for
+    all internal nodes.
+
+    :param ndarray qmin: Nx3 array of minimum corners of the query boxes.
+    :param ndarray qmax: Nx3 array of maximum corners of the query boxes.
+    :return: (query, leaf) indices of all overlapping query boxes and leaf
+             payloads.
+    :rtype: (ndarray, ndarray)
+    """
+    out_query, out_leaf = [], []
+    if root == -1 or len(qmin) == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    query = np.arange(len(qmin))
+    nodes = np.full(len(qmin), root, np.int64)
+    while len(nodes) > 0:
+        # Discard all nodes that do not overlap with their query box.
+        for dim in range(3):
+            below = qmin[query, dim] <= nodeMax[nodes, dim]
+            mask = below & (nodeMin[nodes, dim] <= qmax[query, dim])
+            query, nodes = query[mask], nodes[mask]
+
+        # Report the leaves and descend into the children of all internal
+        # nodes.
+        leaf = nodeLeaf[nodes]
+        is_leaf = (leaf >= 0)
+        out_query.append(query[is_leaf])
+        out_leaf.append(leaf[is_leaf])
+
+        query, nodes = query[~is_leaf], nodes[~is_leaf]
+        query = np.concatenate((query, query))
+        nodes = np.concatenate((left[nodes], right[nodes]))
+    return np.concatenate(out_query), np.concatenate(out_leaf)
+
+
+class _StaticIndex:
+    """
+    Spatial index for all static bodies.
+
+    The index contains the AABBs of all static bodies in a bounding volume
+    hierarchy, and all planes as half spaces. Since static bodies rarely
+    change the index is only rebuilt when they do.
+    """
+    def __init__(self):
+        self.statics = None
+        self.tree = _bvhBuild(np.zeros((0, 3)), np.zeros((0, 3)))
+        self.nodeLeaf = np.zeros(0, np.int64)
+
+    def update(self, statics: _StaticTable):
+        """
+        Replace the static bodies in the index with ``statics``.
+
+        :param _StaticTable statics: the static bodies.
+        """
+        # Do nothing if the static bodies have not changed.
+        old = self.statics
+        if old is not None and old.objIDs == statics.objIDs:
+            pairs = zip(old[1:], statics[1:])
+            if all(np.array_equal(a, b) for (a, b) in pairs):
+                self.statics = statics
+                return
+
+        # Rebuild the tree for the static AABBs.
+        self.statics = statics
+        self.tree = _bvhBuild(statics.aabbMin, statics.aabbMax)
+        self.nodeLeaf = np.full(len(self.tree[0]), -1, np.int64)
+        self.nodeLeaf[:len(statics.rowBody)] = statics.rowBody
+
+    def contacts(self, aabbMin: np.ndarray, aabbMax: np.ndarray):
+        """
+        Return all pairs of AABBs and static bodies that touch.
+
+        An AABB touches a plane if it (partially) lies behind it.
+
+        :param ndarray aabbMin: Nx3 array of minimum AABB corners.
+        :param ndarray aabbMax: Nx3 array of maximum AABB corners.
+        :return: (row, static) indices of the AABBs and static bodies.
+        :rtype: (ndarray, ndarray)
+        """
+        left, right, _, _, nodeMin, nodeMax, root = self.tree
+        rows, statics = _bvhQuery(left, right, self.nodeLeaf, nodeMin,
+                                  nodeMax, root, aabbMin, aabbMax)
+        rows, statics = [rows], [statics]
+
+        # Test all AABBs against all planes. The vertex of the AABB that lies
+        # furthest behind the plane decides.
+        pos = (aabbMax + aabbMin) / 2
+        half_lengths = (aabbMax - aabbMin) / 2
+        st = self.statics
+        for idx, normal, ofs in zip(st.planeBody, st.planeNormal, st.planeOfs):
+            dist = pos.dot(normal) - half_lengths.dot(np.abs(normal))
+            touch = np.flatnonzero(dist <= ofs)
+            rows.append(touch)
+            statics.append(np.full(len(touch), idx, np.int64))
+        return np.concatenate(rows), np.concatenate(statics)
+
+
+class BroadphaseBVH(_BroadphaseRows):
+    """
+    Dynamic bounding volume hierarchy (BVH) broadphase.
+
+    Every body is a leaf in a binary tree of boxes. The leaves store *fat*
+    boxes, ie the box that encloses all AABBs of the body (see
+    ``_slotBounds``) enlarged by ``margin`` times its largest edge. As long
+    as the box of a body stays inside its fat box neither the tree nor the
+    list of candidate pairs (ie pairs of overlapping fat boxes) changes.
+    Only the actual boxes of the candidate pairs need testing in that case,
+    followed by the individual AABBs of the overlapping pairs (see
+    ``_refinePairs``).
+
+    Boxes that escaped their fat box receive a new one, and the tree refits
+    the boxes of their ancestors. Spawned and removed bodies are inserted
+    into (removed from) the tree one by one. Then the class queries the tree
+    for the new candidate pairs of all affected bodies.
+
+    These updates gradually degrade the tree. The class therefore rebuilds
+    it from scratch once the number of changed leaves since the last build
+    exceeds ``rebuildFraction`` times the number of leaves.
+
+    Since the tree adapts to the AABB sizes this engine suits worlds where
+    body sizes vary by orders of magnitude. Like ``BroadphaseGrid`` it only
+    connects bodies whose AABBs actually overlap.
+
+    :param float margin: relative size of the fat AABBs.
+    :param float rebuildFraction: rebuild the tree once this fraction of
+                                  leaves has changed.
+    """
+    def __init__(self, margin: float=0.25, rebuildFraction: float=0.25,
+                 aabbMode: str='conservative'):
+        self.margin = margin
+        self.rebuildFraction = rebuildFraction
+        super().__init__(aabbMode)
+
+    def reset(self):
+        """
+        See docu in ``_BroadphaseRows``.
+        """
+        super().reset()
+
+        # The tree nodes.
+        self.left = np.zeros(0, np.int64)
+        self.right = np.zeros(0, np.int64)
+        self.parent = np.zeros(0, np.int64)
+        self.height = np.zeros(0, np.int64)
+        self.nodeSlot = np.zeros(0, np.int64)
+        self.nodeMin = np.zeros((0, 3), np.float64)
+        self.nodeMax = np.zeros((0, 3), np.float64)
+        self.freeNodes = []
+        self.root = -1
+
+        # The leaf node of every slot (-1 if the slot is not in the tree).
+        self.slotLeaf = np.zeros(0, np.int64)
+
+        # Candidate pairs, ie slots with overlapping fat boxes (pairA < pairB).
+        self.pairA = np.zeros(0, np.int64)
+        self.pairB = np.zeros(0, np.int64)
+
+        # Number of changed leaves since the last rebuild, and whether the
+        # tree must be rebuilt in the next step.
+        self.numChanges = 0
+        self.rebuild = True
+
+    def _numLeaves(self):
+        return np.count_nonzero(self.slotLeaf >= 0)
+
+    def _exceedsChangeLimit(self, num: int):
+        """
+        Return True if the tree should be rebuilt after ``num`` more changes.
+        """
+        limit = max(32, self.rebuildFraction * self._numLeaves())
+        return self.numChanges + num > limit
+
+    def _fatBoxes(self, boxMin: np.ndarray, boxMax: np.ndarray):
+        """
+        Return the fat versions of the ``boxMin``/``boxMax`` boxes.
+        """
+        margin = self.margin * np.max(boxMax - boxMin, axis=1, keepdims=True)
+        return boxMin - margin, boxMax + margin
+
+    def _allocNode(self):
+        """
+        Return the index of an unused tree node.
+        """
+        if len(self.freeNodes) == 0:
+            # Double the capacity of all node arrays.
+            old = len(self.left)
+            num = max(old, 16)
+            unused = np.full(num, -1, np.int64)
+            self.left = np.concatenate((self.left, unused))
+            self.right = np.concatenate((self.right, unused))
+            self.parent = np.concatenate((self.parent, unused))
+            self.height = np.concatenate((self.height, np.zeros_like(unused)))
+            self.nodeSlot = np.concatenate((self.nodeSlot, unused))
+            self.nodeMin = np.vstack((self.nodeMin, np.zeros((num, 3))))
+            self.nodeMax = np.vstack((self.nodeMax, np.zeros((num, 3))))
+            self.freeNodes = list(range(old + num - 1, old - 1, -1))
+        return self.freeNodes.pop()
+
+    def _freeNode(self, node: int):
+        self.left[node] = self.right[node] = self.parent[node] = -1
+        self.nodeSlot[node] = -1
+        self.freeNodes.append(node)
+
+    def _refitUpwards(self, node: int):
+        """
+        Recompute the boxes and heights of ``node`` and all its ancestors.
+        """
+        left, right = self.left, self.right
+        while node != -1:
+            l, r = left[node], right[node]
+            self.nodeMin[node] = np.minimum(self.nodeMin[l], self.nodeMin[r])
+            self.nodeMax[node] = np.maximum(self.nodeMax[l], self.nodeMax[r])
+            self.height[node] = 1 + max(self.height[l], self.height[r])
+            node = self.parent[node]
+
+    def _insertLeaf(self, slot: int, fatMin: np.ndarray, fatMax: np.ndarray):
+        """
+        Add a leaf for ``slot`` with the fat box ``fatMin``/``fatMax``.
+        """
+        leaf = self._allocNode()
+        self.nodeSlot[leaf] = slot
+        self.nodeMin[leaf], self.nodeMax[leaf] = fatMin, fatMax
+        self.height[leaf] = 0
+        self.slotLeaf[slot] = leaf
+        if self.root == -1:
+            self.root = leaf
+            return
 
-        # Create an empty data structure (will be populated below).
-        sweep_data[objID] = {'x': [], 'y': [], 'z': []}
+        # Descend into the child whose perimeter grows the least when it
+        # has to contain the new leaf, until we reach a leaf.
+        node = self.root
+        while self.nodeSlot[node] < 0:
+            cost = []
+            for child in (self.left[node], self.right[node]):
+                cmin, cmax = self.nodeMin[child], self.nodeMax[child]
+                union = np.maximum(cmax, fatMax) - np.minimum(cmin, fatMin)
+                cost.append(np.sum(union) - np.sum(cmax - cmin))
+            node = self.left[node] if cost[0] <= cost[1] else self.right[node]
+
+        # Replace the sibling with a new internal node that holds the sibling
+        # and the new leaf.
+        sibling, grandparent = node, self.parent[node]
+        node = self._allocNode()
+        self.left[node], self.right[node] = sibling, leaf
+        self.parent[node] = grandparent
+        self.parent[sibling] = self.parent[leaf] = node
+        if grandparent == -1:
+            self.root = node
+        elif self.left[grandparent] == sibling:
+            self.left[grandparent] = node
+        else:
+            self.right[grandparent] = node
+        self._refitUpwards(node)
 
-        # If the object has no AABBs then add it to the 'ignore' list (this
-        # means it will be an object that does not collide with anything).
-        if len(AABBs[objID]) == 0:
-            bodies_ignored.append(objID)
-            continue
+    def _removeLeaf(self, slot: int):
+        """
+        Remove the leaf of ``slot`` from the tree.
+        """
+        leaf = self.slotLeaf[slot]
+        self.slotLeaf[slot] = -1
+        node = self.parent[leaf]
+        self._freeNode(leaf)
+        if node == -1:
+            self.root = -1
+            return
 
-        # Iterate over all AABBs, rotate- and translate them in accordance with
-        # the body theyt are attached to, and compile the AABB boundaries.
-        # Note: the AABBs are not re-computed here. The assumption is that the
-        # AABB is large enough to contain their body at any rotation.
-        for aabb in sorted(AABBs[objID].values()):
-            # Sanity check: each AABB has exactly 6 entries. Since any given
-            # body can have multiple of them the number of values in the array
-            # must be an integer multiple of 6.
-            aabb = np.array(aabb, np.float64)
-            assert aabb.ndim == 1
-            assert len(aabb) % 6 == 0
-
-            # Convenience: unpack the AABB positions and half lengths. Apply
-            # the 'scale' to the half lengths.
-            pos_aabb, half_lengths = aabb[:3], aabb[3:]
-            half_lengths *= scale
-
-            # Skip the current AABB if at least on of its half lengths is zero.
-            if 0 in half_lengths:
-                continue
+        # Replace the parent with the sibling.
+        if self.left[node] == leaf:
+            sibling = self.right[node]
+        else:
+            sibling = self.left[node]
+        grandparent = self.parent[node]
+        self.parent[sibling] = grandparent
+        self._freeNode(node)
+        if grandparent == -1:
+            self.root = sibling
+            return
+        if self.left[grandparent] == node:
+            self.left[grandparent] = sibling
+        else:
+            self.right[grandparent] = sibling
+        self._refitUpwards(grandparent)
 
-            # Compute the AABB position in world coordinates. This takes into
-            # account the position-, rotation, and scale of the body.
-            pos = pos_rb + scale * (quat * pos_aabb)
+    def _detach(self, slots: np.ndarray):
+        """
+        Remove the leaves of all ``slots`` from the tree.
+        """
+        if len(slots) == 0:
+            return
+        if not self.rebuild and self._exceedsChangeLimit(len(slots)):
+            self.rebuild = True
+        if self.rebuild:
+            self.slotLeaf[slots] = -1
+        else:
+            for slot in slots:
+                self._removeLeaf(slot)
+            self.numChanges += len(slots)
 
-            # Compute the min/max value of the AABB value in world coordinates.
-            pmin = pos - half_lengths
-            pmax = pos + half_lengths
+            # Remove all candidate pairs that contain one of the slots.
+            keep = ~(np.isin(self.pairA, slots) | np.isin(self.pairB, slots))
+            self.pairA, self.pairB = self.pairA[keep], self.pairB[keep]
 
-            # Store the result for this AABB.
-            sweep_data[objID]['x'].append([pmin[0], pmax[0]])
-            sweep_data[objID]['y'].append([pmin[1], pmax[1]])
-            sweep_data[objID]['z'].append([pmin[2], pmax[2]])
+    def _build(self, slots: np.ndarray, fatMin: np.ndarray,
+               fatMax: np.ndarray):
+        """
+        Build the tree for ``slots`` from scratch.
+        """
+        left, right, parent, height, nodeMin, nodeMax, root = _bvhBuild(
+            fatMin, fatMax)
+        num = len(slots)
+        self.left, self.right, self.parent = left, right, parent
+        self.height, self.nodeMin, self.nodeMax = height, nodeMin, nodeMax
+        self.nodeSlot = np.full(len(left), -1, np.int64)
+        self.nodeSlot[:num] = slots
+        self.root = root
+        self.freeNodes = []
+        self.slotLeaf[:] = -1
+        self.slotLeaf[slots] = np.arange(num)
+        self.numChanges = 0
+        self.rebuild = False
+
+    def _refit(self, leaves: np.ndarray):
+        """
+        Recompute the boxes of all ancestors of ``leaves``.
+        """
+        # Find all ancestors.
+        marked = np.zeros(len(self.left), bool)
+        nodes = np.unique(self.parent[leaves])
+        nodes = nodes[nodes >= 0]
+        while len(nodes) > 0:
+            marked[nodes] = True
+            nodes = np.unique(self.parent[nodes])
+            nodes = nodes[nodes >= 0]
+            nodes = nodes[~marked[nodes]]
+
+        # Refit them bottom up. Every node has a larger height than its
+        # children.
+        nodes = np.flatnonzero(marked)
+        nodes = nodes[np.argsort(self.height[nodes], kind='stable')]
+        heights = self.height[nodes]
+        splits = np.flatnonzero(np.diff(heights)) + 1
+        for level in np.split(nodes, splits):
+            l, r = self.left[level], self.right[level]
+            self.nodeMin[level] = np.minimum(self.nodeMin[l], self.nodeMin[r])
+            self.nodeMax[level] = np.maximum(self.nodeMax[l], self.nodeMax[r])
+
+    def _query(self, slots: np.ndarray):
+        """
+        Return all slots whose fat box overlaps with the fat box of ``slots``.
 
-        # If no AABB was constructed (ie all AABBs contained at least one half
-        # length that was zero) then merely add the object to the 'ignore'
-        # list. It will thus, by definition, not collide with anything.
-        if len(sweep_data[objID]['x']) == 0:
-            bodies_ignored.append(objID)
-            continue
-    del bodies, AABBs
+        :param ndarray slots: the slots to query.
+        :return: (src, dst) slot pairs with overlapping fat boxes.
+        :rtype: (ndarray, ndarray)
+        """
+        leaves = self.slotLeaf[slots]
+        query, dst = _bvhQuery(
+            self.left, self.right, self.nodeSlot, self.nodeMin, self.nodeMax,
+            self.root, self.nodeMin[leaves], self.nodeMax[leaves])
 
-    # Determine the sets of objects that overlap in 'x' direction.
-    stage_0 = sweeping(sweep_data, 'x').data
+        # Every fat box overlaps with itself.
+        src = slots[query]
+        mask = (src != dst)
+        return src[mask], dst[mask]
 
-    # Iterate over all the just found sets. For each, determine the sets that
-    # overlap in the 'y' dimension.
-    stage_1 = []
-    for subset in stage_0:
-        res = sweeping({k: sweep_data[k] for k in subset}, 'y')
-        stage_1.extend(res.data)
+    def _updatePairs(self, slots: np.ndarray):
+        """
+        Replace the candidate pairs of all ``slots``.
+        """
+        changed = np.zeros(len(self.slotLeaf), bool)
+        changed[slots] = True
+        keep = ~(changed[self.pairA] | changed[self.pairB])
+
+        # Only keep one copy of the pairs where both slots have changed.
+        src, dst = self._query(slots)
+        mask = ~changed[dst] | (src < dst)
+        src, dst = src[mask], dst[mask]
+        self.pairA = np.concatenate((self.pairA[keep], np.minimum(src, dst)))
+        self.pairB = np.concatenate((self.pairB[keep], np.maximum(src, dst)))
+
+    def collisionSets(self, bodies: dict, AABBs: dict):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        ret = self._sync(bodies, AABBs)
+        if not ret.ok:
+            return ret
+        aabbMin, aabbMax, active, static = self._worldState(bodies)
+        boxMin, boxMax, slotActive = self._slotBounds(aabbMin, aabbMax, active)
+
+        # Track every slot, and remove the leaves of all slots that are not
+        # active anymore (eg bodies that became static). Note: a slot that
+        # changed its body in the meantime keeps its leaf; its new box either
+        # fits into the old fat box or escapes it.
+        num_new = len(slotActive) - len(self.slotLeaf)
+        self.slotLeaf = np.concatenate(
+            (self.slotLeaf, np.full(num_new, -1, np.int64)))
+        self._detach(np.flatnonzero(~slotActive & (self.slotLeaf >= 0)))
+
+        # Find the boxes that escaped their fat box, and the new boxes.
+        in_tree = (self.slotLeaf >= 0)
+        leaves = self.slotLeaf[in_tree]
+        escaped = np.zeros(len(in_tree), bool)
+        below = np.any(boxMin[in_tree] < self.nodeMin[leaves], axis=1)
+        above = np.any(boxMax[in_tree] > self.nodeMax[leaves], axis=1)
+        escaped[in_tree] = below | above
+        escaped = np.flatnonzero(escaped)
+        added = np.flatnonzero(slotActive & ~in_tree)
+        changed = np.concatenate((escaped, added))
+
+        fatMin, fatMax = self._fatBoxes(boxMin[changed], boxMax[changed])
+        if self.rebuild or self._exceedsChangeLimit(len(changed)):
+            # Rebuild the tree and all candidate pairs from scratch.
+            slots = np.flatnonzero(slotActive)
+            fatMin, fatMax = self._fatBoxes(boxMin[slots], boxMax[slots])
+            self._build(slots, fatMin, fatMax)
+            self.pairA = self.pairB = np.zeros(0, np.int64)
+            self._updatePairs(slots)
+        elif len(changed) > 0:
+            # Refit the escaped leaves, and then insert the new ones.
+            num = len(escaped)
+            leaves = self.slotLeaf[escaped]
+            self.nodeMin[leaves] = fatMin[:num]
+            self.nodeMax[leaves] = fatMax[:num]
+            self._refit(leaves)
+            for slot, bmin, bmax in zip(added, fatMin[num:], fatMax[num:]):
+                self._insertLeaf(slot, bmin, bmax)
+            self.numChanges += len(changed)
+            self._updatePairs(changed)
+
+        # Test the actual boxes of all candidate pairs for overlap.
+        src, dst = self.pairA, self.pairB
+        for dim in range(3):
+            below = boxMin[src, dim] <= boxMax[dst, dim]
+            mask = below & (boxMin[dst, dim] <= boxMax[src, dim])
+            src, dst = src[mask], dst[mask]
+
+        # Test the individual AABBs of the overlapping pairs, and connect the
+        # bodies of the overlapping ones. Note that body `k` in the table is
+        # the `k`-th active slot.
+        table = self._compileTable(aabbMin, aabbMax, active, static)
+        num_bodies = len(table.objIDs)
+        slot_idx = np.cumsum(slotActive) - 1
+        src, dst = slot_idx[src], slot_idx[dst]
+        mask = _refinePairs(src, dst, table.rowBody, table.aabbMin,
+                            table.aabbMax, boxMin[slotActive],
+                            boxMax[slotActive])
+        labels = _unionFind(num_bodies, src[mask], dst[mask])
+        return _finaliseCollisionSets(
+            table, labels, bodies, AABBs, self.staticIndex, self.aabbMode)
+
+
+class BroadphaseReuse(_BroadphaseRows):
+    """
+    Broadphase that reuses the collision sets from the previous step.
+
+    Every AABB has a *fat* copy that is enlarged by the distance its body
+    can travel in ``lookahead`` steps of length ``dt`` (plus ``minMargin``).
+    The collision sets are those of the fat AABBs. They therefore remain
+    valid as long as all AABBs stay inside their fat copies, and the class
+    returns them unchanged in that case.
+
+    Bodies with an AABB that escaped its fat copy, as well as new bodies,
+    receive new fat AABBs. The class then only merges them into the sets of
+    their new neighbours; all other sets stay as they are. This never splits
+    a set. The class therefore recomputes all sets from scratch once the
+    number of changed bodies since the last rebuild exceeds
+    ``rebuildFraction`` times the number of bodies, or the static bodies
+    changed.
+
+    Leonard must update ``dt`` before every step. The ``stats`` attribute
+    contains the kind of the last update ('reuse', 'partial' or 'full'), as
+    well as the number of reused and recomputed collision sets.
+
+    :param float dt: the step size in seconds.
+    :param float lookahead: number of steps a body with constant velocity
+                            stays inside its fat AABBs.
+    :param float minMargin: minimum enlargement of the fat AABBs.
+    :param float rebuildFraction: recompute all sets once this fraction of
+                                  bodies has changed.
+    """
+    def __init__(self, dt: float=0, lookahead: float=2, minMargin: float=0,
+                 rebuildFraction: float=0.25,
+                 aabbMode: str='conservative'):
+        self.dt = dt
+        self.lookahead = lookahead
+        self.minMargin = minMargin
+        self.rebuildFraction = rebuildFraction
+        super().__init__(aabbMode)
+
+    def reset(self):
+        """
+        See docu in ``_BroadphaseRows``.
+        """
+        super().reset()
+
+        # The fat copy of every row in the AABB table. Rows without one have
+        # an empty box.
+        self.fatMin = np.zeros((0, 3), np.float64)
+        self.fatMax = np.zeros((0, 3), np.float64)
+
+        # The collision set of every slot (-1 if the slot is in none), the
+        # number of sets, and the (set, static) pairs of all static bodies
+        # that touch a set.
+        self.slotLabel = np.zeros(0, np.int64)
+        self.numLabels = 0
+        self.setStatic = np.zeros((0, 2), np.int64)
+
+        # Tree with the fat boxes of all slots at the last rebuild. Slots
+        # that changed since then are not in the tree anymore.
+        self.tree = _bvhBuild(np.zeros((0, 3)), np.zeros((0, 3)))
+        self.nodeSlot = np.zeros(0, np.int64)
+        self.inTree = np.zeros(0, bool)
+
+        # Number of changed slots since the last rebuild, and whether all
+        # sets must be recomputed in the next step.
+        self.numChanges = 0
+        self.rebuild = True
+        self.hasStatics = False
+        self.stats = {'update': 'full', 'reused': 0, 'recomputed': 0}
+
+    def _applyPending(self):
+        """
+        See docu in ``_BroadphaseRows``.
 
-    # Iterate over all the sets that overlap in 'x' and 'y' dimension. For
-    # each, determine which also overlap in the 'z' dimension.
-    stage_2 = []
-    for subset in stage_1:
-        res = sweeping({k: sweep_data[k] for k in subset}, 'z')
-        stage_2.extend(res.data)
+        New rows have no fat copy yet. Compacting the table invalidates all
+        fat copies.
+        """
+        num_rows = len(self.rows) + len(self.pendingRows)
+        ret = super()._applyPending()
+        if not ret.ok:
+            return ret
+
+        num_new = len(self.rows) - len(self.fatMin)
+        if len(self.rows) != num_rows:
+            num_new = len(self.rows)
+            self.fatMin = self.fatMin[:0]
+            self.fatMax = self.fatMax[:0]
+            self.rebuild = True
+        self.fatMin = np.vstack((self.fatMin, np.full((num_new, 3), np.inf)))
+        self.fatMax = np.vstack((self.fatMax, np.full((num_new, 3), -np.inf)))
+        return ret
+
+    def _margins(self, bodies: dict, slots: np.ndarray,
+                 boxMin: np.ndarray, boxMax: np.ndarray):
+        """
+        Return the margin of the fat AABBs for all ``slots``.
 
-    # Add the ignored objects which, by definition, do not collide with
-    # anything. In other words, each ignored body creates a dedicated collision
-    # set with itself as the only member.
-    coll_sets = stage_2 + [[_] for _ in bodies_ignored]
+        The margin covers the translation of the body, as well as the
+        rotation of its AABBs (enclosed by ``boxMin``/``boxMax``) around the
+        body position.
+        """
+        slot_bodies = [bodies[self.slotIDs[_]] for _ in slots.tolist()]
+        pos = _stackVectors([_.position for _ in slot_bodies], 3)
+        vlin = _stackVectors([_.velocityLin for _ in slot_bodies], 3)
+        vrot = _stackVectors([_.velocityRot for _ in slot_bodies], 3)
+        radius = np.maximum(np.abs(boxMin - pos), np.abs(boxMax - pos))
+        spin = np.linalg.norm(vrot, axis=1) * np.linalg.norm(radius, axis=1)
+        speed = np.linalg.norm(vlin, axis=1) + spin
+        return self.minMargin + self.lookahead * self.dt * speed
+
+    def _query(self, slots: np.ndarray, boxMin: np.ndarray,
+               boxMax: np.ndarray, outside: np.ndarray):
+        """
+        Return all slots whose fat box overlaps with the fat box of ``slots``.
 
-    # Append every static body to every collision set. This may not be very
-    # efficient for large scale simulations but has a negligible penalty for
-    # smaller simulations. The main advantage is that Azrael can now support
-    # static bodies with infinite extent, most notably 'Plane' shapes without
-    # the extra logic that the sweeping algorithm would otherwise require to
-    # deal with such infinite objects.
-    for collset in coll_sets:
-        collset.extend(bodies_static)
+        Query the tree for the slots that have not changed since the last
+        rebuild, and compare with the ``outside`` slots directly.
 
-    return RetVal(True, None, coll_sets)
+        :return: (src, dst) slot pairs with overlapping fat boxes.
+        :rtype: (ndarray, ndarray)
+        """
+        if len(slots) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+        left, right, _, _, nodeMin, nodeMax, root = self.tree
+        query, dst = _bvhQuery(left, right, self.nodeSlot, nodeMin, nodeMax,
+                               root, boxMin[slots], boxMax[slots])
+        mask = self.inTree[dst]
+        src, dst = [slots[query[mask]]], [dst[mask]]
+
+        # Build a small tree for the slots outside the large one.
+        left, right, _, _, nodeMin, nodeMax, root = _bvhBuild(
+            boxMin[outside], boxMax[outside])
+        nodeSlot = np.full(len(left), -1, np.int64)
+        nodeSlot[:len(outside)] = outside
+        query, tmp = _bvhQuery(left, right, nodeSlot, nodeMin, nodeMax,
+                               root, boxMin[slots], boxMax[slots])
+        src.append(slots[query])
+        dst.append(tmp)
+        src, dst = np.concatenate(src), np.concatenate(dst)
+
+        # Every fat box overlaps with itself.
+        mask = (src != dst)
+        return src[mask], dst[mask]
+
+    def collisionSets(self, bodies: dict, AABBs: dict):
+        """
+        See docu in ``BroadphaseSweeping``.
+        """
+        ret = self._sync(bodies, AABBs)
+        if not ret.ok:
+            return ret
+        aabbMin, aabbMax, active, static = self._worldState(bodies)
+        boxMin, boxMax, slotActive = self._slotBounds(aabbMin, aabbMax, active)
+        table = self._compileTable(aabbMin, aabbMax, active, static)
+
+        # Update the spatial index for the static bodies. Any change to them
+        # invalidates all sets.
+        tree = self.staticIndex.tree
+        has_statics = (len(table.static) > 0)
+        if has_statics:
+            ret = _compileStatics(table.static, bodies, AABBs, self.aabbMode)
+            if not ret.ok:
+                return ret
+            self.staticIndex.update(ret.data)
+        if self.staticIndex.tree is not tree or has_statics != self.hasStatics:
+            self.hasStatics = has_statics
+            self.rebuild = True
+
+        # Track every slot, and release the slots that are not active
+        # anymore (eg removed bodies).
+        num_new = len(slotActive) - len(self.slotLabel)
+        self.slotLabel = np.concatenate(
+            (self.slotLabel, np.full(num_new, -1, np.int64)))
+        self.inTree = np.concatenate((self.inTree, np.zeros(num_new, bool)))
+        self.slotLabel[~slotActive] = -1
+
+        # Find the bodies with an AABB outside its fat copy, and the new
+        # ones. Recompute all sets if there are too many.
+        row_slot = np.maximum(self.rowBody, 0)
+        inside = np.all(aabbMin >= self.fatMin, axis=1)
+        inside &= np.all(aabbMax <= self.fatMax, axis=1)
+        escaped = active & ~inside
+        changed = np.zeros(len(slotActive), bool)
+        changed[row_slot[escaped]] = True
+        changed |= slotActive & (self.slotLabel < 0)
+        num_changed = np.count_nonzero(changed)
+        limit = max(32, self.rebuildFraction * np.count_nonzero(slotActive))
+        full = self.rebuild or (self.numChanges + num_changed > limit)
+        if full:
+            changed = slotActive.copy()
+            self.slotLabel[:] = -1
+            self.numLabels = 0
+            self.setStatic = self.setStatic[:0]
+        slots = np.flatnonzero(changed)
+
+        # Enlarge the AABBs of all changed bodies.
+        margin = np.zeros(len(slotActive), np.float64)
+        margin[slots] = self._margins(
+            bodies, slots, boxMin[slots], boxMax[slots])
+        rows = np.flatnonzero(active & changed[row_slot])
+        margin = margin[row_slot[rows], None]
+        self.fatMin[rows] = aabbMin[rows] - margin
+        self.fatMax[rows] = aabbMax[rows] + margin
+        fatMin, fatMax = self.fatMin[active], self.fatMax[active]
+        fatBoxMin, fatBoxMax = _bodyBounds(
+            self.rowBody[active], len(slotActive), fatMin, fatMax)
+
+        # Find the slots with fat boxes that overlap those of the changed
+        # slots.
+        if full:
+            left, right, parent, height, nodeMin, nodeMax, root = _bvhBuild(
+                fatBoxMin[slots], fatBoxMax[slots])
+            self.tree = (left, right, parent, height, nodeMin, nodeMax, root)
+            self.nodeSlot = np.full(len(left), -1, np.int64)
+            self.nodeSlot[:len(slots)] = slots
+            self.inTree[:] = False
+            self.inTree[slots] = True
+            self.numChanges = 0
+            self.rebuild = False
+            src, dst = self._query(
+                slots, fatBoxMin, fatBoxMax, np.zeros(0, np.int64))
+        else:
+            self.inTree &= slotActive & ~changed
+            outside = np.flatnonzero(slotActive & ~self.inTree)
+            src, dst = self._query(slots, fatBoxMin, fatBoxMax, outside)
+            self.numChanges += len(slots)
+
+        # Test the individual fat AABBs of the overlapping pairs. Note that
+        # body `k` in the table is the `k`-th active slot.
+        slot_idx = np.cumsum(slotActive) - 1
+        mask = _refinePairs(slot_idx[src], slot_idx[dst], table.rowBody,
+                            fatMin, fatMax, fatBoxMin[slotActive],
+                            fatBoxMax[slotActive])
+        src, dst = src[mask], dst[mask]
+
+        # Give every changed slot its own set, and then merge the sets that
+        # the pairs connect. Finally, number the sets consecutively.
+        num_labels = self.numLabels + len(slots)
+        self.slotLabel[slots] = np.arange(self.numLabels, num_labels)
+        comp = _unionFind(num_labels, self.slotLabel[src],
+                          self.slotLabel[dst])
+        active_slots = np.flatnonzero(slotActive)
+        root, labels = np.unique(
+            comp[self.slotLabel[active_slots]], return_inverse=True)
+        relabel = np.full(num_labels, -1, np.int64)
+        relabel[root] = np.arange(len(root))
+        self.slotLabel[active_slots] = labels.ravel()
+        self.numLabels = len(root)
+
+        # Carry over the static bodies of the old sets, and add those that
+        # touch the changed AABBs.
+        static_set = relabel[comp[self.setStatic[:, 0]]]
+        pairs = [np.column_stack((static_set, self.setStatic[:, 1]))]
+        pairs[0] = pairs[0][static_set >= 0]
+        if has_statics:
+            hit, statics = self.staticIndex.contacts(
+                self.fatMin[rows], self.fatMax[rows])
+            hit_set = self.slotLabel[self.rowBody[rows[hit]]]
+            pairs.append(np.column_stack((hit_set, statics)))
+        self.setStatic = np.unique(np.concatenate(pairs), axis=0)
+
+        # Update the statistics. A set is reused if it contains no changed
+        # slot.
+        num_recomputed = len(np.unique(self.slotLabel[slots]))
+        self.stats = {
+            'update': 'full' if full else ('partial' if num_changed else
+                                           'reuse'),
+            'reused': self.numLabels - num_recomputed,
+            'recomputed': num_recomputed,
+        }
+
+        # Compile the collision sets. Every ignored body has its own set.
+        coll_sets = _labelsToSets(table.objIDs, self.slotLabel[active_slots])
+        if has_statics:
+            static_IDs = self.staticIndex.statics.objIDs
+            for (idx_set, idx_static) in self.setStatic.tolist():
+                coll_sets[idx_set].append(static_IDs[idx_static])
+        coll_sets += [[_] for _ in table.ignored]
+        return RetVal(True, None, coll_sets)
+
+
+# All available broadphase engines.
+broadphaseEngines = {
+    'sweeping': BroadphaseSweeping,
+    'incremental': BroadphaseIncremental,
+    'grid': BroadphaseGrid,
+    'bvh': BroadphaseBVH,
+    'reuse': BroadphaseReuse,
+}
 
 
 def mergeConstraintSets(constraintPairs: tuple,
@@ -294,30 +2280,85 @@ def mergeConstraintSets(constraintPairs: tuple,
     connected via a constraint. Typically, this function takes the output of
     ``computeCollisionSets`` as the ``collSets`` argument.
 
+    The function processes the constraints in order, as if every constraint
+    removed the set(s) that contain its bodies from ``collSets`` and then
+    appended their union (possibly empty). The sets that no constraint
+    touches therefore retain their order (and type) at the front of the
+    list, followed by the merged sets in the order of their last merge.
+
+    Internally, this uses a disjoint-set forest with path compression over
+    the sets, and a {objID: set index} map for the constrained bodies. The
+    runtime is thus near linear in the number of bodies and constraints.
+
+    ..note:: the function modifies ``collSets`` in place and returns it.
+
     :param list[vec2] constraintPairs: eg [(1, 2), (1, 5), ...].
     :param list[set] collSets: list of collision sets
     :return: the new list of collision sets.
     :rtype: list[set]
     """
-    # Merge the collision sets that are linked via constraints.
-    for (a, b) in constraintPairs:
-        # Find (and remove) the set(s) that contain object_a or object_b (or
-        # both).
-        s_a = [collSets.pop(ii) for ii, v in enumerate(collSets) if a in v]
-        s_b = [collSets.pop(ii) for ii, v in enumerate(collSets) if b in v]
-
-        # Sanity check: each element can be in at most one set.
-        assert 0 <= len(s_a) < 2
-        assert 0 <= len(s_b) < 2
-
-        # Unpack the list returned by the list comprehension (it contains zero
-        # or one element).
-        s_a = s_a[0] if len(s_a) == 1 else []
-        s_b = s_b[0] if len(s_b) == 1 else []
-
-        # Merge the collision sets.
-        new_set = set(s_a).union(s_b)
-        collSets.append(new_set)
+    if len(constraintPairs) == 0:
+        return RetVal(True, None, collSets)
+
+    # Determine the set index of every constrained body. Each body can be in
+    # at most one set.
+    constrained = {_ for pair in constraintPairs for _ in pair}
+    owner = {}
+    for idx, cset in enumerate(collSets):
+        for objID in constrained.intersection(cset):
+            assert objID not in owner
+            owner[objID] = idx
+
+    # Disjoint-set forest over the collision sets.
+    parent = list(range(len(collSets)))
+
+    def _find(idx):
+        root = idx
+        while parent[root] != root:
+            root = parent[root]
+
+        # Path compression.
+        while parent[idx] != root:
+            parent[idx], idx = root, parent[idx]
+        return root
+
+    # Merge the sets of every constraint and record when each set was last
+    # involved in a merge. A constraint between two bodies that are in none
+    # of the sets produces an empty set.
+    lastMerge, empty = {}, []
+    for step, (a, b) in enumerate(constraintPairs):
+        root_a = _find(owner[a]) if a in owner else None
+        root_b = _find(owner[b]) if b in owner else None
+        if root_a is None and root_b is None:
+            empty.append(step)
+            continue
+        if root_a is None:
+            root_a = root_b
+        elif root_b is not None and root_a != root_b:
+            # Attach the smaller root to the larger one.
+            if root_a < root_b:
+                root_a, root_b = root_b, root_a
+            parent[root_b] = root_a
+            lastMerge.pop(root_b, None)
+        lastMerge[root_a] = step
+
+    # Collect the members of every merged set.
+    merged = {root: set() for root in lastMerge}
+    untouched = []
+    for idx, cset in enumerate(collSets):
+        root = _find(idx)
+        if root in merged:
+            merged[root].update(cset)
+        else:
+            untouched.append(cset)
+
+    # Sort the merged (and empty) sets by the time of their last merge.
+    tail = [(step, merged[root]) for root, step in lastMerge.items()]
+    tail += [(step, set()) for step in empty]
+    tail.sort(key=lambda _: _[0])
+
+    # Update the list in place.
+    collSets[:] = untouched + [_[1] for _ in tail]
     return RetVal(True, None, collSets)
 
 
@@ -350,9 +2391,94 @@ def _skipEmptyBodies(bodies):
     return bak_bodies
 
 
+def collisionSetStats(collSets: (tuple, list)):
+    """
+    Return size statistics for the ``collSets``.
+
+    The returned dictionary contains the number of sets ('num'), the total
+    number of bodies in all sets ('bodies'), as well as the 'mean', 'p95'
+    and 'max' set size. All values are zero if there are no sets.
+
+    :param list[set] collSets: list of collision sets.
+    :return: dict with the statistics.
+    """
+    sizes = np.array([len(_) for _ in collSets], np.int64)
+    if len(sizes) == 0:
+        return {'num': 0, 'bodies': 0, 'mean': 0, 'p95': 0, 'max': 0}
+    return {
+        'num': len(sizes),
+        'bodies': int(sizes.sum()),
+        'mean': float(sizes.mean()),
+        'p95': float(np.percentile(sizes, 95)),
+        'max': int(sizes.max()),
+    }
+
+
+def _packLPT(costs: np.ndarray, numBins: int, preferred: list=None,
+             limit: float=0):
+    """
+    Return the bins and maximum bin cost for ``packCosts``.
+    """
+    # The heap contains one valid (load, bin) entry for every bin. Entries
+    # whose load is outdated are skipped.
+    loads = [0.0] * numBins
+    heap = [(0.0, _) for _ in range(numBins)]
+    bins = [[] for _ in range(numBins)]
+    for idx in np.argsort(-costs, kind='stable').tolist():
+        cost = costs[idx]
+        dst = -1 if preferred is None else preferred[idx]
+        if not (0 <= dst < numBins and loads[dst] + cost <= limit):
+            while True:
+                load, dst = heapq.heappop(heap)
+                if load == loads[dst]:
+                    break
+        loads[dst] += cost
+        heapq.heappush(heap, (loads[dst], dst))
+        bins[dst].append(idx)
+    return bins, max(loads)
+
+
+@typecheck
+def packCosts(costs: (tuple, list, np.ndarray), numBins: int,
+              preferred: (tuple, list, np.ndarray)=None, slack: float=0.1):
+    """
+    Pack items with ``costs`` into ``numBins`` bins with balanced total cost.
+
+    This is the greedy "longest processing time first" heuristic: every item
+    goes into the bin with the lowest total cost so far, starting with the
+    most expensive item. Items with a ``preferred`` bin (-1 for none) go
+    into that bin instead, unless this would push its total cost beyond the
+    maximum bin cost without preferences (or beyond the average cost per
+    bin plus ``slack``, whichever is larger). This keeps the bins stable
+    from one step to the next.
+
+    An item is never split. A single expensive item may thus exceed the
+    average cost per bin.
+
+    :param list costs: cost of every item.
+    :param int numBins: maximum number of bins.
+    :param list preferred: the preferred bin of every item.
+    :param float slack: relative tolerance for the preferred bins.
+    :return: the item indices in every bin (some may be empty).
+    :rtype: list[list[int]]
+    """
+    costs = np.asarray(costs, np.float64)
+    if len(costs) == 0:
+        return []
+    numBins = max(1, min(numBins, len(costs)))
+
+    bins, limit = _packLPT(costs, numBins)
+    if preferred is None or max(preferred) < 0:
+        return bins
+    limit = max(limit, (1 + slack) * costs.sum() / numBins)
+    preferred = np.asarray(preferred, np.int64).tolist()
+    return _packLPT(costs, numBins, preferred, limit)[0]
+
+
 def getFinalCollisionSets(constraintPairs: list,
                           allBodies: dict,
-                          allAABBs: dict):
+                          allAABBs: dict,
+                          broadphase=None):
     """
     Return the collision sets.
 
@@ -365,23 +2491,25 @@ def getFinalCollisionSets(constraintPairs: list,
     :param list constraintPairs: list of 2-tuples eg [(1, 2), (1, 5), ...].
     :param dict allBodies: Leonard's object cache.
     :param dict allAABBs: Leonard's AABB cache.
+    :param broadphase: broadphase engine (defaults to ``BroadphaseSweeping``).
     :return: list of non-overlapping collision sets.
     """
     allBodies = _skipEmptyBodies(allBodies)
+    if broadphase is None:
+        broadphase = BroadphaseSweeping()
 
     # Broadphase based on AABB only.
-    ret = computeCollisionSetsAABB(allBodies, allAABBs)
+    ret = broadphase.collisionSets(allBodies, allAABBs)
     if not ret.ok:
         msg = 'ComputeCollisionSetsAABB returned an error: {}'
         logit.error(msg.format(ret.msg))
         return RetVal(False, msg, None)
 
-    # Sanity checks: constraints must not be attached to static objects. This
-    # is currently a shortcoming due to the broadphase implementation where all
-    # static bodies are added to every collision set. Therefore, if only a
-    # single constraint connects to a static body the 'mergeConstraintSets'
-    # function will automatically merge *all* collision sets. This is currently
-    # a known (but acceptable) shortcoming of the current broadphase algorithm.
+    # Sanity checks: constraints must not be attached to static objects. The
+    # broadphase adds a static body to every collision set it touches.
+    # Therefore, a single constraint to a static body would make
+    # 'mergeConstraintSets' merge *all* collision sets that touch it. This is
+    # currently a known (but acceptable) shortcoming.
     for (a, b) in constraintPairs:
         if (allBodies[a].imass == 0) or (allBodies[b].imass == 0):
             msg = 'Constraint attached to rigid body {}-{}'.format(a, b)
@@ -398,6 +2526,505 @@ def getFinalCollisionSets(constraintPairs: list,
     return ret
 
 
+def _quatMultiply(a: np.ndarray, b: np.ndarray):
+    """
+    Return the (Hamilton) products of the Quaternions in ``a`` and ``b``.
+
+    :param ndarray a: Nx4 array of (x, y, z, w) Quaternions.
+    :param ndarray b: Nx4 array of (x, y, z, w) Quaternions.
+    :return: Nx4 array of (x, y, z, w) Quaternions.
+    :rtype: ndarray
+    """
+    out = np.empty_like(b)
+    out[:, :3] = a[:, 3:] * b[:, :3] + b[:, 3:] * a[:, :3]
+    out[:, :3] += np.cross(a[:, :3], b[:, :3])
+    out[:, 3] = a[:, 3] * b[:, 3] - np.einsum('ni,ni->n', a[:, :3], b[:, :3])
+    return out
+
+
+def _quatRotate(quats: np.ndarray, omega: np.ndarray, h: float):
+    """
+    Return ``quats`` after rotating them with ``omega`` for ``h`` seconds.
+
+    The angular velocities ``omega`` are in world coordinates. The rotation
+    is exact for constant angular velocities.
+
+    :param ndarray quats: Nx4 array of (x, y, z, w) Quaternions.
+    :param ndarray omega: Nx3 array of angular velocities.
+    :param float h: time step.
+    :return: Nx4 array of (normalised) Quaternions.
+    :rtype: ndarray
+    """
+    speed = np.sqrt(np.einsum('ni,ni->n', omega, omega))
+    angle = 0.5 * h * speed
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(speed > 0, np.sin(angle) / speed, 0)
+    delta = np.column_stack((scale[:, None] * omega, np.cos(angle)))
+    out = _quatMultiply(delta, quats)
+    return out / np.sqrt(np.einsum('ni,ni->n', out, out))[:, None]
+
+
+def _quatDerivative(quats: np.ndarray, omega: np.ndarray):
+    """
+    Return the time derivative of ``quats`` for angular velocities ``omega``.
+
+    :param ndarray quats: Nx4 array of (x, y, z, w) Quaternions.
+    :param ndarray omega: Nx3 array of angular velocities (world coordinates).
+    :return: Nx4 array.
+    :rtype: ndarray
+    """
+    omega = np.column_stack((omega, np.zeros(len(omega))))
+    return 0.5 * _quatMultiply(omega, quats)
+
+
+class _FreeBodies:
+    """
+    Equations of motion for bodies that neither collide nor have constraints.
+
+    The state of every body comprises its centre of mass ``c``, rotation
+    ``q``, and linear- and angular velocity ``v`` and ``w`` (all in world
+    coordinates). The forces and torques are constant for the entire step.
+    Like Bullet, the inertia is diagonal with respect to the principal axes
+    (ie ``rotation * paxis``), and the linear- and angular factors scale the
+    forces and torques.
+
+    The angular acceleration of bodies with isotropic inertia (eg spheres
+    and cubes) is constant, and so it is for bodies that neither spin nor
+    experience a torque. Only the remaining bodies need the full Euler
+    equations in every step.
+
+    :param BodyStore store: the bodies.
+    :param ndarray slots: the slots of the bodies in ``store``.
+    :param ndarray force: Nx3 array of forces (world coordinates).
+    :param ndarray torque: Nx3 array of torques (world coordinates).
+    """
+    def __init__(self, store, slots: np.ndarray,
+                 force: np.ndarray, torque: np.ndarray):
+        rotFactor, inertia = store.rotFactor[slots], store.inertia[slots]
+        with np.errstate(divide='ignore'):
+            invInertia = np.where(inertia > 0, 1 / inertia, 0)
+
+        # Linear acceleration of all bodies.
+        self.accel = store.imass[slots, None] * store.linFactor[slots] * force
+
+        # Constant angular acceleration of the bodies with isotropic inertia.
+        isotropic = inertia.min(axis=1) == inertia.max(axis=1)
+        self.alpha = np.zeros_like(torque)
+        self.alpha[isotropic] = (rotFactor * invInertia * torque)[isotropic]
+
+        # The remaining bodies whose angular acceleration changes over time.
+        spin = np.any(store.velocityRot[slots] != 0, axis=1)
+        spin |= np.any(torque != 0, axis=1)
+        self.rows = np.flatnonzero(~isotropic & spin)
+        rows = self.rows
+        self.torque, self.rotFactor = torque[rows], rotFactor[rows]
+        self.inertia, self.invInertia = inertia[rows], invInertia[rows]
+        self.paxis = _quatToMatrix(store.paxis[slots[rows]])
+
+    def acceleration(self, q: np.ndarray, w: np.ndarray):
+        """
+        Return the linear- and angular acceleration of all bodies.
+
+        The angular acceleration follows from Euler's equations, ie it
+        includes the gyroscopic term.
+
+        :param ndarray q: Nx4 array of rotations.
+        :param ndarray w: Nx3 array of angular velocities.
+        :return: (linear, angular) acceleration as Nx3 arrays.
+        :rtype: (ndarray, ndarray)
+        """
+        if len(self.rows) == 0:
+            return self.accel, self.alpha
+        rows = self.rows
+
+        # Rotate the angular velocity and torque into the principal frame.
+        basis = np.matmul(_quatToMatrix(q[rows]), self.paxis)
+        w_p = np.einsum('nji,nj->ni', basis, w[rows])
+        torque_p = np.einsum('nji,nj->ni', basis, self.torque)
+
+        # Solve Euler's equations and rotate the result back.
+        gyro = np.cross(w_p, self.inertia * w_p)
+        alpha_p = self.invInertia * (torque_p - gyro)
+        alpha = self.alpha.copy()
+        alpha[rows] = self.rotFactor * np.einsum('nij,nj->ni', basis, alpha_p)
+        return self.accel, alpha
+
+
+def _stepEuler(eom: _FreeBodies, c, q, v, w, h: float):
+    """
+    Semi-implicit (symplectic) Euler step of size ``h``.
+
+    This is the same scheme Bullet uses.
+    """
+    a, alpha = eom.acceleration(q, w)
+    v, w = v + h * a, w + h * alpha
+    return c + h * v, _quatRotate(q, w, h), v, w
+
+
+def _stepVerlet(eom: _FreeBodies, c, q, v, w, h: float):
+    """
+    Velocity Verlet step of size ``h``.
+    """
+    a, alpha = eom.acceleration(q, w)
+    v, w = v + 0.5 * h * a, w + 0.5 * h * alpha
+    c, q = c + h * v, _quatRotate(q, w, h)
+    a, alpha = eom.acceleration(q, w)
+    return c, q, v + 0.5 * h * a, w + 0.5 * h * alpha
+
+
+def _stepRK4(eom: _FreeBodies, c, q, v, w, h: float):
+    """
+    Classic fourth order Runge-Kutta step of size ``h``.
+
+    The Quaternions are integrated like every other state variable and
+    normalised afterwards.
+    """
+    def _deriv(q, v, w):
+        a, alpha = eom.acceleration(q, w)
+        return v, _quatDerivative(q, w), a, alpha
+
+    state = (c, q, v, w)
+    k1 = _deriv(q, v, w)
+    k2 = _deriv(*[s + 0.5 * h * k for s, k in zip(state, k1)][1:])
+    k3 = _deriv(*[s + 0.5 * h * k for s, k in zip(state, k2)][1:])
+    k4 = _deriv(*[s + h * k for s, k in zip(state, k3)][1:])
+    c, q, v, w = [s + h / 6 * (d1 + 2 * d2 + 2 * d3 + d4)
+                  for s, d1, d2, d3, d4 in zip(state, k1, k2, k3, k4)]
+    return c, q / np.sqrt(np.einsum('ni,ni->n', q, q))[:, None], v, w
+
+
+# All integrators for ``integrateBodies``.
+integrators = {
+    'euler': _stepEuler,
+    'verlet': _stepVerlet,
+    'rk4': _stepRK4,
+}
+
+# Bullet integrates with this fixed step size and damps the linear- and
+# angular velocity of every body (see ``bullet_api.setRigidBodyData``).
+_FIXED_STEP = 1 / 60
+_DAMPING = 0.02
+
+
+@typecheck
+def integrateBodies(store, slots: np.ndarray, force: np.ndarray,
+                    torque: np.ndarray, dt: (int, float), maxsteps: int,
+                    method: str='euler'):
+    """
+    Advance the bodies in ``slots`` by ``dt`` without Bullet.
+
+    This is only valid for bodies that cannot collide with anything and have
+    no constraints, eg bodies in their own collision set. The function
+    integrates all of them at once in ``store``.
+
+    Like Bullet, the function sub-divides ``dt`` into steps of (at most)
+    1/60s, but never uses more than ``maxsteps`` of them. Unlike Bullet, it
+    always advances the bodies by the full ``dt``. Static bodies (ie bodies
+    without mass or inertia) do not move.
+
+    :param BodyStore store: the bodies.
+    :param ndarray slots: the slots of the bodies in ``store``.
+    :param ndarray force: Nx3 array of forces (world coordinates).
+    :param ndarray torque: Nx3 array of torques (world coordinates).
+    :param float dt: time step in seconds.
+    :param int maxsteps: maximum number of sub-steps.
+    :param str method: name of integrator (see ``integrators``).
+    :return: number of integrated bodies.
+    :rtype: int
+    """
+    if method not in integrators:
+        return RetVal(False, 'Unknown integrator <{}>'.format(method), None)
+    step = integrators[method]
+
+    # Bullet treats bodies with (almost) no mass or inertia as static.
+    dynamic = store.imass[slots] >= 1E-4
+    dynamic &= store.inertia[slots].sum(axis=1) >= 1E-4
+    slots, force, torque = slots[dynamic], force[dynamic], torque[dynamic]
+    if len(slots) == 0 or dt <= 0:
+        return RetVal(True, None, 0)
+
+    # Integrate the centre of mass instead of the body position.
+    com = store.com[slots]
+    q = store.rotation[slots]
+    c = store.position[slots] + np.einsum('nij,nj->ni', _quatToMatrix(q), com)
+    v, w = store.velocityLin[slots], store.velocityRot[slots]
+
+    # Advance the bodies in equally sized sub-steps.
+    numSteps = max(1, min(maxsteps, int(np.ceil(dt / _FIXED_STEP - 1E-9))))
+    h = dt / numSteps
+    damping = (1 - _DAMPING) ** h
+    eom = _FreeBodies(store, slots, force, torque)
+    for ii in range(numSteps):
+        c, q, v, w = step(eom, c, q, v, w, h)
+        v, w = damping * v, damping * w
+
+    # Write the new state variables back to the store.
+    store.position[slots] = c - np.einsum('nij,nj->ni', _quatToMatrix(q), com)
+    store.rotation[slots] = q
+    store.velocityLin[slots] = v
+    store.velocityRot[slots] = w
+    return RetVal(True, None, len(slots))
+
+
+class StepScheduler:
+    """
+    Decide when Leonard advances the simulation, and by how much.
+
+    Every tick advances the simulation by ``stepinterval`` seconds with at
+    most ``maxsteps`` sub-steps. Bullet sub-divides the ticks into steps of
+    1/60s and drops the simulated time that does not fit into the sub-steps.
+    A tick with fewer sub-steps than that therefore only advances the
+    simulation by the time they cover, ie the simulation runs slower than
+    the wall clock.
+
+    The ``mode`` determines how the ticks relate to the wall clock:
+
+    * 'realtime': start a tick every ``stepinterval`` seconds. Ticks that
+      take longer than that are overruns, and the next tick starts late. If
+      the schedule falls behind by more than one interval then the scheduler
+      gives up on catching up and restarts the schedule from the current
+      time.
+    * 'adaptive': like 'realtime' but halve the number of sub-steps (of
+      1/60s) after every overrun, which shortens the next tick accordingly.
+      Once ticks finish within half their budget again the scheduler
+      restores the sub-steps, one per tick, up to ``maxsteps``.
+    * 'batch': never wait, ie step as fast as possible. This is for offline
+      simulations (eg training or Monte Carlo runs) where the simulated time
+      need not track the wall clock.
+
+    Call ``wait`` before and ``done`` after every tick. The ``stats``
+    dictionary contains the tick statistics:
+
+    * ticks: number of completed ticks,
+    * simTime: simulated time in seconds (the sum of all tick ``dt``),
+    * duration: wall clock time of the last tick in seconds,
+    * speedup: simulated time per wall clock time of the last tick,
+    * substeps: maximum number of sub-steps of the last tick,
+    * overruns: number of ticks that took longer than ``stepinterval``,
+    * lag: how late the last tick started in seconds,
+    * jitter: moving average of the absolute start time error.
+
+    The scheduler also logs the statistics after every tick.
+
+    :param str mode: 'realtime', 'adaptive' or 'batch'.
+    :param float stepinterval: simulated time per tick in seconds.
+    :param int maxsteps: maximum number of sub-steps per tick.
+    :param int numTicks: stop after this many ticks (None means never).
+    """
+    modes = ('realtime', 'adaptive', 'batch')
+
+    def __init__(self, mode: str='realtime', stepinterval: float=0.05,
+                 maxsteps: int=10, numTicks: int=None):
+        assert mode in self.modes
+        assert stepinterval > 0 and maxsteps > 0
+        self.mode = mode
+        self.stepinterval = stepinterval
+        self.maxsteps = maxsteps
+        self.numTicks = numTicks
+
+        # The start time of the next tick and the current one.
+        self.deadline = None
+        self.tickStart = None
+
+        # Number of sub-steps for the next tick, and how many of them a tick
+        # needs to cover the full ``stepinterval``.
+        self.substeps = maxsteps
+        self.needed = int(np.ceil(stepinterval / _FIXED_STEP - 1E-9))
+
+        self.stats = {
+            'ticks': 0, 'simTime': 0, 'duration': 0, 'speedup': 0,
+            'substeps': maxsteps, 'overruns': 0, 'lag': 0, 'jitter': 0,
+        }
+
+    def wait(self):
+        """
+        Wait until the next tick is due and return its parameters.
+
+        The ``dt`` is less than ``stepinterval`` if there are not enough
+        sub-steps to cover it (see ``needed``).
+
+        :return: (dt, maxsteps), or None if all ``numTicks`` are done.
+        :rtype: tuple
+        """
+        if self.numTicks is not None and self.stats['ticks'] >= self.numTicks:
+            return None
+
+        # Sleep until the next tick is due (unless in batch mode).
+        if self.mode != 'batch':
+            if self.deadline is None:
+                self.deadline = time.time()
+            delay = self.deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        # Record how late this tick starts.
+        self.tickStart = time.time()
+        if self.mode != 'batch':
+            lag = self.tickStart - self.deadline
+            self.stats['lag'] = max(0, lag)
+            self.stats['jitter'] = 0.9 * self.stats['jitter'] + 0.1 * abs(lag)
+
+            # Restart the schedule if we are behind by more than one tick.
+            if lag > self.stepinterval:
+                self.deadline = self.tickStart
+        return self.tickDuration(), self.substeps
+
+    def tickDuration(self):
+        """
+        Return the simulated time of the next tick.
+
+        :return: simulated time in seconds.
+        :rtype: float
+        """
+        if self.substeps >= self.needed:
+            return self.stepinterval
+        return self.substeps * _FIXED_STEP
+
+    def done(self):
+        """
+        Update the statistics at the end of a tick.
+        """
+        duration = time.time() - self.tickStart
+        dt = self.tickDuration()
+        stats = self.stats
+        stats['ticks'] += 1
+        stats['simTime'] += dt
+        stats['duration'] = duration
+        stats['speedup'] = dt / max(duration, 1E-9)
+        stats['substeps'] = self.substeps
+
+        if self.mode != 'batch':
+            self.deadline += self.stepinterval
+            overrun = duration > self.stepinterval
+            stats['overruns'] += int(overrun)
+
+            # Slow down the simulation if the ticks take too long. Sub-steps
+            # beyond the ``needed`` ones do not cost any time.
+            if self.mode == 'adaptive':
+                if overrun:
+                    substeps = min(self.substeps, self.needed)
+                    self.substeps = max(1, substeps // 2)
+                elif duration < 0.5 * self.stepinterval:
+                    self.substeps = min(self.maxsteps, self.substeps + 1)
+
+        util.logMetricQty('#TickOverruns', stats['overruns'])
+        util.logMetricQty('#TickSubsteps', stats['substeps'])
+        util.logMetricQty('TickLag_ms', int(1000 * stats['lag']))
+        util.logMetricQty('TickJitter_ms', int(1000 * stats['jitter']))
+
+
+class DatastoreWriter(threading.Thread):
+    """
+    Apply datastore modifications in the background.
+
+    ``submit`` queues a batch of modifications (see
+    ``DatastoreBase.modify``) and returns immediately. The thread applies the
+    batches in order, each with a single ``modifyBulk`` call. The queue holds
+    at most ``maxsize`` batches and ``submit`` drops new batches while it is
+    full. It is up to the caller to re-submit those modifications later.
+
+    A batch that could not be written (``modifyBulk`` failed or raised an
+    exception) does not stop the thread. Instead, ``popFailed`` returns the
+    IDs of its documents so that the caller can re-submit them as well.
+
+    The ``stats`` attribute counts the written, failed and dropped documents,
+    and contains the lag (in seconds) between submitting and writing the last
+    batch.
+
+    :param str dbName: name of datastore (see ``datastore.getDSHandle``).
+    :param int maxsize: maximum number of pending batches.
+    """
+    def __init__(self, dbName: str='ObjInstances', maxsize: int=2):
+        super().__init__(daemon=True)
+
+        # Create a Class-specific logger.
+        name = '.'.join([__name__, self.__class__.__name__])
+        self.logit = logging.getLogger(name)
+
+        self.dbName = dbName
+        self.queue = queue.Queue(maxsize)
+        self.stats = {'written': 0, 'failed': 0, 'dropped': 0, 'lag': 0}
+
+        # IDs of the documents whose modifications could not be written.
+        self._failed = set()
+        self._lock = threading.Lock()
+
+        # The thread terminates once this flag is True. The timeout
+        # specifies how often the thread checks it.
+        self._terminate = False
+        self._timeout = 0.2
+
+    def submit(self, ops: dict):
+        """
+        Queue the modifications ``ops`` unless the queue is full.
+
+        :param dict ops: document specific modifications.
+        :return: True if the modifications were queued.
+        :rtype: bool
+        """
+        try:
+            self.queue.put_nowait((time.time(), ops))
+        except queue.Full:
+            self.stats['dropped'] += len(ops)
+            return False
+        return True
+
+    def popFailed(self):
+        """
+        Return the IDs of all documents that could not be written.
+
+        Every ID is only returned once.
+
+        :return: document IDs.
+        :rtype: set
+        """
+        with self._lock:
+            failed, self._failed = self._failed, set()
+        return failed
+
+    def flush(self):
+        """
+        Block until all queued modifications were processed.
+        """
+        self.queue.join()
+
+    def stop(self):
+        """
+        Terminate the thread once it wrote all queued modifications.
+
+        Call ``join`` afterwards to wait for it.
+        """
+        self._terminate = True
+
+    def run(self):
+        db = azrael.datastore.getDSHandle(self.dbName)
+        while not (self._terminate and self.queue.empty()):
+            try:
+                t0, ops = self.queue.get(timeout=self._timeout)
+            except queue.Empty:
+                continue
+
+            # Never let an error terminate the thread, or else ``flush``
+            # would block forever.
+            try:
+                ret = db.modifyBulk(ops)
+            except Exception:
+                self.logit.exception('Could not write the modifications')
+                ret = RetVal(False, None, None)
+            else:
+                if not ret.ok:
+                    self.logit.warning(ret.msg)
+
+            if ret.ok:
+                self.stats['written'] += len(ops)
+                self.stats['lag'] = time.time() - t0
+            else:
+                self.stats['failed'] += len(ops)
+                with self._lock:
+                    self._failed.update(ops)
+            self.queue.task_done()
+
+
 class LeonardBase(config.AzraelProcess):
     """
     Base class for Physics manager.
@@ -405,16 +3032,76 @@ class LeonardBase(config.AzraelProcess):
     No physics is actually computed here. The class serves mostly as an
     interface for the actual Leonard implementations, as well as a test
     framework.
+
+    :param str broadphase: name of broadphase engine (see
+                           ``broadphaseEngines``).
+    :param str aabbMode: 'tight' computes the AABBs from the collision shapes
+                         and current rotation of each body; 'conservative'
+                         uses the (rotation invariant) AABBs as they are.
+    :param str integrator: name of the integrator for the bodies that do not
+                           need Bullet (see ``integrators``).
+    :param float syncThreshold: only sync bodies to the datastore once their
+                                motion state changed by more than this.
+    :param StepScheduler scheduler: decides when ``run`` steps the
+                                    simulation (defaults to real time).
+    :param tuple sleepVelocity: linear- and angular speed below which a body
+                                counts as resting.
+    :param float sleepTime: collision sets whose bodies rested for this many
+                            seconds fall asleep (*None* disables sleeping).
+    :param int cmdPort: port of the command channel (defaults to the
+                        'leonard_cmd' service in ``config``).
     """
-    def __init__(self):
+    def __init__(self, broadphase: str='reuse', aabbMode: str='tight',
+                 integrator: str='euler', syncThreshold: float=1E-6,
+                 scheduler: StepScheduler=None,
+                 sleepVelocity: (tuple, list)=(1E-2, 1E-2),
+                 sleepTime: (int, float)=2, cmdPort: int=None):
         super().__init__()
 
+        # Default to 20 real time ticks per second.
+        if scheduler is None:
+            scheduler = StepScheduler('realtime', 0.05, 10)
+        self.scheduler = scheduler
+
+        # Only ``run`` writes the bodies in the background (see
+        # ``syncObjects``).
+        self.syncThreshold = syncThreshold
+        self.writer = None
+
+        # Apply at most this many commands from the command channel per
+        # step, and poll the datastore for the other commands at this
+        # interval (in seconds).
+        self.cmdBatch = 10000
+        self.cmdPollInterval = 1
+        self.lastCmdPoll = 0
+
+        # Leonard binds the command channel to this port (see ``run``).
+        if cmdPort is None:
+            cmdPort = config.azService['leonard_cmd'].port
+        self.cmdPort = cmdPort
+
+        # Resume reading the commands at the read position in the datastore.
+        leoAPI.resetCommandReader()
+
+        # Thresholds for sleeping collision sets (see ``removeSleepingSets``).
+        self.sleepVelocity = tuple(sleepVelocity)
+        self.sleepTime = sleepTime
+
+        # Name of the integrator for isolated bodies.
+        assert integrator in integrators
+        self.integrator = integrator
+
         # Create an Igor instance.
         self.igor = azrael.igor.Igor()
 
-        self.allBodies = {}
-        self.allAABBs = {}
-        self.allForces = {}
+        # Instantiate the broadphase engine.
+        self.broadphase = broadphaseEngines[broadphase](aabbMode=aabbMode)
+
+        # Local cache of all bodies, and dictionary views of their AABBs and
+        # forces.
+        self.allBodies = azrael.bodystore.BodyStore()
+        self.allAABBs = self.allBodies.aabbs
+        self.allForces = self.allBodies.forces
         self.events = azrael.eventstore.EventStore(topics=['phys'])
 
     def setup(self):
@@ -431,9 +3118,13 @@ class LeonardBase(config.AzraelProcess):
         """
         Stub for shutdown code that cannot go into the destructor.
 
-        The typical use case is to close ZeroMQ sockets.
+        The typical use case is to close ZeroMQ sockets. This method also
+        writes all pending body updates and terminates the background writer.
         """
-        pass
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer.join()
+            self.writer = None
 
     def getGridForces(self, idPos: dict):
         """
@@ -479,34 +3170,102 @@ class LeonardBase(config.AzraelProcess):
         :return: the force and torque as two Python lists (not NumPy arrays)
         :rtype: (list, list)
         """
+        force, torque = self.forcesAndTorques([objID])
+        return force[0].tolist(), torque[0].tolist()
+
+    def forcesAndTorques(self, objIDs: (tuple, list)=None,
+                         grid: bool=False):
+        """
+        Return the total forces and torques on all ``objIDs``.
+
+        This is the vectorised version of ``totalForceAndTorque``. It rotates
+        the booster forces and torques of all bodies into world coordinates
+        at once and adds the direct forces and torques.
+
+        If ``grid`` is *True* then the forces also include the value of the
+        'force' grid at the position of each body. If the grid query fails
+        then the grid forces are zero.
+
+        :param list objIDs: the bodies (defaults to all bodies).
+        :param bool grid: whether to include the forces from the 'force' grid.
+        :return: the forces and torques as Nx3 arrays (in ``objIDs`` order).
+        :rtype: (ndarray, ndarray)
+        :raises: KeyError if a body does not exist.
+        """
         # Convenience.
-        body = self.allBodies[objID]
-        f = self.allForces[objID]
+        store = self.allBodies
+        slots = store.indices(objIDs)
+
+        # The booster forces and torques are in object coordinates. Rotate
+        # them to world coordinates before adding them to the direct ones.
+        rot = _quatToMatrix(store.rotation[slots])
+        force = store.forceDirect[slots]
+        force += np.einsum('nij,nj->ni', rot, store.forceBoost[slots])
+        torque = store.torqueDirect[slots]
+        torque += np.einsum('nij,nj->ni', rot, store.torqueBoost[slots])
+
+        # Add the forces from the 'force' grid.
+        if grid and len(slots) > 0:
+            positions = store.position[slots].tolist()
+            ret = azrael.vectorgrid.getValues('force', positions)
+            if ret.ok:
+                force += ret.data
+            else:
+                self.logit.info(ret.msg)
+        return force, torque
+
+    def sampleForces(self):
+        """
+        Return the total force and torque on every body, indexed by slot.
 
-        # Construct the Quaternion of the object based on its rotation.
-        quat = util.Quaternion(*body.rotation)
+        The forces include the 'force' grid, which this method queries once
+        for all bodies. Pass the result to the other methods that need the
+        forces in the same step (eg ``removeSleepingSets``) to avoid further
+        grid queries.
 
-        # Fetch the force vector for the current object from the DB.
-        force = np.array(f.forceDirect, np.float64)
-        torque = np.array(f.torqueDirect, np.float64)
+        :return: the forces and torques as Nx3 arrays with one row per slot
+                 of ``allBodies`` (see ``BodyStore.indices``).
+        :rtype: (ndarray, ndarray)
+        """
+        store = self.allBodies
+        force = np.zeros_like(store.forceDirect)
+        torque = np.zeros_like(store.torqueDirect)
+        slots = store.indices()
+        force[slots], torque[slots] = self.forcesAndTorques(grid=True)
+        return force, torque
+
+    def compileForces(self, objIDs: (tuple, list)=None, grid: bool=False,
+                      forces: tuple=None):
+        """
+        Return the total force and torque on every body in ``objIDs``.
 
-        # Add the booster's contribution to force and torque.
-        # Note: We cannot do this directly since the booster force/torque were
-        # specified in object coordinates. We thus rotate them to world
-        # coordinates before adding them to the total force.
-        force += quat * f.forceBoost
-        torque += quat * f.torqueBoost
+        This is a convenience wrapper around ``forcesAndTorques`` for the
+        code that processes the bodies one by one (eg per collision set).
 
-        # Convert to Python lists.
-        return force.tolist(), torque.tolist()
+        :param list objIDs: the bodies (defaults to all bodies).
+        :param bool grid: whether to include the forces from the 'force' grid.
+        :param tuple forces: use these forces (see ``sampleForces``) instead
+                             of computing them (``grid`` is irrelevant then).
+        :return: {objID: (force, torque)} where force and torque are lists.
+        :rtype: dict
+        """
+        if objIDs is None:
+            objIDs = list(self.allBodies)
+        if forces is None:
+            force, torque = self.forcesAndTorques(objIDs, grid)
+        else:
+            slots = self.allBodies.indices(objIDs)
+            force, torque = forces[0][slots], forces[1][slots]
+        return dict(zip(objIDs, zip(force.tolist(), torque.tolist())))
 
     @typecheck
     def step(self, dt: (int, float), maxsteps: int):
         """
         Advance the simulation by ``dt`` using at most ``maxsteps``.
 
-        This method will use a primitive Euler step to update the state
-        variables. This suffices as a proof of concept.
+        This method ignores collisions and constraints altogether and
+        integrates all bodies at once (see ``integrateBodies``). This
+        suffices as a proof of concept.
 
         :param float dt: time step in seconds.
         :param int maxsteps: maximum number of sub-steps to simulate for one
@@ -514,34 +3273,160 @@ class LeonardBase(config.AzraelProcess):
         """
         self.processCommandQueue()
 
-        # Fetch the forces for all object positions.
-        idPos = {k: v.position for (k, v) in self.allBodies.items()}
-        ret = self.getGridForces(idPos)
-        if not ret.ok:
-            self.logit.info(ret.msg)
-            z = np.float64(0)
-            gridForces = {_: z for _ in idPos}
+        # Update the state variables of all objects.
+        self.integrate(list(self.allBodies), dt, maxsteps)
+
+        # Synchronise the local object cache back to the database.
+        self.syncObjects(collisions=None)
+
+    @typecheck
+    def integrate(self, objIDs: (tuple, list), dt: (int, float),
+                  maxsteps: int, forces: tuple=None):
+        """
+        Advance ``objIDs`` by ``dt`` without Bullet.
+
+        The forces include the 'force' grid. Only use this method for bodies
+        that can neither collide nor have constraints (see
+        ``integrateBodies``).
+
+        :param list objIDs: the bodies to advance.
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps to simulate for one
+                             ``dt`` update.
+        :param tuple forces: the forces of this step (see ``sampleForces``).
+        :return: number of integrated bodies.
+        """
+        if len(objIDs) == 0:
+            return RetVal(True, None, 0)
+        slots = self.allBodies.indices(objIDs)
+        if forces is None:
+            force, torque = self.forcesAndTorques(objIDs, grid=True)
         else:
-            gridForces = ret.data
-        del ret, idPos
+            force, torque = forces[0][slots], forces[1][slots]
+        ret = integrateBodies(self.allBodies, slots, force, torque,
+                              dt, maxsteps, self.integrator)
+        if not ret.ok:
+            self.logit.error(ret.msg)
+        return ret
+
+    def integrateIsolated(self, collSets: list, dt: (int, float),
+                          maxsteps: int, forces: tuple=None):
+        """
+        Advance all bodies that are alone in their collision set.
+
+        These bodies (eg all bodies without collision shapes) cannot touch
+        anything and therefore do not need Bullet. This method integrates
+        them directly and returns the remaining collision sets.
+
+        :param list collSets: list of collision sets.
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps to simulate for one
+                             ``dt`` update.
+        :param tuple forces: the forces of this step (see ``sampleForces``).
+        :return: the collision sets with more than one body.
+        :rtype: list
+        """
+        isolated = [next(iter(_)) for _ in collSets if len(_) == 1]
+        ret = self.integrate(isolated, dt, maxsteps, forces)
+        if not ret.ok:
+            # Leave the isolated bodies to Bullet.
+            return collSets
+        util.logMetricQty('#Integrated', ret.data)
+        return [_ for _ in collSets if len(_) > 1]
 
-        # Iterate over all objects and update their body information in Bullet.
-        for objID, body in self.allBodies.items():
-            # Compute direct- and booster forces on object.
-            force, torque = self.totalForceAndTorque(objID)
+    def removeSleepingSets(self, collSets: list, dt: (int, float),
+                           forces: tuple=None):
+        """
+        Return the collision sets that are not asleep.
+
+        A body is at rest if its linear- and angular speed are below
+        ``sleepVelocity`` and no force or torque acts on it (including the
+        force from the 'force' grid).
+        Static bodies are always at rest. A collision set falls asleep once
+        all its bodies have been at rest for at least ``sleepTime`` seconds.
+        Like Bullet, this method sets the velocities of sleeping bodies to
+        zero. Sleeping bodies do not change and ``syncObjects`` therefore
+        skips them as well.
+
+        Sleeping sets wake up when any of their bodies receives a command (see
+        ``processCommandQueue``), a force, or when an awake body comes close
+        enough to merge with the set.
+
+        :param list collSets: list of collision sets.
+        :param float dt: time step in seconds.
+        :param tuple forces: the forces of this step (defaults to
+                             ``sampleForces``).
+        :return: the collision sets that are awake.
+        :rtype: list
+        """
+        if self.sleepTime is None or len(collSets) == 0:
+            return collSets
 
-            # Add the force defined on the 'force' grid.
-            force += gridForces[objID]
+        # Convenience.
+        store = self.allBodies
+        slots = store.indices()
+        linThresh, rotThresh = self.sleepVelocity
+
+        # Update the rest time of all bodies.
+        if forces is None:
+            forces = self.sampleForces()
+        force, torque = forces[0][slots], forces[1][slots]
+        resting = np.linalg.norm(store.velocityLin[slots], axis=1) < linThresh
+        resting &= np.linalg.norm(store.velocityRot[slots], axis=1) < rotThresh
+        resting &= ~np.any(force != 0, axis=1) & ~np.any(torque != 0, axis=1)
+        resting |= store.imass[slots] < 1E-4
+        resting |= store.inertia[slots].sum(axis=1) < 1E-4
+        store.restTime[slots] = np.where(
+            resting, store.restTime[slots] + dt, 0)
+
+        # A set is asleep if none of its bodies is awake.
+        awake = store.restTime < self.sleepTime
+        members = store.indices(itertools.chain.from_iterable(collSets))
+        setIdx = np.repeat(np.arange(len(collSets)),
+                           [len(_) for _ in collSets])
+        numAwake = np.bincount(setIdx, awake[members], len(collSets))
+        asleep = (numAwake == 0)
+
+        # Sleeping bodies do not move.
+        sleepSlots = members[asleep[setIdx]]
+        store.velocityLin[sleepSlots] = 0
+        store.velocityRot[sleepSlots] = 0
+
+        util.logMetricQty('#SleepingSets', int(np.count_nonzero(asleep)))
+        util.logMetricQty('#SleepingBodies', len(sleepSlots))
+        return [s for s, z in zip(collSets, asleep.tolist()) if not z]
+
+    def computeCollisionSets(self, constraintPairs: list, dt: (int, float),
+                             timeit=None):
+        """
+        Return the collision sets for all bodies in the local cache.
 
-            # Update velocity and position.
-            vel = np.array(body.velocityLin, np.float64) + 0.5 * force
-            pos = np.array(body.position, np.float64)
-            pos += dt * vel
-            vel, pos = tuple(vel), tuple(pos)
-            self.allBodies[objID] = body._replace(position=pos, velocityLin=vel)
+        If the broadphase reuses the collision sets from the previous step
+        (see ``BroadphaseReuse``) then this method also logs the number of
+        reused and recomputed sets. Furthermore, it books the elapsed time
+        of ``timeit`` under the kind of update ('reuse', 'partial' or
+        'full'). The difference between those timings is the time saved.
 
-        # Synchronise the local object cache back to the database.
-        self.syncObjects(collisions=None)
+        :param list constraintPairs: list of 2-tuples eg [(1, 2), ...].
+        :param float dt: time step in seconds.
+        :param timeit: ``util.Timeit`` instance that measures the broadphase.
+        :return: list of non-overlapping collision sets.
+        """
+        reuse = isinstance(self.broadphase, BroadphaseReuse)
+        if reuse:
+            self.broadphase.dt = dt
+
+        ret = getFinalCollisionSets(
+            constraintPairs, self.allBodies, self.allAABBs, self.broadphase)
+        if not ret.ok or not reuse:
+            return ret
+
+        stats = self.broadphase.stats
+        util.logMetricQty('#CollSetsReused', stats['reused'])
+        util.logMetricQty('#CollSetsRecomputed', stats['recomputed'])
+        if timeit is not None:
+            timeit.tick(' ' + stats['update'])
+        return ret
 
     def processCommandQueue(self):
         """
@@ -551,82 +3436,89 @@ class LeonardBase(config.AzraelProcess):
 
         :return bool: Success.
         """
-        # Fetch (and de-queue) all pending commands.
-        ret = leoAPI.dequeueCommands()
+        # Fetch (and de-queue) the pending commands. Only poll the datastore
+        # periodically since the commands usually arrive via the command
+        # channel (if there is one). ``readCommands`` also reads the
+        # datastore if the channel skipped a command.
+        poll = (time.time() - self.lastCmdPoll >= self.cmdPollInterval)
+        if poll:
+            self.lastCmdPoll = time.time()
+        ret = leoAPI.readCommands(self.cmdBatch, poll)
         if not ret.ok:
             msg = 'Cannot fetch commands'
             self.logit.error(msg)
             return RetVal(False, msg, None)
+        util.logMetricQty('#Commands', len(ret.data))
+
+        # Apply the commands in the order they arrived.
+        store = self.allBodies
+        for doc in ret.data:
+            objID, cmd = doc['objID'], doc['cmd']
+            if cmd == 'spawn':
+                self._applySpawn(objID, doc)
+                continue
+            if objID not in store:
+                continue
 
-        # Convenience.
-        cmds = ret.data
-
-        # Remove objects.
-        for doc in cmds['remove']:
-            objID = doc['objID']
-            if objID in self.allBodies:
-                del self.allBodies[objID]
-                del self.allForces[objID]
-                del self.allAABBs[objID]
-
-        # Spawn objects.
-        for doc in cmds['spawn']:
-            objID = doc['objID']
-            if objID in self.allBodies:
-                msg = 'Cannot spawn object since objID={} already exists'
-                self.logit.warning(msg.format(objID))
+            if cmd == 'remove':
+                # This also removes the AABBs and forces.
+                del store[objID]
+                self.broadphase.remove(objID)
                 continue
 
-            # Add the body and its AABB to Leonard's cache. Furthermore, add
-            # (and initialise) the entry for the forces on this body.
-            body_old = doc['rbs']
-            self.allBodies[objID] = RigidBodyData(**body_old)
-            self.allForces[objID] = Forces(*(([0, 0, 0], ) * 4))
-            self.allAABBs[objID] = doc['AABBs']
-
-        # Update Body States.
-        for doc in cmds['modify']:
-            objID, new, aabbs_new = doc['objID'], doc['rbs'], doc['AABBs']
-            if objID in self.allBodies:
-                # Convert the original body state into a dictionary and update
-                # it with the new values.
-                old = self.allBodies[objID]._asdict()
-                old.update(new)
-
-                # Attempt to construct a new RigidBody with the new body that
-                # now includes the updated values. If it fails skip this body
-                # altogether.
-                try:
-                    self.allBodies[objID] = RigidBodyData(**old)
-                except TypeError:
-                    self.logit.warning('Could not update body state in Leonard.')
-                    continue
+            # Wake up all bodies that receive a command.
+            store.restTime[store.slots[objID]] = 0
+            if cmd == 'modify':
+                self._applyModify(objID, doc)
+            elif cmd == 'direct_force':
+                self.allForces[objID] = self.allForces[objID]._replace(
+                    forceDirect=doc['force'], torqueDirect=doc['torque'])
+            elif cmd == 'booster_force':
+                self.allForces[objID] = self.allForces[objID]._replace(
+                    forceBoost=doc['force'], torqueBoost=doc['torque'])
+        return RetVal(True, None, None)
 
-                # Assign the new AABB if it is not None (note: a value of
-                # *None* explicitly means that there is no AABB update,
-                # whereas the AABBs for eg an empty shape would be []).
-                if aabbs_new is not None:
-                    self.allAABBs[objID] = aabbs_new
+    def _applySpawn(self, objID: str, doc: dict):
+        """
+        Add the body from the 'spawn' command ``doc`` to the local cache.
+        """
+        if objID in self.allBodies:
+            msg = 'Cannot spawn object since objID={} already exists'
+            self.logit.warning(msg.format(objID))
+            return
 
-        # Update direct force- and torque values.
-        for doc in cmds['direct_force']:
-            objID, force, torque = doc['objID'], doc['force'], doc['torque']
-            try:
-                self.allForces[objID] = self.allForces[objID]._replace(
-                    forceDirect=force, torqueDirect=torque)
-            except KeyError:
-                pass
+        # Add the body and its AABB to Leonard's cache. The forces on new
+        # bodies are zero.
+        self.allBodies[objID] = RigidBodyData(**doc['rbs'])
+        self.allAABBs[objID] = doc['AABBs']
+        self.broadphase.insert(objID, self.allBodies[objID], doc['AABBs'])
 
-        # Update booster force- and torque values.
-        for doc in cmds['booster_force']:
-            objID, force, torque = doc['objID'], doc['force'], doc['torque']
-            try:
-                self.allForces[objID] = self.allForces[objID]._replace(
-                    forceBoost=force, torqueBoost=torque)
-            except KeyError:
-                pass
+    def _applyModify(self, objID: str, doc: dict):
+        """
+        Update the body ``objID`` with the 'modify' command ``doc``.
+        """
+        new, aabbs_new = doc['rbs'], doc['AABBs']
+
+        # Convert the original body state into a dictionary and update it
+        # with the new values.
+        old = self.allBodies[objID]._asdict()
+        old.update(new)
 
-        return RetVal(True, None, None)
+        # Attempt to construct a new RigidBody with the new body that now
+        # includes the updated values. If it fails skip this body
+        # altogether.
+        try:
+            self.allBodies[objID] = RigidBodyData(**old)
+        except TypeError:
+            self.logit.warning('Could not update body state in Leonard.')
+            return
+
+        # Assign the new AABB if it is not None (note: a value of *None*
+        # explicitly means that there is no AABB update, whereas the AABBs
+        # for eg an empty shape would be []).
+        if aabbs_new is not None:
+            self.allAABBs[objID] = aabbs_new
+            self.broadphase.insert(objID, self.allBodies[objID], aabbs_new)
 
     def syncObjects(self, collisions: list):
         """
@@ -646,17 +3538,47 @@ class LeonardBase(config.AzraelProcess):
             msg = json.dumps(collisions).encode('utf8')
             self.events.publish(topic='phys.collisions', msg=msg)
 
-        # Update the RBS data in the master record.
-        db = azrael.datastore.getDSHandle('ObjInstances')
+        # The background writer could not sync some bodies. Mark them dirty
+        # to sync them again (unless they do not exist anymore).
+        store = self.allBodies
+        if self.writer is not None:
+            failed = [_ for _ in self.writer.popFailed() if _ in store]
+            store.dirty[store.indices(failed)] = True
+
+        # Compile the RBS updates for all bodies that changed noticeably
+        # since their last sync.
+        slots = store.changed(self.syncThreshold)
+        aids = [store.slotIDs[_] for _ in slots.tolist()]
         ops = {}
-        for aid, body in self.allBodies.items():
+        for aid, body in zip(aids, store.bodies(slots)):
             ops[aid] = {
                 'inc': {},
                 'set': {('template', 'rbs'): body._asdict()},
                 'unset': [],
                 'exists': {('template', 'rbs'): True},
             }
-        db.modify(ops)
+        util.logMetricQty('#SyncBodies', len(ops))
+        if len(ops) == 0:
+            return
+
+        # Update the RBS data in the master record. Use the background writer
+        # if there is one. If its queue is full, or the write fails, then
+        # the bodies remain unsynced, ie the next call will try again.
+        if self.writer is None:
+            db = azrael.datastore.getDSHandle('ObjInstances')
+            ret = db.modifyBulk(ops)
+            if ret.ok:
+                store.markSynced(slots)
+            else:
+                store.dirty[slots] = True
+                self.logit.warning(ret.msg)
+        else:
+            if self.writer.submit(ops):
+                store.markSynced(slots)
+            stats = self.writer.stats
+            util.logMetricQty('#SyncDropped', stats['dropped'])
+            util.logMetricQty('#SyncFailed', stats['failed'])
+            util.logMetricQty('SyncLag_ms', int(1000 * stats['lag']))
 
     def processCommandsAndSync(self):
         """
@@ -670,6 +3592,8 @@ class LeonardBase(config.AzraelProcess):
         """
         self.processCommandQueue()
         self.syncObjects(collisions=None)
+        if self.writer is not None:
+            self.writer.flush()
 
     def run(self):
         """
@@ -678,23 +3602,29 @@ class LeonardBase(config.AzraelProcess):
         # Call `run` method of `AzraelProcess` base class.
         super().run()
 
-        # Initialisation.
+        # Initialisation. Write the bodies to the datastore in the background
+        # to never block the physics.
         self.setup()
+        self.writer = DatastoreWriter('ObjInstances')
+        self.writer.start()
+
+        # Receive the commands via the command channel. Use the ZeroMQ
+        # channel unless the process already has one (eg an in-process
+        # queue because Clerk runs in the same process).
+        if leoAPI.getCommandChannel() is None:
+            addr = 'tcp://*:{}'.format(self.cmdPort)
+            leoAPI.setCommandChannel(leoAPI.CommandChannel(addr))
+        leoAPI.getCommandChannel().bind()
         self.logit.debug('Setup complete.')
 
-        # Trigger the `step` method every `stepinterval` seconds, if possible.
-        t0 = time.time()
-        stepinterval = 0.050
-
+        # Trigger the `step` method whenever the scheduler says so.
         try:
             while True:
-                # Wait if <10ms have passed. Proceed immediately otherwise.
-                sleep_time = stepinterval - (time.time() - t0)
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-
-                # Backup the time stamp.
-                t0 = time.time()
+                # Wait for the next tick. Stop if the scheduler is done.
+                tick = self.scheduler.wait()
+                if tick is None:
+                    break
+                dt, maxsteps = tick
 
                 # Trigger the physics update step.
                 # Note: 'maxsteps' *must* be 1 to obtain all collision
@@ -703,9 +3633,13 @@ class LeonardBase(config.AzraelProcess):
                 # during the sub-steps, but we can only query them after the
                 # last update.
                 with util.Timeit('Leonard:1.0 Step'):
-                    self.step(stepinterval, maxsteps=10)
+                    self.step(dt, maxsteps)
+                self.scheduler.done()
         except KeyboardInterrupt:
             self.logit.warning('Leonard was aborted')
+        finally:
+            # Write the last updates before terminating.
+            self.shutdown()
 
 
 class LeonardBullet(LeonardBase):
@@ -714,8 +3648,8 @@ class LeonardBullet(LeonardBase):
 
     Unlike ``LeonardBase`` this class actually *does* update the physics.
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.bullet = None
 
     def setup(self):
@@ -743,30 +3677,17 @@ class LeonardBullet(LeonardBase):
         self.igor.updateLocalCache()
         allConstraints = self.igor.getConstraints(None).data
 
-        # Fetch the forces for all object positions.
-        idPos = {k: v.position for (k, v) in self.allBodies.items()}
-        ret = self.getGridForces(idPos)
-        if not ret.ok:
-            self.logit.info(ret.msg)
-            z = np.float64(0)
-            gridForces = {_: z for _ in idPos}
-        else:
-            gridForces = ret.data
-        del ret, idPos
+        # Compute the direct-, booster- and grid forces on all objects.
+        objIDs = list(self.allBodies)
+        force, torque = self.forcesAndTorques(objIDs, grid=True)
 
         # Iterate over all objects and update them.
-        for objID, body in self.allBodies.items():
+        for idx, objID in enumerate(objIDs):
             # Copy the body from the DB to Bullet.
-            self.bullet.setRigidBodyData(objID, body)
-
-            # Compute direct- and booster forces on object.
-            force, torque = self.totalForceAndTorque(objID)
-
-            # Add the force defined on the 'force' grid.
-            force += gridForces[objID]
+            self.bullet.setRigidBodyData(objID, self.allBodies[objID])
 
             # Apply the force to the object.
-            self.bullet.applyForceAndTorque(objID, force, torque)
+            self.bullet.applyForceAndTorque(objID, force[idx], torque[idx])
 
         # Apply all constraints. Log any errors but ignore them otherwise as
         # they are harmless (simply means no constraints were applied).
@@ -792,8 +3713,8 @@ class LeonardBullet(LeonardBase):
             # Assign the new object properties only if the call succeeded. Keep
             # the old body otherwise.
             if ret.ok is True:
-                body = self.allBodies[objID]
-                self.allBodies[objID] = body._replace(
+                self.allBodies.setFields(
+                    objID,
                     position=ret.data.position,
                     rotation=ret.data.rotation,
                     velocityLin=ret.data.vLin,
@@ -839,14 +3760,13 @@ class LeonardSweeping(LeonardBase):
         self.igor.updateLocalCache()
 
         # Compute all collision sets.
-        with util.Timeit('CCS'):
+        with util.Timeit('CCS') as timeit:
             ret = self.igor.uniquePairs()
             if not ret.ok:
                 return
             uniquePairs = ret.data
 
-            ret = getFinalCollisionSets(
-                uniquePairs, self.allBodies, self.allAABBs)
+            ret = self.computeCollisionSets(uniquePairs, dt, timeit)
             if not ret.ok:
                 return
             collSets = ret.data
@@ -854,6 +3774,18 @@ class LeonardSweeping(LeonardBase):
 
         # Log the number of created collision sets.
         util.logMetricQty('#CollSets', len(collSets))
+        util.logMetricQty('#CollSetMax', collisionSetStats(collSets)['max'])
+
+        # Compute the direct-, booster- and grid forces on all objects. This
+        # queries the grid only once.
+        sample = self.sampleForces()
+
+        # Sleeping sets need no update at all. Advance the isolated bodies
+        # without Bullet.
+        collSets = self.removeSleepingSets(collSets, dt, sample)
+        collSets = self.integrateIsolated(collSets, dt, maxsteps, sample)
+        forces = self.compileForces(
+            list(set().union(*collSets)), forces=sample)
 
         # Create empty set of collisions. This is a precaution in case the
         # for-loop below does not run (ie there are no bodies to simulate).
@@ -864,29 +3796,13 @@ class LeonardSweeping(LeonardBase):
             # Compile the subset dictionary for the current collision set.
             coll_bodies = {_: self.allBodies[_] for _ in subset}
 
-            # Fetch the forces for all object positions.
-            idPos = {k: v.position for (k, v) in coll_bodies.items()}
-            ret = self.getGridForces(idPos)
-            if not ret.ok:
-                self.logit.info(ret.msg)
-                z = np.float64(0)
-                gridForces = {_: z for _ in idPos}
-            else:
-                gridForces = ret.data
-            del ret, idPos
-
             # Iterate over all objects and update them.
             for objID, body in coll_bodies.items():
                 # Copy the body from the DB to Bullet.
                 self.bullet.setRigidBodyData(objID, body)
 
-                # Compute direct- and booster forces on object.
-                force, torque = self.totalForceAndTorque(objID)
-
-                # Add the force defined on the 'force' grid.
-                force += gridForces[objID]
-
                 # Apply the final force to the object.
+                force, torque = forces[objID]
                 self.bullet.applyForceAndTorque(objID, force, torque)
 
             # Query all constraints and apply them in the next step (this
@@ -917,11 +3833,11 @@ class LeonardSweeping(LeonardBase):
             for objID, body in coll_bodies.items():
                 ret = self.bullet.getRigidBodyData(objID)
 
-                # Assign the new object properties only if the call succeeded. Keep
-                # the old body otherwise.
+                # Assign the new object properties only if the call
+                # succeeded. Keep the old body otherwise.
                 if ret.ok is True:
-                    body = self.allBodies[objID]
-                    self.allBodies[objID] = body._replace(
+                    self.allBodies.setFields(
+                        objID,
                         position=ret.data.position,
                         rotation=ret.data.rotation,
                         velocityLin=ret.data.vLin,
@@ -932,6 +3848,49 @@ class LeonardSweeping(LeonardBase):
         self.syncObjects(collisions)
 
 
+class _WorkerResidency:
+    """
+    Keep track of the bodies a Worker holds.
+
+    The arrays are indexed by the slots of the bodies in the ``BodyStore``.
+    The ``owner`` array contains the objID of the body the Worker holds in
+    every slot (or *None*), and ``rows`` its state (see
+    ``wpcodec.packState``) as Leonard last received it from the Worker. The
+    ``drop`` set contains the objIDs the Worker should forget.
+    """
+    def __init__(self):
+        self.owner = np.zeros(0, object)
+        self.rows = np.zeros((0, wpcodec.wpWidth), np.float64)
+        self.drop = set()
+
+    def resize(self, size: int):
+        """
+        Grow the arrays to at least ``size`` slots.
+        """
+        num = size - len(self.owner)
+        if num > 0:
+            pad = np.full(num, None, object)
+            self.owner = np.concatenate((self.owner, pad))
+            pad = np.full((num, wpcodec.wpWidth), np.nan)
+            self.rows = np.concatenate((self.rows, pad))
+
+    def forget(self, slots: np.ndarray):
+        """
+        Tell the Worker to drop the bodies in ``slots`` (if it holds them).
+        """
+        slots = slots[slots < len(self.owner)]
+        slots = slots[np.not_equal(self.owner[slots], None)]
+        self.drop.update(self.owner[slots].tolist())
+        self.owner[slots] = None
+
+    def update(self, store, slots: np.ndarray):
+        """
+        Record the state of the bodies in ``slots`` (if the Worker holds them).
+        """
+        slots = slots[np.not_equal(self.owner[slots], None)]
+        self.rows[slots] = wpcodec.packState(store, slots)
+
+
 class LeonardDistributedZeroMQ(LeonardBase):
     """
     Compute physics with separate engines.
@@ -942,17 +3901,101 @@ class LeonardDistributedZeroMQ(LeonardBase):
 
     This class uses the sweeping algorithm to determine collision sets, just
     like ``LeonardSweeping`` does.
+
+    The Workers connect DEALER sockets to Leonard's ROUTER socket and
+    announce how many Work Packages they can hold (see
+    ``LeonardWorkerZeroMQ``). Leonard sends each Worker up to that many
+    Work Packages at once, and the Workers return the results as soon as
+    they are done (see ``processWorkPackages``). The Workers keep their
+    bodies between steps, and Leonard routes every collision set back to
+    the same Worker if possible.
+
+    The Workers may run on other hosts. A ``WorkerAgent`` on every host
+    registers with Leonard, reports its live Workers with periodic
+    heartbeats, and starts or stops Workers as Leonard asks it to (see
+    ``scaleFleet``). Leonard re-sends the unfinished Work Packages of a
+    Worker as soon as it is gone (see ``_checkAgents``).
+
+    :param int port: port for the Workers and agents (defaults to the
+                     Leonard service in ``config``).
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, port: int=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.wpid_counter = 0
         self.ctx = None
         self.sock = None
+        if port is None:
+            port = config.azService['leonard'].port
+        self.port = port
+
+        # The number of additional Work Packages each Worker can accept,
+        # and the bodies each Worker holds, keyed by the ZeroMQ identity of
+        # the Worker.
+        self.workers = {}
+        self.residency = {}
+
+        # The slots of the bodies in every Work Package of the current step,
+        # the Work Packages every Worker is processing (see
+        # ``_dispatchWorkPackages``), the overdue ones, and those of the
+        # Workers that died in the meantime.
+        self.wpSlots = {}
+        self.inflight = {}
+        self.overdue = set()
+        self.orphans = []
+
+        # The Worker agents keyed by their ZeroMQ identity. Declare an agent
+        # and all its Workers dead if it sent no heartbeat for
+        # ``agentTimeout`` seconds.
+        self.agents = {}
+        self.agentTimeout = 2
+
+        # Size the fleet to the tick duration relative to the tick budget:
+        # add a Worker if it exceeds ``fleetGrow`` on average, and remove one
+        # if it is below ``fleetShrink``. Wait ``fleetHold`` ticks after
+        # every change (see ``scaleFleet``).
+        self.fleetSize = 0
+        self.fleetLoad = 0
+        self.fleetGrow, self.fleetShrink = 1.0, 0.5
+        self.fleetHold, self.fleetWait = 20, 0
+
+        # Pack the collision sets into about this many Work Packages per
+        # Worker. The cost of a collision set is the weighted number of its
+        # bodies, collision shapes, constraints and contacts (see
+        # ``packCollisionSets``).
+        self.wpPerWorker = 4
+        self.wpCostWeights = {
+            'bodies': 1, 'shapes': 1, 'constraints': 2, 'contacts': 1}
+
+        # The Work Package of every body (by slot) in the last step.
+        self.wpBin = np.zeros(0, np.int64)
+
+        # A Work Package is overdue once its Worker took ``wpSlack`` times
+        # longer than its cost (see ``packCollisionSets``) suggests, but at
+        # least ``wpMinDeadline`` and at most ``wpTimeout`` seconds. The
+        # expected time per unit of cost (``wpRate``) is the moving average
+        # of the previous results. Leonard sends overdue Work Packages to
+        # another Worker as well and uses whichever result arrives first.
+        self.wpTimeout = 0.5
+        self.wpSlack, self.wpMinDeadline = 3, 0.01
+        self.wpRate = None
+
+        # Do not send Work Packages to a Worker for ``wpBlacklistTime``
+        # seconds once it missed ``wpMaxStrikes`` deadlines in a row.
+        self.wpMaxStrikes, self.wpBlacklistTime = 3, 10
+        self.strikes, self.blacklist = {}, {}
+
+        # The duration of the last ``processWorkPackages`` calls.
+        self.wpGather = deque(maxlen=100)
+
+        # Statistics of the last ``processWorkPackages`` call.
+        self.wpStats = {}
 
         # Local cache of collision contacts. This one will be filled up as the
         # minions return their result. Only when all results are in will the
-        # collision contacts be dispatched.
+        # collision contacts be dispatched. The contacts of the previous step
+        # determine the cost of the collision sets.
         self.collisions = []
+        self.lastCollisions = []
 
 #    def __del__(self):
 #        self.shutdown()
@@ -961,9 +4004,11 @@ class LeonardDistributedZeroMQ(LeonardBase):
         """
         Kill all worker processes.
         """
+        super().shutdown()
+
         # Close the Leonard <---> Worker socket.
         if self.sock is not None:
-            addr = 'tcp://{}:{}'.format('*', config.azService['leonard'].port)
+            addr = 'tcp://{}:{}'.format('*', self.port)
             try:
                 self.sock.unbind(addr)
             except zmq.error.ZMQError:
@@ -986,11 +4031,14 @@ class LeonardDistributedZeroMQ(LeonardBase):
         # copy of the ZeroMQ context with the already bound address, which it
         # may never release.
         self.ctx = zmq.Context()
-        self.sock = self.ctx.socket(zmq.REP)
+        self.sock = self.ctx.socket(zmq.ROUTER)
+
+        # Raise an error when sending to a Worker that is gone.
+        self.sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
 
         # Bind the socket to the specified address. Retry a few times if
         # necessary.
-        addr = 'tcp://{}:{}'.format('*', config.azService['leonard'].port)
+        addr = 'tcp://{}:{}'.format('*', self.port)
         for ii in range(10):
             try:
                 self.sock.bind(addr)
@@ -1007,8 +4055,8 @@ class LeonardDistributedZeroMQ(LeonardBase):
 
         This method copies all bodies from the database to the Bullet
         engine. Then it defers to Bullet for the physics update. Finally, it
-        replaces the body fields with the user specified values (only applies if
-        the user called 'setRigidBody') and writes the results back to the
+        replaces the body fields with the user specified values (only applies
+        if the user called 'setRigidBody') and writes the results back to the
         database.
 
         :param float dt: time step in seconds.
@@ -1016,7 +4064,16 @@ class LeonardDistributedZeroMQ(LeonardBase):
                              ``dt`` update.
         """
         # Flush the collision contacts from the previous iteration.
-        self.collisions.clear()
+        self.lastCollisions, self.collisions = self.collisions, []
+
+        # Register new Workers and agents, process the heartbeats, and size
+        # the fleet according to the previous ticks.
+        with util.Timeit('Leonard:1.0.1  Fleet'):
+            self.pollWorkers()
+            self.scaleFleet()
+        util.logMetricQty('#FleetAgents', len(self.agents))
+        util.logMetricQty('#FleetWorkers', len(self.workers))
+        util.logMetricQty('#FleetTarget', self.fleetSize)
 
         # Read queued commands and update the local object cache accordingly.
         with util.Timeit('Leonard:1.1  processCmdQueue'):
@@ -1026,121 +4083,753 @@ class LeonardDistributedZeroMQ(LeonardBase):
         self.igor.updateLocalCache()
 
         # Compute the collision sets.
-        with util.Timeit('Leonard:1.2  CCS'):
+        with util.Timeit('Leonard:1.2  CCS') as timeit:
             ret = self.igor.uniquePairs()
             if not ret.ok:
                 return
             uniquePairs = ret.data
 
-            ret = getFinalCollisionSets(
-                uniquePairs, self.allBodies, self.allAABBs)
+            ret = self.computeCollisionSets(uniquePairs, dt, timeit)
             if not ret.ok:
                 return
             collSets = ret.data
-            del ret, uniquePairs
+            del ret
 
         # Log the number of created collision sets.
         util.logMetricQty('#CollSets', len(collSets))
-
-        # Put each collision set into its own Work Package.
+        util.logMetricQty('#CollSetMax', collisionSetStats(collSets)['max'])
+
+        # Skip the sleeping sets and advance the isolated bodies here. Only
+        # the other collision sets need a Worker. Log the total number of
+        # bodies in them (static bodies may appear in several sets).
+        with util.Timeit('Leonard:1.2.1  Integrate'):
+            # Compute the direct-, booster- and grid forces on all objects.
+            # This queries the grid once for all of them, instead of once per
+            # Work Package in the Workers.
+            sample = self.sampleForces()
+            collSets = self.removeSleepingSets(collSets, dt, sample)
+            collSets = self.integrateIsolated(collSets, dt, maxsteps, sample)
+        util.logMetricQty('#WPBodies', sum([len(_) for _ in collSets]))
+
+        # Pack the collision sets into Work Packages of similar cost.
         with util.Timeit('Leonard:1.3  CreateWPs'):
+            forces = self.compileForces(
+                list(set().union(*collSets)), forces=sample)
+
             all_WPs = {}
-            for subset in collSets:
+            for subset, cost in self.packCollisionSets(collSets, uniquePairs):
                 # Compile the Work Package. Skip this physics step altogether
                 # if an error occurs.
-                ret = self.createWorkPackage(list(subset), dt, maxsteps)
+                ret = self.createWorkPackage(subset, dt, maxsteps, forces)
                 if not ret.ok:
                     self.logit.error(ret.msg)
                     return
+                ret.data['cost'] = cost
                 all_WPs[ret.data['wpid']] = ret.data
-
-        with util.Timeit('Leonard:1.4  WPSendRecv'):
-            wpIdx = 0
-            worklist = list(all_WPs.keys())
-            while True:
-                # Wait until Worker contacts us. The message usually contains a
-                # processed Work Package. However, it may also be empty, most
-                # likely because the Worker has not received a Work Package
-                # from us yet.
-                msg = self.sock.recv()
-                if msg != b'':
-                    # Unpickle the message.
-                    msg = pickle.loads(msg)
-                    wpid = msg['wpid']
-
-                    # Ignore the message if its Work Package is not pending
-                    # anymore (most likely because multiple Workers processed
-                    # the same Work Package and one of the others already
-                    # returned it).
-                    if wpid in all_WPs:
-                        self.updateLocalCache(msg['wpdata'], msg['collisions'])
-
-                        # Decrement the Work Package index if the wpIdx counter
-                        # is already past that work package. This simply
-                        # ensures that no WP is skipped simply because the
-                        # queue has shrunk.
-                        if worklist.index(wpid) < wpIdx:
-                            wpIdx -= 1
-
-                        # Remove the WP from the work list and the WP cache.
-                        worklist.remove(wpid)
-                        del all_WPs[wpid]
-
-                # Send an empty message to the Worker if no Work Packages are
-                # pending anymore. This empty message is important to avoid
-                # breaking the REQ/REP pattern enforced by ZeroMQ.
-                if len(all_WPs) == 0:
-                    self.sock.send(b'')
-                    break
-
-                # Pick the next pending Work Package and increment the index.
-                if wpIdx >= len(worklist):
-                    wpIdx = 0
-                wp = all_WPs[worklist[wpIdx]]
-                wpIdx += 1
-
-                # Send the Work Package to the Worker.
-                self.sock.send(pickle.dumps(wp))
+        util.logMetricQty('#WPs', len(all_WPs))
+
+        with util.Timeit('Leonard:1.4  WPSendRecv') as timeit:
+            self.processWorkPackages(all_WPs)
+            timeit.save('Leonard:1.4.1  Dispatch', self.wpStats['dispatch'])
+            timeit.save('Leonard:1.4.2  Collect', self.wpStats['collect'])
+            timeit.save('Leonard:1.4.3  Encode', self.wpStats['encode'])
+            timeit.save('Leonard:1.4.4  Decode', self.wpStats['decode'])
+            for pct, value in self.wpStats['tail'].items():
+                timeit.save('Leonard:1.4  WPSendRecv p{}'.format(pct), value)
+        util.logMetricQty('#WPDuplicates', self.wpStats['duplicates'])
+        util.logMetricQty('#WPOrphans', self.wpStats['orphans'])
+        util.logMetricQty('#WPSpeculative', self.wpStats['speculative'])
+        util.logMetricQty('#WPBlacklisted', len(self.blacklist))
+        util.logMetricQty('#WPBytesOut', self.wpStats['bytesOut'])
+        util.logMetricQty('#WPBytesIn', self.wpStats['bytesIn'])
+        util.logMetricQty('#WPBodiesResident', self.wpStats['resident'])
+        util.logMetricQty('#WPBodiesLoaded', self.wpStats['loaded'])
+        imbalance = int(100 * self.wpStats['imbalance'])
+        util.logMetricQty('WPImbalance_pct', imbalance)
 
         # Synchronise the local cache back to the database.
         with util.Timeit('Leonard:1.5  syncObjects'):
             self.syncObjects(self.collisions)
 
+    def packCollisionSets(self, collSets: list, constraintPairs: list):
+        """
+        Return the ``collSets`` packed into groups of similar cost.
+
+        The cost of a collision set is the weighted sum (see
+        ``wpCostWeights``) of the number of its bodies, their collision
+        shapes, their constraints, and their contacts in the previous step.
+        This method packs the sets into at most ``wpPerWorker`` groups per
+        Worker with ``packCosts``. Every set prefers the group its bodies
+        were in during the previous step.
+
+        :param list collSets: collision sets.
+        :param list constraintPairs: list of 2-tuples eg [(1, 2), ...].
+        :return: the objIDs and the total cost of every group.
+        :rtype: list[(list, float)]
+        """
+        if len(collSets) == 0:
+            return []
+
+        # Convenience.
+        store, weights = self.allBodies, self.wpCostWeights
+        sizes = [len(_) for _ in collSets]
+        members = store.indices(itertools.chain.from_iterable(collSets))
+        setIdx = np.repeat(np.arange(len(collSets)), sizes)
+
+        # Count the constraints and contacts of every body.
+        extra = np.zeros(len(store.slotIDs), np.float64)
+        for pair in constraintPairs:
+            for objID in pair:
+                if objID in store:
+                    extra[store.slots[objID]] += weights['constraints']
+        for aidA, aidB, points in self.lastCollisions:
+            for objID in (aidA, aidB):
+                if objID in store:
+                    extra[store.slots[objID]] += (
+                        weights['contacts'] * (len(points) // 2))
+
+        # Compile the cost of every body and collision set.
+        numShapes = [len(store.cshapes[_]) for _ in members.tolist()]
+        cost = weights['bodies'] + extra[members]
+        cost += weights['shapes'] * np.array(numShapes, np.float64)
+        cost = np.bincount(setIdx, cost, len(collSets))
+
+        # Every set prefers the group of (one of) its bodies in the last step.
+        if len(self.wpBin) < len(store.slotIDs):
+            pad = np.full(len(store.slotIDs) - len(self.wpBin), -1, np.int64)
+            self.wpBin = np.concatenate((self.wpBin, pad))
+        offsets = np.cumsum(sizes) - sizes
+        preferred = np.maximum.reduceat(self.wpBin[members], offsets)
+
+        # Pack the sets and remember the group of every body.
+        numBins = self.wpPerWorker * max(1, len(self.workers))
+        bins = packCosts(cost, numBins, preferred)
+        setBin = np.zeros(len(collSets), np.int64)
+        for idx, items in enumerate(bins):
+            setBin[items] = idx
+        self.wpBin[:] = -1
+        self.wpBin[members] = setBin[setIdx]
+
+        out = []
+        for items in bins:
+            if len(items) > 0:
+                objIDs = set().union(*[collSets[_] for _ in items])
+                out.append((list(objIDs), float(cost[items].sum())))
+        return out
+
+    def processWorkPackages(self, all_WPs: dict):
+        """
+        Distribute ``all_WPs`` to the Workers and apply their results.
+
+        Every Worker receives at most as many Work Packages as it can
+        currently accept. The results arrive in any order. Each one frees up
+        the capacity for another Work Package. Every Work Package has a
+        deadline that depends on its cost (see ``_checkDeadlines``). This
+        method sends the overdue ones to another Worker as well
+        ('speculative'), and ignores the late duplicates ('duplicates')
+        without decoding them. The Work Packages of Workers that are gone
+        (see ``_checkAgents``) are re-sent right away ('orphans').
+
+        The Workers keep the bodies from previous Work Packages. Leonard
+        therefore sends every Work Package to the Worker that already holds
+        most of its bodies, unless that Worker is busy and another one is
+        idle. The Work Package then only contains the forces for the bodies
+        that have not changed since (see ``_encodeWorkPackage``).
+
+        This method returns once all Work Packages were processed. The
+        ``wpStats`` attribute then contains the time spent on sending
+        ('dispatch') and receiving/applying the results ('collect') in
+        seconds, as well as the number of duplicate results. It also
+        contains the time spent on encoding the Work Packages ('encode')
+        and decoding the results ('decode'), the number of bytes sent
+        ('bytesOut') and received ('bytesIn'), and the number of bodies
+        the Workers already held ('resident') or had to load ('loaded').
+        The 'affinity' is the fraction of resident bodies.
+
+        Finally, 'workers' contains the load of every Worker: the number of
+        Work Packages ('wps'), bodies ('bodies') and their total 'cost' (see
+        ``packCollisionSets``) it received, as well as the sum of the round
+        trip times of its results ('time'). The 'imbalance' is the ratio of
+        the maximum to the average cost per Worker. The 'tail' contains the
+        50th, 90th and 99th percentile of the duration of the last
+        ``wpGather.maxlen`` calls to this method in seconds.
+
+        :param dict all_WPs: {wpid: wp} (see ``createWorkPackage``).
+        """
+        stats = {'dispatch': 0, 'collect': 0, 'duplicates': 0,
+                 'orphans': 0, 'speculative': 0, 'encode': 0, 'decode': 0,
+                 'bytesOut': 0, 'bytesIn': 0, 'resident': 0, 'loaded': 0,
+                 'affinity': 0, 'workers': {}, 'imbalance': 0, 'tail': {}}
+        self.wpStats = stats
+        self.inflight, self.overdue, self.orphans = {}, set(), []
+        tStart = time.time()
+
+        # Queue every Work Package for the Worker that holds most of its
+        # bodies (the key is *None* if there is no such Worker).
+        t0 = time.time()
+        pending = dict(all_WPs)
+        queues = self._assignWorkPackages(all_WPs)
+        stats['dispatch'] += time.time() - t0
+
+        while len(pending) > 0:
+            # Send Work Packages to all Workers with free capacity.
+            t0 = time.time()
+            self._dispatchWorkPackages(pending, queues)
+            stats['dispatch'] += time.time() - t0
+
+            # Send the overdue Work Packages to other Workers as well.
+            overdue, deadline = self._checkDeadlines(pending)
+            if len(overdue) > 0:
+                queues[None].extend(overdue)
+                stats['speculative'] += len(overdue)
+                continue
+
+            # Wait for the next message, but not beyond the next deadline.
+            timeout = max(0, int(1000 * (deadline - time.time())))
+            if self.sock.poll(timeout) != 0:
+                # Process all messages that have arrived.
+                t0 = time.time()
+                while self.sock.poll(0) != 0:
+                    self._handleWorkerMessage(pending)
+                stats['collect'] += time.time() - t0
+
+            # Queue the unfinished Work Packages of dead Workers first.
+            self._checkAgents()
+            orphans = [_ for _ in self.orphans if _ in pending]
+            queues[None].extendleft(reversed(orphans))
+            stats['orphans'] += len(orphans)
+            self.orphans.clear()
+
+        num = stats['resident'] + stats['loaded']
+        if num > 0:
+            stats['affinity'] = stats['resident'] / num
+        cost = [_['cost'] for _ in stats['workers'].values()]
+        if sum(cost) > 0:
+            stats['imbalance'] = max(cost) / np.mean(cost)
+
+        # Percentiles of the duration of this method.
+        self.wpGather.append(time.time() - tStart)
+        pct = (50, 90, 99)
+        tail = np.percentile(np.array(self.wpGather), pct).tolist()
+        stats['tail'] = dict(zip(pct, tail))
+
+    def _assignWorkPackages(self, all_WPs: dict):
+        """
+        Return the wpids in ``all_WPs`` grouped by their preferred Worker.
+
+        The preferred Worker of a Work Package is the one that holds most of
+        its bodies. This method also tells the Workers to forget the bodies
+        that do not exist anymore.
+
+        :param dict all_WPs: {wpid: wp} (see ``createWorkPackage``).
+        :return: {ident: deque(wpids)} (the ident is *None* for all Work
+                 Packages without a preferred Worker).
+        :rtype: dict
+        """
+        store = self.allBodies
+        slotIDs = np.array(store.slotIDs, object)
+
+        # Map every slot to the index of the Worker that holds it (or -1).
+        idents = list(self.residency)
+        where = np.full(len(slotIDs), -1, np.int64)
+        for idx, ident in enumerate(idents):
+            res = self.residency[ident]
+            res.resize(len(slotIDs))
+
+            # Forget the bodies that were removed (their slots are empty or
+            # hold another body by now).
+            known = np.not_equal(res.owner, None)
+            stale = known & (res.owner != slotIDs)
+            res.drop.update(res.owner[stale].tolist())
+            res.owner[stale] = None
+            where[known & ~stale] = idx
+
+        queues = {None: deque()}
+        self.wpSlots = {}
+        for wpid, wp in all_WPs.items():
+            slots = store.indices(wp['aids'])
+            self.wpSlots[wpid] = slots
+            owners = where[slots]
+            owners = owners[owners >= 0]
+            if len(owners) == 0:
+                ident = None
+            else:
+                ident = idents[np.bincount(owners).argmax()]
+            queues.setdefault(ident, deque()).append(wpid)
+        return queues
+
+    def _nextWorkPackage(self, ident: bytes, pending: dict, queues: dict):
+        """
+        Return the next Work Package for Worker ``ident`` (or *None*).
+
+        Workers prefer their own Work Packages, then those without a
+        preferred Worker, and then those whose preferred Worker is busy (or
+        blacklisted). Workers never receive a Work Package they already
+        have.
+
+        :param bytes ident: ZeroMQ identity of Worker.
+        :param dict pending: {wpid: wp} of unfinished WPs.
+        :param dict queues: the unsent wpids, grouped by preferred Worker.
+        :return: wpid
+        """
+        idle = {k for k in queues if self.workers.get(k, 0) == 0}
+        busy = [k for k in queues
+                if k is not None and (k in idle or k in self.blacklist)]
+        mine = self.inflight.get(ident, {})
+        for key in [ident, None] + busy:
+            queue, skipped = queues.get(key, deque()), []
+            while len(queue) > 0:
+                wpid = queue.popleft()
+                if wpid not in pending:
+                    continue
+                if wpid in mine:
+                    skipped.append(wpid)
+                    continue
+                queue.extendleft(reversed(skipped))
+                return wpid
+            queue.extendleft(reversed(skipped))
+        return None
+
+    def _eligibleWorkers(self):
+        """
+        Return the Workers that are not blacklisted.
+
+        Blacklisted Workers are eligible again after ``wpBlacklistTime``
+        seconds, or if all Workers are blacklisted.
+
+        :return: ZeroMQ identities of Workers.
+        :rtype: list
+        """
+        now = time.time()
+        for ident, until in list(self.blacklist.items()):
+            if until < now or ident not in self.workers:
+                del self.blacklist[ident]
+        out = [_ for _ in self.workers if _ not in self.blacklist]
+        return out if len(out) > 0 else list(self.workers)
+
+    def _dispatchWorkPackages(self, pending: dict, queues: dict):
+        """
+        Send the queued Work Packages to the Workers in a round robin.
+
+        :param dict pending: {wpid: wp} of unfinished WPs.
+        :param dict queues: the unsent wpids, grouped by preferred Worker.
+        """
+        while True:
+            idle = [_ for _ in self._eligibleWorkers() if self.workers[_] > 0]
+            sent = False
+            for ident in idle:
+                wpid = self._nextWorkPackage(ident, pending, queues)
+                if wpid is None:
+                    continue
+
+                # Compile the Work Package for this particular Worker, and
+                # send its arrays without copying them.
+                t0 = time.time()
+                frames = self._encodeWorkPackage(ident, pending[wpid])
+                self.wpStats['encode'] += time.time() - t0
+                try:
+                    msg = [ident, b'wp'] + frames
+                    self.sock.send_multipart(msg, zmq.NOBLOCK, copy=False)
+                except zmq.error.Again:
+                    # The Worker cannot keep up. It does not hold the bodies
+                    # of the Work Package either.
+                    self.workers[ident] = 0
+                    self.residency[ident].forget(self.wpSlots[wpid])
+                    queues[None].appendleft(wpid)
+                    continue
+                except zmq.error.ZMQError:
+                    # The Worker is gone.
+                    self._removeWorker(ident)
+                    queues[None].appendleft(wpid)
+                    continue
+                # Record when the Work Package was sent, its cost, and the
+                # cost of all Work Packages the Worker must process before it
+                # is done with this one.
+                self.workers[ident] -= 1
+                mine = self.inflight.setdefault(ident, {})
+                self._workerLoad(ident, pending[wpid])
+                cost = pending[wpid].get('cost', len(pending[wpid]['aids']))
+                work = cost + sum(_[1] for _ in mine.values())
+                mine[wpid] = (pending[wpid]['sent'], cost, work)
+                self.wpStats['bytesOut'] += len(frames[0])
+                self.wpStats['bytesOut'] += sum(_.nbytes for _ in frames[1:])
+                sent = True
+            if not sent:
+                break
+
+    def _checkDeadlines(self, pending: dict):
+        """
+        Return the overdue Work Packages and the next deadline.
+
+        A Work Package is due once the Worker had ``wpSlack`` times the
+        expected time to process it, and all the Work Packages it received
+        before (see ``_dispatchWorkPackages``). Every overdue Work Package
+        counts as a strike against its Worker.
+
+        :param dict pending: {wpid: wp} of unfinished WPs.
+        :return: (wpids, deadline) where the deadline is a Unix time.
+        :rtype: tuple
+        """
+        now = time.time()
+        overdue, deadline = [], now + self.wpTimeout
+        for ident, mine in list(self.inflight.items()):
+            for wpid, (sent, cost, work) in mine.items():
+                if wpid not in pending or (ident, wpid) in self.overdue:
+                    continue
+                due = sent + self._allowance(work)
+                if due > now:
+                    deadline = min(deadline, due)
+                    continue
+                self.overdue.add((ident, wpid))
+                self._strike(ident)
+                if wpid not in overdue:
+                    overdue.append(wpid)
+        return overdue, deadline
+
+    def _allowance(self, cost: (int, float)):
+        """
+        Return the time a Worker may take for Work Packages with ``cost``.
+
+        :param float cost: total cost.
+        :return: time in seconds.
+        :rtype: float
+        """
+        if self.wpRate is None:
+            return self.wpTimeout
+        allowance = self.wpSlack * self.wpRate * cost
+        return min(max(allowance, self.wpMinDeadline), self.wpTimeout)
+
+    def _strike(self, ident: bytes):
+        """
+        Blacklist Worker ``ident`` once it missed too many deadlines.
+
+        :param bytes ident: ZeroMQ identity of Worker.
+        """
+        num = self.strikes.get(ident, 0) + 1
+        if num < self.wpMaxStrikes:
+            self.strikes[ident] = num
+            return
+        self.strikes.pop(ident, None)
+        self.blacklist[ident] = time.time() + self.wpBlacklistTime
+        self.logit.warning('Blacklisted slow Worker <{}>'.format(ident))
+
+    def _workerLoad(self, ident: bytes, wp: dict=None):
+        """
+        Return the load statistics of Worker ``ident``.
+
+        Add the Work Package ``wp`` to them, and record when it was sent.
+
+        :param bytes ident: ZeroMQ identity of Worker.
+        :param dict wp: Work Package (see ``createWorkPackage``).
+        :return: the statistics (see ``processWorkPackages``).
+        :rtype: dict
+        """
+        load = self.wpStats['workers'].setdefault(
+            ident, {'wps': 0, 'bodies': 0, 'cost': 0, 'time': 0})
+        if wp is not None:
+            load['wps'] += 1
+            load['bodies'] += len(wp['aids'])
+            load['cost'] += wp.get('cost', len(wp['aids']))
+            wp['sent'] = time.time()
+        return load
+
+    def _encodeWorkPackage(self, ident: bytes, wp: dict):
+        """
+        Return the ZeroMQ frames of ``wp`` for Worker ``ident``.
+
+        The Work Package contains the state of all bodies that the Worker
+        does not hold yet, or that have changed since Leonard last received
+        them from that Worker (eg because of user commands). For all other
+        bodies it only contains the forces. The bodies that move to this
+        Worker are dropped from all other Workers.
+
+        :param bytes ident: ZeroMQ identity of Worker.
+        :param dict wp: Work Package (see ``createWorkPackage``).
+        :return: frames (see ``wpcodec.encodeWorkPackage``).
+        :rtype: list
+        """
+        store, res = self.allBodies, self.residency[ident]
+        slots, state = self.wpSlots[wp['wpid']], wp['state']
+        aids = np.array(wp['aids'], object)
+        res.resize(len(store.slotIDs))
+
+        # Determine the bodies that the Worker holds in their current state.
+        resident = (res.owner[slots] == aids) & ~store.dirty[slots]
+        resident &= np.all(res.rows[slots] == state, axis=1)
+        load, keep = np.flatnonzero(~resident), np.flatnonzero(resident)
+        order = np.concatenate((load, keep))
+
+        # Only one Worker can hold a body.
+        for other, tmp in self.residency.items():
+            if other != ident:
+                tmp.forget(slots[load])
+
+        # The state of all bodies in the Worker is unknown until the result
+        # arrives (the rows are NaN and thus never match).
+        res.owner[slots] = aids
+        res.rows[slots] = np.nan
+
+        msg = {
+            'wpid': wp['wpid'],
+            'wpmeta': wp['wpmeta'],
+            'aids': aids[order].tolist(),
+            'cshapes': [wp['cshapes'][_] for _ in load.tolist()],
+            'state': state[load],
+            'forces': wp['forces'][order],
+            'wpconstraints': wp['wpconstraints'],
+            'drop': list(res.drop),
+        }
+        res.drop.clear()
+        self.wpStats['resident'] += len(keep)
+        self.wpStats['loaded'] += len(load)
+        return wpcodec.encodeWorkPackage(msg)
+
+    def _removeWorker(self, ident: bytes, dead: bool=True):
+        """
+        Forget Worker ``ident`` and the bodies it holds.
+
+        If the Worker is ``dead`` then its unfinished Work Packages become
+        orphans, and ``processWorkPackages`` sends them to other Workers.
+
+        :param bytes ident: ZeroMQ identity of Worker.
+        :param bool dead: the Worker will not return any more results.
+        """
+        self.workers.pop(ident, None)
+        self.residency.pop(ident, None)
+        if dead:
+            self.orphans.extend(self.inflight.pop(ident, ()))
+
+    def pollWorkers(self):
+        """
+        Process all pending messages from the Workers and agents.
+
+        This registers new Workers and agents, and handles the heartbeats
+        between the steps, ie when there are no Work Packages to process.
+        """
+        while self.sock.poll(0) != 0:
+            self._handleWorkerMessage({})
+        self._checkAgents()
+
+    def _handleHeartbeat(self, ident: bytes, beat: dict):
+        """
+        Process the heartbeat ``beat`` of agent ``ident`` and reply to it.
+
+        The heartbeat lists the live Workers of the agent. Leonard removes
+        the Workers that are not in the list anymore. The reply contains the
+        number of Workers Leonard wants from this agent.
+
+        :param bytes ident: ZeroMQ identity of agent.
+        :param dict beat: {'name': str, 'workers': [str], 'min': int,
+                          'max': int} (see ``WorkerAgent``).
+        """
+        agent = self.agents.get(ident)
+        if agent is None:
+            msg = 'Worker agent <{}> registered'.format(beat['name'])
+            self.logit.info(msg)
+            agent = {'name': beat['name'], 'workers': set(),
+                     'target': beat['min']}
+            self.agents[ident] = agent
+
+        # The Workers the agent does not list anymore are dead.
+        workers = {_.encode('utf8') for _ in beat['workers']}
+        for worker in agent['workers'] - workers:
+            self._removeWorker(worker)
+        agent.update(seen=time.time(), workers=workers,
+                     min=beat['min'], max=beat['max'])
+
+        # The agent may have quit already (eg after its last heartbeat). The
+        # timeout will remove it.
+        target = str(agent['target']).encode('utf8')
+        try:
+            self.sock.send_multipart([ident, b'fleet', target], zmq.NOBLOCK)
+        except zmq.error.ZMQError:
+            pass
+
+    def _checkAgents(self):
+        """
+        Remove the agents whose heartbeat stopped, and all their Workers.
+        """
+        now = time.time()
+        for ident, agent in list(self.agents.items()):
+            if now - agent['seen'] <= self.agentTimeout:
+                continue
+            msg = 'Worker agent <{}> timed out'.format(agent['name'])
+            self.logit.warning(msg)
+            for worker in agent['workers']:
+                self._removeWorker(worker)
+            del self.agents[ident]
+
+    def scaleFleet(self):
+        """
+        Adjust the number of Workers to the duration of the last tick.
+
+        The load is the moving average of the tick duration relative to the
+        ``stepinterval`` of the scheduler. Add a Worker if the load exceeds
+        ``fleetGrow`` (ie the ticks overrun), and remove one if it is below
+        ``fleetShrink``. The minimum and maximum number of Workers of all
+        agents bound the size of the fleet. Every agent receives its share
+        with the reply to its next heartbeat.
+
+        :return: the number of Workers for every agent.
+        :rtype: dict
+        """
+        sched = self.scheduler
+        load = sched.stats['duration'] / sched.stepinterval
+        self.fleetLoad += 0.2 * (load - self.fleetLoad)
+        if len(self.agents) == 0:
+            return {}
+
+        # Grow or shrink the fleet, but give every change time to take
+        # effect.
+        size = self.fleetSize
+        if self.fleetWait > 0:
+            self.fleetWait -= 1
+        elif self.fleetLoad > self.fleetGrow:
+            size += 1
+        elif self.fleetLoad < self.fleetShrink:
+            size -= 1
+        lo = sum(_['min'] for _ in self.agents.values())
+        hi = sum(_['max'] for _ in self.agents.values())
+        size = int(np.clip(size, lo, max(lo, hi)))
+        if size != self.fleetSize:
+            self.fleetWait = self.fleetHold
+            self.fleetSize = size
+
+        # Every agent runs its minimum number of Workers. Distribute the
+        # others in a round robin.
+        agents = sorted(self.agents.items(), key=lambda _: _[1]['name'])
+        target = {k: v['min'] for k, v in agents}
+        extra = size - sum(target.values())
+        while extra > 0:
+            room = [k for k, v in agents if target[k] < v['max']][:extra]
+            if len(room) == 0:
+                break
+            for ident in room:
+                target[ident] += 1
+            extra -= len(room)
+        for ident, agent in agents:
+            agent['target'] = target[ident]
+        return target
+
+    def _handleWorkerMessage(self, pending: dict):
+        """
+        Receive and process one message from a Worker.
+
+        :param dict pending: {wpid: wp} of unfinished WPs.
+        """
+        ident, kind, *payload = self.sock.recv_multipart(copy=False)
+        ident, kind = ident.bytes, kind.bytes
+        if kind == b'ready':
+            # A new Worker announced its capacity. It holds no bodies yet.
+            self.workers[ident] = int(payload[0].bytes)
+            self.residency[ident] = _WorkerResidency()
+        elif kind == b'bye':
+            # The Worker wants to quit. It will finish the WPs it already
+            # has, and then exit once it receives our reply.
+            self._removeWorker(ident, dead=False)
+            self.sock.send_multipart([ident, b'bye'])
+        elif kind == b'agent':
+            beat = json.loads(payload[0].bytes.decode('utf8'))
+            self._handleHeartbeat(ident, beat)
+        elif kind == b'result':
+            if ident in self.workers:
+                self.workers[ident] += 1
+            frames = [_.buffer for _ in payload]
+            self.wpStats['bytesIn'] += sum(len(_) for _ in payload)
+            wpid, res = wpcodec.resultID(frames), self.residency.get(ident)
+            sent = self.inflight.get(ident, {}).pop(wpid, None)
+
+            # Ignore the result without decoding it if its Work Package is
+            # not pending anymore (most likely because multiple Workers
+            # processed the same Work Package and one of the others already
+            # returned it). The Worker does not hold the same bodies as
+            # Leonard in that case.
+            if wpid not in pending:
+                self.wpStats['duplicates'] += 1
+                if res is not None and wpid in self.wpSlots:
+                    res.forget(self.wpSlots[wpid])
+                return
+
+            # Decode the result. Its state array uses the memory of the
+            # ZeroMQ frame.
+            t0 = time.time()
+            msg = wpcodec.decodeResult(frames)
+            self.wpStats['decode'] += time.time() - t0
+
+            self.updateLocalCache(msg['aids'], msg['state'], msg['collisions'])
+            if res is not None:
+                res.update(self.allBodies, self.wpSlots[wpid])
+            wp = pending.pop(wpid)
+            elapsed = time.time() - wp['sent']
+            if sent is not None:
+                elapsed = time.time() - sent[0]
+
+                # Update the expected time per unit of cost, and forgive the
+                # Worker its strikes if it met the deadline.
+                rate = elapsed / max(sent[2], 1E-9)
+                if self.wpRate is None:
+                    self.wpRate = rate
+                self.wpRate += 0.1 * (rate - self.wpRate)
+                if (ident, wpid) not in self.overdue:
+                    self.strikes.pop(ident, None)
+            self._workerLoad(ident)['time'] += elapsed
+        else:
+            self.logit.warning('Unknown Worker message <{}>'.format(kind))
+
     @typecheck
     def createWorkPackage(self, objIDs: (tuple, list),
-                          dt: (int, float), maxsteps: int):
+                          dt: (int, float), maxsteps: int,
+                          forces: dict=None):
         """
-        Create a new Work Package (WP) and return its ID.
-
-        The Work Package will not be returned but uploaded to the DB directly.
+        Create a new Work Package (WP) and return it.
 
         A Work Package carries the necessary information for another rigid body
-        physics steps. The Worker can thus start its work immediately, at least
-        in terms of the rigid bodies (it may still want to incorporate other
-        data like grid forces, but that is up to the Worker implementation).
+        physics steps. The Worker can thus start its work immediately. In
+        particular, the forces already include the grid forces.
+
+        The numeric state of the bodies and their forces are in the 'state'
+        and 'forces' arrays (one row per body in 'aids' order, see
+        ``azrael.wpcodec``), and their collision shapes in the 'cshapes'
+        list. Use ``wpcodec.unpackBodies`` to convert them to ``WPDataOut``
+        tuples.
+
+        The Work Package contains all bodies, even those that a Worker may
+        already hold (see ``_encodeWorkPackage``).
 
         The ``dt`` and ``maxsteps`` arguments are for the underlying physics
         engine.
 
+        The optional ``forces`` argument contains the total force and torque
+        of (at least) all ``objIDs``, usually from ``compileForces``. This
+        avoids one force computation (and grid query) per Work Package when
+        the caller creates many of them.
+
         :param iterable objIDs: list of object IDs in the new work package.
         :param float dt: time step for this work package.
         :param int maxsteps: number of sub-steps for the time step.
-        :return: Work package ID
-        :rtype: int
+        :param dict forces: {objID: (force, torque)}
+        :return: Work package.
+        :rtype: dict
         """
         # Sanity check.
         if len(objIDs) == 0:
             return RetVal(False, 'Work package is empty', None)
 
-        # Compile the Body States and forces into a list of ``WPDataOut`` tuples.
+        # Compile the body states and forces into the state array.
+        store = self.allBodies
         try:
-            wpdata = []
-            for objID in objIDs:
-                body = self.allBodies[objID]
-                force, torque = self.totalForceAndTorque(objID)
-                wpdata.append(WPDataOut(objID, body, force, torque))
+            slots = store.indices(objIDs)
+            if forces is None:
+                force, torque = self.forcesAndTorques(objIDs, grid=True)
+            else:
+                ft = [forces[_] for _ in objIDs]
+                force = np.array([_[0] for _ in ft], np.float64)
+                torque = np.array([_[1] for _ in ft], np.float64)
         except KeyError:
             return RetVal(False, 'Cannot compile WP', None)
+        state = wpcodec.packState(store, slots)
+        cshapes = [store.cshapes[_] for _ in slots.tolist()]
+        forces = np.hstack((force.reshape(-1, 3), torque.reshape(-1, 3)))
 
         # Query all constraints.
         constraints = self.igor.getConstraints(objIDs).data
@@ -1148,31 +4837,37 @@ class LeonardDistributedZeroMQ(LeonardBase):
         # Form the content of the Work Package as it will appear in the DB.
         data = {'wpid': self.wpid_counter,
                 'wpmeta': (self.wpid_counter, dt, maxsteps),
-                'wpdata': wpdata,
+                'aids': list(objIDs),
+                'cshapes': cshapes,
+                'state': state,
+                'forces': forces,
                 'wpconstraints': constraints,
+                'drop': [],
                 'ts': None}
         self.wpid_counter += 1
         return RetVal(True, None, data)
 
-    def updateLocalCache(self, wp_data_ret, collisions):
+    def updateLocalCache(self, aids: list, state: np.ndarray, collisions):
         """
-        Copy every object from ``wp_data_ret`` to the local cache.
-
-        The ``wp_data_ret`` argument is a list of (objID, body) tuples.
+        Copy the new motion ``state`` of all ``aids`` to the local cache.
 
-        The implicit assumption of this method is that ``wpdata`` is the
-        output of ``computePhysicsForWorkPackage`` from a Worker.
+        The ``state`` argument has one row per body and the columns of
+        ``wpcodec.retLayout``. The implicit assumption of this method is that
+        it is the output of ``computePhysicsForWorkPackage`` from a Worker.
 
         This method will also publish all `collisions`, the format of which is
         determined entirely by `PyBulletDynamicsWorld.getLastContacts`.
 
-        :param list[Wp_data_ret] wp_data_ret: data returned by Minion.
+        :param list aids: the IDs of the bodies in ``state``.
+        :param ndarray state: the new motion state of the bodies.
         :param list collisions: collisions to publish.
         """
-        # Reset force and torque for all objects in the WP, and overwrite
-        # the old Body States with the new one from the processed WP.
-        for wp in wp_data_ret:
-            self.allBodies[wp.aid] = _RigidBodyData(*wp.body)
+        # Overwrite the motion state of all bodies at once. The Workers do
+        # not modify the other fields.
+        store = self.allBodies
+        slots = store.indices(aids)
+        for name in store.motionFields:
+            getattr(store, name)[slots] = state[:, wpcodec.retLayout[name]]
 
         # Extend the list of collision contacts if any were provided.
         if (collisions is not None) and len(collisions) > 0:
@@ -1183,12 +4878,34 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
     """
     Dedicated Worker to process Work Packages.
 
+    The Worker tells Leonard how many Work Packages it can hold at once
+    (``capacity``). Leonard may therefore send several of them before the
+    Worker returns the first result.
+
+    The Worker keeps all bodies in its Bullet engine until Leonard tells it
+    to drop them. Work Packages therefore only contain the state of new and
+    modified bodies, and the results only contain the bodies that moved.
+
     :param int workerID: the ID of this worker.
     :param int stepsUntilQuit: Worker will restart after this many steps.
+    :param int capacity: maximum number of Work Packages in flight.
+    :param str addr: Leonard's address (defaults to the Leonard service in
+                     ``config``).
+    :param bytes identity: ZeroMQ identity of the Worker (defaults to a
+                           random one). ``WorkerAgent`` uses it to report
+                           the Worker to Leonard.
     """
-    def __init__(self, workerID, stepsUntilQuit: int):
+    def __init__(self, workerID, stepsUntilQuit: int, capacity: int=4,
+                 addr: str=None, identity: bytes=None):
         super().__init__()
         self.workerID = workerID
+        assert capacity > 0
+        self.capacity = capacity
+        if addr is None:
+            host = config.azService['leonard']
+            addr = 'tcp://{}:{}'.format(host.ip, host.port)
+        self.addr = addr
+        self.identity = identity
 
         # After ``stepsUntilQuit`` this Worker will spawn a new Worker with the
         # same ID and quit.
@@ -1199,33 +4916,9 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         engine = azrael.bullet_api.PyBulletDynamicsWorld
         self.bullet = engine(self.workerID)
 
-    def getGridForces(self, idPos: dict):
-        """
-        Return dictionary of force values for every object in ``idPos``.
-
-        The ``idPos`` argument is a {objID_1: body_1, objID_2, body_2, ...}
-        dictionary.
-
-        The returned dictionary has the same keys as ``idPos``.
-
-        :param dict idPos: dictionary with objIDs and corresponding body data.
-        :return dict: {objID_k: force_k}
-        """
-        # Convenience.
-        vg = azrael.vectorgrid
-
-        # Extract the keys and values in the same order.
-        objIDs = list(idPos.keys())
-        positions = [idPos[_] for _ in objIDs]
-
-        # Query the grid values at all positions.
-        ret = vg.getValues('force', positions)
-        if not ret.ok:
-            return RetVal(False, ret.msg, None)
-
-        # Overwrite the default values with whatever ...
-        gridForces = {objID: val for objID, val in zip(objIDs, ret.data)}
-        return RetVal(True, None, gridForces)
+        # The motion state of all bodies in the Bullet engine, as Leonard
+        # knows it (see ``wpcodec.retLayout``).
+        self.motion = {}
 
     def computePhysicsForWorkPackage(self, wp):
         """
@@ -1234,47 +4927,51 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         The output of this method is matched to the ``updateLocalCache`` in
         Leonard itself.
 
+        The result only contains the bodies whose motion state changed.
+
         :param dict wp: Work Package content from ``createWorkPackage``.
-        :return dict: {'wpdata': list_of_bodies, 'wpid': wpid}
+        :return dict: {'wpid': wpid, 'aids': objIDs, 'state': motion state,
+                       'collisions': collisions}
         """
-        worklist, meta = wp['wpdata'], WPMeta(*wp['wpmeta'])
-        constraints = wp['wpconstraints']
+        worklist = wpcodec.unpackBodies(wp)
+        meta, constraints = WPMeta(*wp['wpmeta']), wp['wpconstraints']
+        IDs = wp['aids']
 
         # Log the number of collision-sets in the current Work Package.
-        util.logMetricQty('Engine_{}'.format(self.workerID), len(worklist))
-
-        # Convenience: the WPDataOut elements make the code more readable.
-        worklist = [WPDataOut(*_) for _ in worklist]
+        util.logMetricQty('Engine_{}'.format(self.workerID), len(IDs))
 
         # Convenience.
         applyForceAndTorque = self.bullet.applyForceAndTorque
         setRB = self.bullet.setRigidBodyData
+        layout = wpcodec.retLayout
 
-        # Add every object to the Bullet engine and set the force/torque.
+        # Load the new and modified objects into Bullet and set the
+        # force/torque of all of them.
         with util.Timeit('Worker:1.1.0  applyforce'):
-            with util.Timeit('Worker:1.1.1   grid'):
-                # Fetch the grid force for all object positions.
-                idPos = {_.aid: _.rbs.position for _ in worklist}
-                ret = self.getGridForces(idPos)
-                if not ret.ok:
-                    self.logit.info(ret.msg)
-                    z = np.float64(0)
-                    gridForces = {_: z for _ in idPos}
-                else:
-                    gridForces = ret.data
-                del ret, idPos
-
             with util.Timeit('Worker:1.1.1   updateGeo'):
+                # Forget the bodies that Leonard removed or sent to another
+                # Worker.
+                self.bullet.removeRigidBody(wp['drop'])
+                for aid in wp['drop']:
+                    self.motion.pop(aid, None)
+
+                # Only the first ``len(worklist)`` bodies have a state. The
+                # Bullet engine already holds the others.
                 for obj in worklist:
-                    # Load all objects into Bullet.
                     setRB(obj.aid, obj.rbs)
+                state = wp['state']
+                state = np.hstack([state[:, wpcodec.wpLayout[_]]
+                                   for _ in layout])
+                self.motion.update(zip(IDs, state))
 
             with util.Timeit('Worker:1.1.1   updateForce'):
-                for obj in worklist:
-                    # Tally up and apply the combined grid + user specified
-                    # force for each object.
-                    force = obj.force + gridForces[obj.aid]
-                    applyForceAndTorque(obj.aid, force, obj.torque)
+                # Apply the total force. Leonard already added the grid
+                # force to it.
+                forces = wp['forces']
+                force = forces[:, wpcodec.forceLayout['force']].tolist()
+                torque = forces[:, wpcodec.forceLayout['torque']].tolist()
+                for aid, f, t in zip(IDs, force, torque):
+                    applyForceAndTorque(aid, f, t)
 
         # Apply all constraints. Log any errors but ignore them otherwise as
         # they are harmless (simply means no constraints were applied).
@@ -1285,7 +4982,6 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         # Tell Bullet to advance the simulation for all objects in the
         # current work list.
         with util.Timeit('Worker:1.2.0  compute'):
-            IDs = [_.aid for _ in worklist]
             self.bullet.compute(IDs, meta.dt, meta.maxsteps)
 
             # Remove all constraints.
@@ -1295,26 +4991,32 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         collisions = self.bullet.getLastContacts().data
 
         with util.Timeit('Worker:1.3.0  fetchFromBullet'):
-            # Compile the new state variables into a list. This list will be
-            # sent back to the caller later on.
-            out = []
-            for obj in worklist:
-                ret = self.bullet.getRigidBodyData(obj.aid)
+            # Compile the new motion state into an array. It will be sent
+            # back to the caller later on.
+            old = [self.motion[_] for _ in IDs]
+            old = np.array(old, np.float64).reshape(-1, wpcodec.retWidth)
+            state = old.copy()
+            for idx, aid in enumerate(IDs):
+                ret = self.bullet.getRigidBodyData(aid)
                 if ret.ok is True:
-                    body = obj.rbs._replace(
-                        position=ret.data.position,
-                        rotation=ret.data.rotation,
-                        velocityLin=ret.data.vLin,
-                        velocityRot=ret.data.vRot
-                    )
+                    body = ret.data
+                    values = (body.position, body.rotation,
+                              body.vLin, body.vRot)
+                    for name, value in zip(layout, values):
+                        state[idx, layout[name]] = value
                 else:
                     # Something went wrong. Reuse the old body.
-                    body = obj.rbs
                     self.logit.error('Unable to get all objects from Bullet')
-                out.append(WPDataRet(obj.aid, body))
+
+            # Only return the bodies that moved.
+            changed = np.flatnonzero(np.any(state != old, axis=1)).tolist()
+            IDs = [IDs[_] for _ in changed]
+            state = state[changed]
+            self.motion.update(zip(IDs, state))
 
         # Return the updated WP data.
-        return {'wpid': meta.wpid, 'wpdata': out, 'collisions': collisions}
+        return {'wpid': meta.wpid, 'aids': IDs, 'state': state,
+                'collisions': collisions}
 
     def sighandler(self, signum, frame):
         """
@@ -1361,49 +5063,45 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
 
         # Setup ZeroMQ.
         ctx = zmq.Context()
-        sock = ctx.socket(zmq.REQ)
-        host = config.azService['leonard']
-        addr = 'tcp://{}:{}'.format(host.ip, host.port)
-        sock.connect(addr)
+        sock = ctx.socket(zmq.DEALER)
+        if self.identity is not None:
+            sock.setsockopt(zmq.IDENTITY, self.identity)
+        sock.connect(self.addr)
         self.logit.info(
-            'Worker {} connected to <{}>'.format(self.workerID, addr)
+            'Worker {} connected to <{}>'.format(self.workerID, self.addr)
         )
 
         # Store as instance variables for signal handler.
         self.ctx = ctx
         self.sock = sock
 
-        # Contact Leonard with an empty payload.
-        sock.send(b'')
+        # Tell Leonard how many Work Packages we can hold.
+        sock.send_multipart([b'ready', str(self.capacity).encode()])
 
-        # Wait for messages from Leonard. If they contain a WP then process
-        # it and return the result, otherwise reply with an empty message.
+        # Process the Work Packages from Leonard and return the results.
+        # Once we processed enough of them, ask Leonard for permission to
+        # quit. Leonard will not send any more Work Packages after its reply.
         numSteps = 0
         suq = self.stepsUntilQuit
-        while numSteps < suq:
+        while True:
             # Wait for the next message.
-            msg = sock.recv()
-
-            # If Leonard did not send a Work Package (probably because it
-            # does not have one right now) then wait for a short time
-            # before asking again to avoid spamming the network.
-            if msg == b'':
-                time.sleep(0.003)
-                sock.send(b'')
-                continue
-
-            # Unpickle the Work Package.
-            wpdata = pickle.loads(msg)
+            kind, *payload = sock.recv_multipart(copy=False)
+            if kind.bytes == b'bye':
+                break
 
-            # Process the Work Package.
+            # Decode and process the Work Package.
+            wpdata = wpcodec.decodeWorkPackage([_.buffer for _ in payload])
             with util.Timeit('Worker:1.0.0 WPTotal'):
                 wpdata = self.computePhysicsForWorkPackage(wpdata)
 
-            # Pack up the Work Package and send it back to Leonard.
-            sock.send(pickle.dumps(wpdata))
+            # Encode the result and send it back to Leonard.
+            frames = [b'result'] + wpcodec.encodeResult(wpdata)
+            sock.send_multipart(frames, copy=False)
 
             # Count the number of Work Packages we have processed.
             numSteps += 1
+            if numSteps == suq:
+                sock.send_multipart([b'bye'])
 
         # Log a last status message before terminating.
         msg = 'Worker {} terminated itself after {} steps'
@@ -1528,3 +5226,160 @@ class WorkerManager(config.AzraelProcess):
         while True:
             self.maintainFleet()
             time.sleep(0.25)
+
+
+class WorkerAgent(config.AzraelProcess):
+    """
+    Run Workers on this host for a (possibly remote) Leonard.
+
+    The agent connects to Leonard at ``addr`` and sends a heartbeat every
+    ``heartbeat`` seconds. The heartbeat lists the live Workers and the
+    minimum and maximum number of Workers this host can run. Leonard replies
+    with the number of Workers it wants (see
+    ``LeonardDistributedZeroMQ.scaleFleet``), and the agent starts or stops
+    Workers accordingly. Like ``WorkerManager`` it also replaces the Workers
+    that quit.
+
+    Leonard declares the Workers dead once the agent stops listing them, and
+    the agent with all its Workers once the heartbeats stop.
+
+    :param str name: name of the agent (should be unique, eg the host name).
+    :param str addr: Leonard's address, eg 'tcp://10.0.0.1:5556' (defaults
+                     to the Leonard service in ``config``).
+    :param int minWorkers: minimum number of Workers.
+    :param int maxWorkers: maximum number of Workers.
+    :param int minSteps: see ``WorkerManager``.
+    :param int maxSteps: see ``WorkerManager``.
+    :param class workerCls: the class to instantiate.
+    :param float heartbeat: seconds between heartbeats.
+    """
+    @typecheck
+    def __init__(self, name: str, addr: str=None, minWorkers: int=1,
+                 maxWorkers: int=4, minSteps: int=500, maxSteps: int=700,
+                 workerCls=LeonardWorkerZeroMQ, heartbeat: (int, float)=0.25):
+        super().__init__()
+
+        # Sanity checks.
+        assert 0 <= minWorkers <= maxWorkers
+        assert 0 < minSteps <= maxSteps
+        assert heartbeat > 0
+
+        # Backup the ctor arguments.
+        if addr is None:
+            host = config.azService['leonard']
+            addr = 'tcp://{}:{}'.format(host.ip, host.port)
+        self.name, self.addr = name, addr
+        self.minWorkers, self.maxWorkers = minWorkers, maxWorkers
+        self.minSteps, self.maxSteps = minSteps, maxSteps
+        self.workerCls = workerCls
+        self.heartbeat = heartbeat
+
+        # Handles to the Worker processes, keyed by their identity, and the
+        # number of Workers started so far.
+        self.workers = {}
+        self.numStarted = 0
+        self.ctx = self.sock = None
+
+    def maintainFleet(self, target: int):
+        """
+        Join all dead Workers, and start or stop Workers to run ``target``.
+
+        Stopping a Worker terminates it immediately. Leonard notices with
+        the next heartbeat and re-sends its unfinished Work Packages.
+
+        :param int target: number of Workers.
+        :return: the identities of the live Workers.
+        :rtype: list[str]
+        """
+        for ident, proc in list(self.workers.items()):
+            if not proc.is_alive():
+                proc.join()
+                del self.workers[ident]
+
+        # Stop the newest Workers first. Note: ``terminate`` would kill all
+        # Workers (see ``config.AzraelProcess``).
+        while len(self.workers) > target:
+            ident, proc = self.workers.popitem()
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.join()
+
+        # Start new Workers. Every Worker has a new identity.
+        while len(self.workers) < target:
+            self.numStarted += 1
+            ident = '{}/{}'.format(self.name, self.numStarted)
+            suq = np.random.randint(self.minSteps, self.maxSteps + 1)
+            proc = self.workerCls(self.numStarted, suq, addr=self.addr,
+                                  identity=ident.encode('utf8'))
+            proc.start()
+            self.workers[ident] = proc
+        return RetVal(True, None, list(self.workers))
+
+    def sendHeartbeat(self, workers: list):
+        """
+        Tell Leonard which ``workers`` are alive.
+
+        The heartbeat is lost if Leonard is unreachable.
+
+        :param list[str] workers: identities of the live Workers.
+        """
+        beat = {'name': self.name, 'workers': workers,
+                'min': self.minWorkers, 'max': self.maxWorkers}
+        try:
+            msg = [b'agent', json.dumps(beat).encode('utf8')]
+            self.sock.send_multipart(msg, zmq.NOBLOCK)
+        except zmq.error.Again:
+            pass
+
+    def sighandler(self, signum, frame):
+        """
+        Signal handler for SIGTERM.
+
+        Stop all Workers and tell Leonard about it before quitting.
+
+        See `signal module <https://docs.python.org/3/library/signal.html>`_
+        for the specific meaning of the arguments.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        msg = 'Agent <{}> intercepted signal {}'.format(self.name, signum)
+        self.logit.info(msg)
+        self.maintainFleet(0)
+        if self.sock is not None:
+            self.sendHeartbeat([])
+            self.sock.close(linger=100)
+            self.ctx.term()
+        sys.exit(0)
+
+    def run(self):
+        super().run()
+
+        # Install the signal handler to facilitate a clean shutdown
+        # (including the Worker processes).
+        signal.signal(signal.SIGTERM, self.sighandler)
+        signal.signal(signal.SIGINT, self.sighandler)
+
+        # Only queue heartbeats while connected to Leonard.
+        self.ctx = zmq.Context()
+        self.sock = self.ctx.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.IMMEDIATE, 1)
+        self.sock.connect(self.addr)
+        self.logit.info('Agent <{}> connected to <{}>'.format(
+            self.name, self.addr))
+
+        # Run the minimum number of Workers until Leonard asks for more.
+        target = self.minWorkers
+        while True:
+            ret = self.maintainFleet(target)
+            self.sendHeartbeat(ret.data)
+
+            # Process Leonard's replies until the next heartbeat is due.
+            deadline = time.time() + self.heartbeat
+            while True:
+                timeout = int(1000 * (deadline - time.time()))
+                if timeout <= 0 or self.sock.poll(timeout) == 0:
+                    break
+                kind, *payload = self.sock.recv_multipart()
+                if kind == b'fleet':
+                    target = int(payload[0])
+                    target = min(max(target, self.minWorkers),
+                                 self.maxWorkers)
@@ -19,6 +19,7 @@
 Convenience functions for testing and running Azrael.
 """
 
+import os
 import sys
 import time
 import logging
@@ -145,12 +146,15 @@ class AzraelStack:
         # leo = azrael.leonard.LeonardBullet()
         # leo = azrael.leonard.LeonardSweeping()
 
+        # Leonard sizes the Worker fleet to the load. Agents on other hosts
+        # may connect to it as well.
         leo = azrael.leonard.LeonardDistributedZeroMQ()
-        wm = azrael.leonard.WorkerManager(
-            numWorkers=3,
+        wm = azrael.leonard.WorkerAgent(
+            name='localhost',
+            minWorkers=1,
+            maxWorkers=max(1, os.cpu_count() or 1),
             minSteps=500,
             maxSteps=700,
-            workerCls=azrael.leonard.LeonardWorkerZeroMQ
         )
 
         # Start Clerk, WebServer, and Leonard.
@@ -20,10 +20,14 @@ This module does not contain any tests but utility functions often used in
 other tests.
 """
 import os
+import zmq
 import json
+import time
+import threading
 import subprocess
 import numpy as np
 import azrael.leonard
+import azrael.wpcodec as wpcodec
 
 from azrael.aztypes import FragMeta, Template
 from azrael.aztypes import CollShapeMeta, CollShapeEmpty, CollShapeSphere
@@ -225,3 +229,87 @@ def getTemplate(name='template',
         rbs = getRigidBody(cshapes={'cssphere': getCSSphere()})
 
     return Template(name, rbs, fragments, boosters, factories, custom)
+
+
+class FakeWorker(threading.Thread):
+    """
+    Emulate a Worker that processes the Work Packages from Leonard.
+
+    The Worker connects a DEALER socket to ``addr``, registers with
+    ``capacity`` and records every decoded Work Package in ``received``.
+    After ``delay`` seconds it returns a state where all bodies are at
+    ``value``, unless ``stall`` is *True*, in which case it never responds.
+    Pass ``update`` to compute the returned state from the Work Package
+    instead.
+
+    The Worker asks to quit along with its ``quitAfter``-th result. It stops
+    once Leonard says 'bye', or when the test calls ``stop``.
+
+    :param str addr: Leonard's address, eg 'tcp://127.0.0.1:5555'.
+    :param bytes identity: ZeroMQ identity of the Worker (optional).
+    :param int capacity: number of Work Packages the Worker accepts.
+    :param float delay: processing time per Work Package in seconds.
+    :param float value: position of all bodies in the returned state.
+    :param bool stall: never return a Work Package.
+    :param int quitAfter: ask to quit after this many Work Packages.
+    :param callable update: returns the state for a Work Package.
+    """
+    def __init__(self, addr, identity=None, capacity=4, delay=0, value=1,
+                 stall=False, quitAfter=None, update=None):
+        super().__init__(daemon=True)
+        self.addr = addr
+        self.identity = identity
+        self.capacity = capacity
+        self.delay = delay
+        self.value = value
+        self.stall = stall
+        self.quitAfter = quitAfter
+        self.update = update
+        self.received = []
+        self.done = threading.Event()
+
+    def stop(self):
+        """
+        Terminate the Worker (it finishes the current Work Package first).
+        """
+        self.done.set()
+
+    def wpids(self):
+        """
+        Return the IDs of all received Work Packages.
+        """
+        return [_['wpid'] for _ in self.received]
+
+    def run(self):
+        ctx = zmq.Context()
+        sock = ctx.socket(zmq.DEALER)
+        if self.identity is not None:
+            sock.setsockopt(zmq.IDENTITY, self.identity)
+        sock.connect(self.addr)
+        sock.send_multipart([b'ready', str(self.capacity).encode()])
+
+        while not self.done.is_set():
+            if sock.poll(50) == 0:
+                continue
+            kind, *payload = sock.recv_multipart()
+            if kind == b'bye':
+                break
+            wp = wpcodec.decodeWorkPackage(payload)
+            self.received.append(wp)
+            if self.stall:
+                continue
+
+            time.sleep(self.delay)
+            if self.update is None:
+                state = np.zeros((len(wp['aids']), wpcodec.retWidth))
+                state[:, wpcodec.retLayout['position']] = self.value
+                state[:, wpcodec.retLayout['rotation']] = [0, 0, 0, 1]
+            else:
+                state = self.update(wp)
+            ret = {'wpid': wp['wpid'], 'aids': wp['aids'],
+                   'state': state, 'collisions': []}
+            if len(self.received) == self.quitAfter:
+                sock.send_multipart([b'bye'])
+            sock.send_multipart([b'result'] + wpcodec.encodeResult(ret))
+        sock.close(linger=0)
+        ctx.term()
@@ -0,0 +1,203 @@
+# Copyright 2016, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+import pytest
+import numpy as np
+
+from IPython import embed as ipshell
+from azrael.bodystore import BodyStore
+from azrael.aztypes import RigidBodyData, Forces
+from azrael.test.test import getRigidBody, getCSBox, getCSSphere
+
+
+class TestBodyStore:
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def setup_method(self, method):
+        pass
+
+    def teardown_method(self, method):
+        pass
+
+    def test_dictionary_interface(self):
+        """
+        Add, query, modify and remove bodies like in a dictionary.
+        """
+        store = BodyStore()
+        assert len(store) == 0
+        assert '1' not in store
+        with pytest.raises(KeyError):
+            store['1']
+
+        # Add two bodies. The store must return equivalent RigidBodyData
+        # instances.
+        body_1 = getRigidBody(imass=2, position=[1, 2, 3],
+                              cshapes={'cs': getCSBox()})
+        body_2 = getRigidBody(velocityLin=[-1, 0, 1], version=3)
+        store['1'], store['2'] = body_1, body_2
+        assert len(store) == 2
+        assert list(store) == ['1', '2']
+        assert isinstance(store['1'], RigidBodyData)
+        assert store['1'] == body_1
+        assert store['2'] == body_2
+        assert store['1'].cshapes is body_1.cshapes
+        assert isinstance(store['2'].version, int)
+
+        # The fields are also available as arrays.
+        slots = store.indices()
+        assert np.array_equal(store.position[slots], [[1, 2, 3], [0, 0, 0]])
+        assert np.array_equal(store.imass[slots], [2, 1])
+        assert np.array_equal(store.indices(['2']), slots[1:])
+
+        # Modify individual fields, or replace the entire body.
+        store.setFields('1', position=(4, 5, 6), imass=3)
+        assert store['1'] == body_1._replace(position=(4, 5, 6), imass=3)
+        store['1'] = body_2
+        assert store['1'] == body_2
+        with pytest.raises(KeyError):
+            store.setFields('3', imass=3)
+
+        # Remove a body.
+        del store['1']
+        assert len(store) == 1
+        assert '1' not in store and '2' in store
+        assert store['2'] == body_2
+        assert dict(store) == {'2': body_2}
+
+    def test_forces_and_aabbs(self):
+        """
+        Query and update the forces and AABBs of the bodies.
+        """
+        store = BodyStore()
+        store['1'] = getRigidBody()
+        assert len(store.forces) == len(store.aabbs) == 1
+
+        # New bodies have no forces.
+        zero = [0, 0, 0]
+        assert store.forces['1'] == Forces(zero, zero, zero, zero)
+        assert store.aabbs['1'] is None
+
+        # Update the forces and AABBs.
+        force = Forces([1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12])
+        store.forces['1'] = force
+        assert store.forces['1'] == force
+        store.forces['1'] = store.forces['1']._replace(forceBoost=[0, 1, 0])
+        assert store.forces['1'].forceBoost == [0, 1, 0]
+        assert np.array_equal(store.forceDirect[store.indices()], [[1, 2, 3]])
+
+        aabbs = {'cs': [0, 0, 0, 1, 1, 1]}
+        store.aabbs['1'] = aabbs
+        assert store.aabbs['1'] is aabbs
+
+        # Forces and AABBs only exist for bodies.
+        with pytest.raises(KeyError):
+            store.forces['2'] = force
+        with pytest.raises(KeyError):
+            store.aabbs['2'] = aabbs
+
+        # Removing the body removes its forces and AABBs. A new body must not
+        # inherit them.
+        del store['1']
+        assert '1' not in store.forces and '1' not in store.aabbs
+        store['2'] = getRigidBody()
+        assert store.forces['2'] == Forces(zero, zero, zero, zero)
+        assert store.aabbs['2'] is None
+
+    def test_slot_reuse(self):
+        """
+        The store must re-use the slots of removed bodies and grow its arrays
+        on demand.
+        """
+        store = BodyStore()
+        bodies = {str(_): getRigidBody(position=[_, 0, 0]) for _ in range(50)}
+        for objID, body in bodies.items():
+            store[objID] = body
+        assert len(store) == 50
+        assert len(store.position) >= 50
+        assert dict(store) == bodies
+
+        # Remove every other body and add new ones. They must occupy the
+        # free slots.
+        capacity = len(store.position)
+        freed = set(store.indices([str(_) for _ in range(0, 50, 2)]).tolist())
+        for idx in range(0, 50, 2):
+            del store[str(idx)]
+            del bodies[str(idx)]
+        for idx in range(50, 75):
+            bodies[str(idx)] = getRigidBody(cshapes={'cs': getCSSphere()})
+            store[str(idx)] = bodies[str(idx)]
+        new = set(store.indices([str(_) for _ in range(50, 75)]).tolist())
+        assert new == freed
+        assert len(store.position) == capacity
+        assert dict(store) == bodies
+
+    def test_changed(self):
+        """
+        Track the bodies that changed since the last sync.
+        """
+        store = BodyStore()
+        store['1'], store['2'] = getRigidBody(), getRigidBody()
+        slot_1, slot_2 = store.indices(['1', '2']).tolist()
+
+        # New bodies are always dirty.
+        assert store.changed().tolist() == [slot_1, slot_2]
+        store.markSynced(store.changed())
+        assert len(store.changed()) == 0
+
+        # Small changes to the motion state only count if they exceed the
+        # threshold.
+        store.setFields('1', position=(0, 0, 1E-3))
+        assert store.changed(threshold=1E-2).tolist() == []
+        assert store.changed(threshold=1E-4).tolist() == [slot_1]
+
+        # The tolerance is relative to the last sync, ie small changes
+        # accumulate.
+        store.setFields('1', position=(0, 0, 2E-2))
+        assert store.changed(threshold=1E-2).tolist() == [slot_1]
+        store.markSynced(np.array([slot_1]))
+        assert store.changed().tolist() == []
+
+        # Any change to the other fields makes the body dirty.
+        store.setFields('2', imass=2)
+        assert store.changed(threshold=1).tolist() == [slot_2]
+        store.markSynced(np.array([slot_2]))
+
+        # A new body in the slot of a removed one must be dirty.
+        del store['2']
+        store['3'] = getRigidBody()
+        assert store.changed(threshold=1).tolist() == [slot_2]
+
+    def test_bodies(self):
+        """
+        Query many bodies at once.
+        """
+        store = BodyStore()
+        bodies = [getRigidBody(position=[_, 0, 0], version=_)
+                  for _ in range(5)]
+        for idx, body in enumerate(bodies):
+            store[str(idx)] = body
+
+        slots = store.indices(['3', '1'])
+        assert store.bodies(slots) == [bodies[3], bodies[1]]
+        assert store.bodies(slots) == [store['3'], store['1']]
+        assert isinstance(store.bodies(slots)[0].version, int)
+        assert store.bodies(slots[:0]) == []
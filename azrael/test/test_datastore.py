@@ -16,6 +16,7 @@
 # along with Azrael. If not, see <http://www.gnu.org/licenses/>.
 import copy
 import pytest
+import pymongo
 import unittest.mock as mock
 import azrael.datastore as datastore
 
@@ -496,6 +497,65 @@ class TestAllDatastoreBackends:
         }
         assert ret.data == ref
 
+    @pytest.mark.parametrize('clsDatabase', all_engines)
+    def test_modifyBulk(self, clsDatabase):
+        """
+        Modify several documents at once.
+        """
+        db = clsDatabase(name=('test1', 'test2'))
+
+        # Reset the database and verify that it is empty.
+        assert db.reset().ok and db.count().data == 0
+
+        # Insert three documents.
+        ops = {str(_): {'data': {'foo': {'a': _, 'b': 2}}} for _ in range(3)}
+        assert db.put(ops).ok
+
+        # Nothing to modify.
+        assert db.modifyBulk({}) == (True, None, 0)
+
+        # Modify two existing documents, one non-existing document, and one
+        # that does not match the 'exists' condition.
+        ops = {
+            '0': {'inc': {('foo', 'a'): 1}, 'set': {('foo', 'b'): 20},
+                  'unset': [], 'exists': {}},
+            '1': {'inc': {}, 'set': {}, 'unset': [('foo', 'b')],
+                  'exists': {('foo', 'b'): True}},
+            '2': {'inc': {}, 'set': {('foo', 'c'): 3}, 'unset': [],
+                  'exists': {('foo', 'c'): True}},
+            '3': {'inc': {}, 'set': {('foo', 'a'): 3}, 'unset': [],
+                  'exists': {}},
+        }
+        assert db.modifyBulk(ops) == (True, None, 2)
+
+        # Verify the documents.
+        ret = db.getAll()
+        assert ret.ok
+        assert ret.data == {
+            '0': {'foo': {'a': 1, 'b': 20}},
+            '1': {'foo': {'a': 1}},
+            '2': {'foo': {'a': 2, 'b': 2}},
+        }
+
+        # Invalid arguments.
+        assert not db.modifyBulk({'0': {'inc': {}}}).ok
+
+    def test_modifyBulk_error(self):
+        """
+        A failed bulk write must return an error instead of raising it.
+        """
+        db = datastore.DatastoreMongo(name=('test1', 'test2'))
+        assert db.reset().ok
+        assert db.put({'0': {'data': {'foo': 1}}}).ok
+
+        ops = {'0': {'inc': {}, 'set': {('foo',): 2}, 'unset': [],
+                     'exists': {}}}
+        err = pymongo.errors.BulkWriteError({'writeErrors': []})
+        with mock.patch.object(db.db, 'bulk_write') as m_bulk:
+            m_bulk.side_effect = err
+            assert not db.modifyBulk(ops).ok
+        assert m_bulk.call_count == 1
+
     @pytest.mark.parametrize('clsDatabase', all_engines)
     def test_atomic_counter(self, clsDatabase):
         """
@@ -15,12 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Azrael. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import pytest
 import numpy as np
+import unittest.mock as mock
 
 import azrael.datastore
 import azrael.leo_api as leoAPI
 
 from IPython import embed as ipshell
+from azrael.aztypes import RigidBodyData
 from azrael.test.test import getLeonard
 from azrael.test.test import getCSEmpty, getCSBox
 from azrael.test.test import getCSSphere, getCSPlane, getRigidBody
@@ -39,7 +43,7 @@ class TestLeonardAPI:
         azrael.datastore.init(flush=True)
 
     def teardown_method(self, method):
-        pass
+        leoAPI.setCommandChannel(None)
 
     def test_add_get_remove_single(self):
         """
@@ -121,21 +125,21 @@ class TestLeonardAPI:
         ret = leoAPI.dequeueCommands()
         assert ret.ok and (ret.data['spawn'] == [])
 
-        # Spawn the first object, then attempt to spawn another with the same
-        # objID *before* Leonard gets around to add even the first one --> this
-        # must fail and not add anything.
+        # Spawn the first object, then spawn another with the same objID
+        # *before* Leonard gets around to add even the first one --> the
+        # second command is redundant and must not show up.
         assert leoAPI.addCmdSpawn([(id_1, body_1)]).ok
-        assert not leoAPI.addCmdSpawn([(id_1, body_2)]).ok
+        assert leoAPI.addCmdSpawn([(id_1, body_2)]).ok
         ret = leoAPI.dequeueCommands()
         spawn = ret.data['spawn']
         assert ret.ok and (len(spawn) == 1) and (spawn[0]['objID'] == id_1)
+        assert RigidBodyData(**spawn[0]['rbs']) == body_1
 
         # Similar test as before, but this time Leonard has already pulled id_1
         # into the simulation *before* we (attempt to) spawn another object
         # with the same ID. The 'addSpawnCmd' must succeed because it cannot
-        # reliably verify if Leonard has an object id_1 (it can only verify if
-        # another such request is in the queue already -- see above). However,
-        # Leonard itself must ignore that request. To verify this claim we will
+        # reliably verify if Leonard has an object id_1. However, Leonard
+        # itself must ignore that request. To verify this claim we will
         # now spawn a new object with the same id_1 but a different state data,
         # let Leonard process the queue, and then verify that it did not
         # add/modify the object with id_1.
@@ -248,6 +252,180 @@ class TestLeonardAPI:
         assert len(ret.data['direct_force']) == 2
         assert len(ret.data['booster_force']) == 2
 
+    def test_commandLog(self):
+        """
+        Read the commands from the command log in sequence order.
+        """
+        force, torque = [1, 2, 3], [4, 5, 6]
+        for objID in ('1', '2', '3', '4'):
+            assert leoAPI.addCmdDirectForce(objID, force, torque).ok
+
+        # Read the commands in two batches.
+        db = azrael.datastore.getDSHandle('Commands')
+        ret = leoAPI.readCommands(maxcount=3)
+        assert ret.ok
+        assert [_['seq'] for _ in ret.data] == [1, 2, 3]
+        assert [_['objID'] for _ in ret.data] == ['1', '2', '3']
+        assert db.count().data == 0
+        ret = leoAPI.readCommands(maxcount=3)
+        assert [_['objID'] for _ in ret.data] == ['4']
+        assert leoAPI.readCommands().data == []
+
+        # Reserve a sequence number without writing the command (ie a
+        # producer is slow). Leonard must not receive any later commands
+        # until either the missing one arrives or the timeout expires.
+        counters = azrael.datastore.getDSHandle('Counters')
+        assert counters.incrementCounter('cmdseq', 1).data == 5
+        assert leoAPI.addCmdRemoveObject('6').ok
+        assert leoAPI.readCommands().data == []
+        ret = leoAPI.readCommands(gapTimeout=0)
+        assert [_['seq'] for _ in ret.data] == [6]
+        assert counters.getCounter('cmdread').data == 6
+
+        # The slow producer writes the missing command after all. It must
+        # not remain in the log forever, but arrive with the next read.
+        doc = {'cmd': 'remove', 'objID': '5', 'seq': 5}
+        assert db.put({'5': {'data': doc}}).ok
+        assert leoAPI.addCmdRemoveObject('7').ok
+        ret = leoAPI.readCommands()
+        assert [_['seq'] for _ in ret.data] == [5, 7]
+        assert db.count().data == 0
+
+        # A restarted reader resumes at the read position in the datastore.
+        leoAPI.resetCommandReader()
+        assert leoAPI.addCmdRemoveObject('8').ok
+        assert [_['seq'] for _ in leoAPI.readCommands().data] == [8]
+
+    def test_coalesceCommands(self):
+        """
+        Coalesce redundant force and modify commands.
+        """
+        def force(cmd, objID, value):
+            return {'cmd': cmd, 'objID': objID, 'force': value, 'torque': 0}
+
+        def modify(objID, rbs, aabbs=None):
+            return {'cmd': 'modify', 'objID': objID, 'rbs': rbs,
+                    'AABBs': aabbs}
+
+        # Only the last force of each type counts for every object.
+        docs = [
+            force('direct_force', '1', 1), force('direct_force', '2', 2),
+            force('booster_force', '1', 3), force('direct_force', '1', 4),
+        ]
+        assert leoAPI.coalesceCommands(docs) == docs[1:]
+
+        # Modify commands merge into the last one.
+        docs = [
+            modify('1', {'imass': 1, 'scale': 2}, {'cs': 1}),
+            modify('2', {'imass': 3}),
+            modify('1', {'scale': 4}),
+        ]
+        ref = [docs[1], modify('1', {'imass': 1, 'scale': 4}, {'cs': 1})]
+        assert leoAPI.coalesceCommands(docs) == ref
+        assert docs[2]['rbs'] == {'scale': 4}
+
+        # Commands never coalesce across a spawn or remove command of the
+        # same object. Duplicate spawn commands are redundant.
+        spawn = {'cmd': 'spawn', 'objID': '1'}
+        remove = {'cmd': 'remove', 'objID': '1'}
+        docs = [
+            spawn, force('direct_force', '1', 1), spawn,
+            force('direct_force', '1', 2), remove,
+            force('direct_force', '1', 3), spawn,
+            force('direct_force', '1', 4), force('direct_force', '1', 5),
+        ]
+        ref = [spawn, force('direct_force', '1', 2), remove,
+               force('direct_force', '1', 3), spawn,
+               force('direct_force', '1', 5)]
+        assert leoAPI.coalesceCommands(docs) == ref
+
+    def test_commandOrder(self):
+        """
+        Leonard must apply the commands in the order they arrived.
+        """
+        leo = getLeonard()
+        body_1, body_2 = getRigidBody(imass=1), getRigidBody(imass=2)
+        assert leoAPI.addCmdSpawn([('1', body_1)]).ok
+        leo.processCommandsAndSync()
+
+        # Apply a force, then replace the object. The new object must not
+        # inherit the force.
+        assert leoAPI.addCmdDirectForce('1', [1, 2, 3], [4, 5, 6]).ok
+        assert leoAPI.addCmdRemoveObject('1').ok
+        assert leoAPI.addCmdSpawn([('1', body_2)]).ok
+        leo.processCommandsAndSync()
+        assert leo.allBodies['1'] == body_2
+        assert leo.totalForceAndTorque('1') == ([0, 0, 0], [0, 0, 0])
+
+    @pytest.mark.parametrize('addr', [None, 'inproc://leo-cmd'])
+    def test_commandChannel(self, addr):
+        """
+        Push the commands to Leonard via the command channel and fall back to
+        the datastore if the channel is full.
+        """
+        leo = getLeonard()
+        channel = leoAPI.CommandChannel(addr, maxsize=2)
+        channel.bind()
+        leoAPI.setCommandChannel(channel)
+        body = getRigidBody()
+
+        # The commands must bypass the datastore.
+        force, torque = [1, 2, 3], [4, 5, 6]
+        assert leoAPI.addCmdSpawn([('1', body), ('2', body)]).ok
+        assert leoAPI.addCmdDirectForce('1', force, torque).ok
+        db = azrael.datastore.getDSHandle('Commands')
+        assert db.count().data == 0
+
+        # Leonard must receive the commands even without polling the
+        # datastore.
+        ret = leoAPI.dequeueCommands(poll=False)
+        assert ret.ok
+        assert [_['objID'] for _ in ret.data['spawn']] == ['1', '2']
+        assert ret.data['direct_force'][0]['force'] == force
+
+        # The channel only holds two messages. The third command must go to
+        # the datastore instead, from where Leonard only reads it when
+        # polling.
+        assert leoAPI.addCmdRemoveObject('1').ok
+        assert leoAPI.addCmdRemoveObject('2').ok
+        assert leoAPI.addCmdRemoveObject('3').ok
+        assert db.count().data == 1
+
+        # Drain the channel in batches of (at least) one command.
+        ret = leoAPI.dequeueCommands(maxcount=1, poll=False)
+        assert [_['objID'] for _ in ret.data['remove']] == ['1']
+        ret = leoAPI.dequeueCommands(poll=False)
+        assert [_['objID'] for _ in ret.data['remove']] == ['2']
+        ret = leoAPI.dequeueCommands(poll=True)
+        assert [_['objID'] for _ in ret.data['remove']] == ['3']
+        assert db.count().data == 0
+
+        # A command may still be in transit in the channel when Leonard
+        # reads a later one from the datastore. Leonard must hold back the
+        # later command until the earlier one arrives.
+        transit = []
+        with mock.patch.object(channel, 'push') as m_push:
+            m_push.side_effect = lambda docs: transit.append(docs) or True
+            assert leoAPI.addCmdRemoveObject('5').ok
+            m_push.side_effect = lambda docs: False
+            assert leoAPI.addCmdRemoveObject('6').ok
+        assert db.count().data == 1
+        ret = leoAPI.dequeueCommands(poll=True)
+        assert ret.data['remove'] == []
+        assert channel.push(transit[0])
+        ret = leoAPI.dequeueCommands(poll=False)
+        assert [_['objID'] for _ in ret.data['remove']] == ['5', '6']
+
+        # Leonard must apply the commands from the channel. It must not
+        # access the datastore between polls.
+        assert leoAPI.addCmdSpawn([('4', body)]).ok
+        leo.lastCmdPoll = time.time()
+        with mock.patch.object(azrael.datastore, 'getDSHandle') as m_getDS:
+            assert leo.processCommandQueue().ok
+            assert m_getDS.call_count == 0
+        assert leo.allBodies['4'] == body
+        channel.close()
+
     def test_setRigidBody(self):
         """
         Set and retrieve object attributes like position, velocity,
@@ -1,21 +1,28 @@
+import os
+import zmq
 import json
-import pytest
 import time
+import pytest
+import signal
+import threading
 import azrael.igor
 import azrael.aztypes
 import azrael.leonard
+import azrael.bodystore
 import azrael.datastore
 import azrael.vectorgrid
 import azrael.eventstore
+import azrael.wpcodec as wpcodec
 
 import numpy as np
 import unittest.mock as mock
+import azrael.config as config
 import azrael.leo_api as leoAPI
 
 from azrael.aztypes import RetVal
 from IPython import embed as ipshell
-from azrael.test.test import getCSBox, getCSSphere, getCSEmpty
-from azrael.test.test import getP2P, getLeonard, getRigidBody
+from azrael.test.test import getCSBox, getCSSphere, getCSEmpty, getCSPlane
+from azrael.test.test import getP2P, getLeonard, getRigidBody, FakeWorker
 
 
 # List all available engines. This simplifies the parameterisation of those
@@ -27,6 +34,10 @@ allEngines = [
     azrael.leonard.LeonardDistributedZeroMQ,
 ]
 
+# List all available broadphase engines. All broadphase tests must pass for
+# all of them.
+allBroadphases = ['sweeping', 'incremental', 'grid', 'bvh', 'reuse']
+
 
 class TestLeonardAllEngines:
     @classmethod
@@ -394,6 +405,26 @@ class TestLeonardAllEngines:
         es.join()
 
 
+class IdleWorker(config.AzraelProcess):
+    """
+    Fake ``LeonardWorkerZeroMQ`` that registers with Leonard and then idles.
+    """
+    def __init__(self, workerID, stepsUntilQuit, addr, identity):
+        super().__init__()
+        self.addr, self.identity = addr, identity
+
+    def run(self):
+        # Do not inherit the signal handler of the agent.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        ctx = zmq.Context()
+        sock = ctx.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, self.identity)
+        sock.connect(self.addr)
+        sock.send_multipart([b'ready', b'1'])
+        while True:
+            sock.recv_multipart()
+
+
 class TestWorkerManager:
     @classmethod
     def setup_class(cls):
@@ -482,6 +513,69 @@ class TestWorkerManager:
         assert m_worker_dead.join.called
         assert wm.workers == [None, None]
 
+    def test_workerAgent(self):
+        """
+        Start two agents for a Leonard on a non-default port. Leonard must
+        register them and their Workers, and the agents must start and stop
+        Workers as Leonard requests.
+        """
+        port = config.azService['leonard'].port + 2
+        leo = azrael.leonard.LeonardDistributedZeroMQ(port=port)
+        leo.setup()
+
+        def waitFor(condition):
+            # Process the heartbeats until ``condition`` holds.
+            for ii in range(250):
+                leo.pollWorkers()
+                if condition():
+                    return True
+                time.sleep(0.02)
+            return False
+
+        # The agents run between one and two Workers each.
+        addr = 'tcp://127.0.0.1:{}'.format(port)
+        agents = [
+            azrael.leonard.WorkerAgent(
+                name, addr, minWorkers=1, maxWorkers=2,
+                workerCls=IdleWorker, heartbeat=0.05)
+            for name in ('host1', 'host2')
+        ]
+        [_.start() for _ in agents]
+        initial = {b'host1/1', b'host2/1'}
+
+        try:
+            # Both agents start their minimum number of Workers.
+            assert waitFor(lambda: len(leo.agents) == 2)
+            assert waitFor(lambda: set(leo.workers) == initial)
+
+            # Grow the fleet to three Workers.
+            leo.fleetHold, leo.fleetLoad, leo.fleetSize = 0, 2, 2
+            leo.scheduler.stats['duration'] = 2 * leo.scheduler.stepinterval
+            assert leo.scaleFleet() == {
+                k: 2 if v['name'] == 'host1' else 1
+                for k, v in leo.agents.items()}
+            assert waitFor(lambda: len(leo.workers) == 3)
+            assert b'host1/2' in leo.workers
+
+            # Shrink it again. The agent must stop its newest Worker, and
+            # Leonard must remove it once the agent stops listing it.
+            leo.fleetLoad = 0
+            leo.scheduler.stats['duration'] = 0
+            leo.scaleFleet()
+            assert leo.fleetSize == 2
+            assert waitFor(lambda: set(leo.workers) == initial)
+
+            # Stop the second agent. It must stop its Workers and tell
+            # Leonard about it.
+            os.kill(agents[1].pid, signal.SIGTERM)
+            agents[1].join()
+            assert len(leo.agents) == 2
+            assert waitFor(lambda: set(leo.workers) == {b'host1/1'})
+        finally:
+            [_.terminate() for _ in agents]
+            [_.join() for _ in agents]
+            leo.shutdown()
+
     def test_worker_respawn(self):
         """
         Ensure the objects move correctly even though the Workers will restart
@@ -567,18 +661,17 @@ class TestLeonardOther:
 
         # Create a Work Package with two objects. The WPID must be 1.
         ret = leo.createWorkPackage([id_1], dt, maxsteps)
-        ret_wpid, ret_wpdata = ret.data['wpid'], ret.data['wpdata']
+        ret_wpid, ret_wpdata = ret.data['wpid'], ret.data['aids']
         assert (ret.ok, ret_wpid, len(ret_wpdata)) == (True, 0, 1)
 
         # Create a second WP: it must have WPID=2 and contain two objects.
         ret = leo.createWorkPackage([id_1, id_2], dt, maxsteps)
-        ret_wpid, ret_wpdata = ret.data['wpid'], ret.data['wpdata']
+        ret_wpid, ret_wpdata = ret.data['wpid'], ret.data['aids']
         assert (ret.ok, ret_wpid, len(ret_wpdata)) == (True, 1, 2)
 
         # Check the WP content.
-        WPDataOut = azrael.aztypes.WPDataOut
         WPMeta = azrael.aztypes.WPMeta
-        data = [WPDataOut(*_) for _ in ret.data['wpdata']]
+        data = wpcodec.unpackBodies(ret.data)
         meta = WPMeta(*ret.data['wpmeta'])
         assert (meta.dt, meta.maxsteps) == (dt, maxsteps)
         assert (ret.ok, len(data)) == (True, 2)
@@ -588,6 +681,417 @@ class TestLeonardOther:
         assert np.array_equal(data[0].force, [0, 0, 0])
         assert np.array_equal(data[1].force, [0, 0, 0])
 
+        # The forces in the WP must include the grid forces since the Workers
+        # do not query the grid anymore.
+        vg = azrael.vectorgrid
+        assert vg.defineGrid(name='force', vecDim=3, granularity=1).ok
+        assert vg.setValues('force', [(np.zeros(3), np.ones(3))]).ok
+        ret = leo.createWorkPackage([id_1], dt, maxsteps)
+        data = wpcodec.unpackBodies(ret.data)
+        assert np.array_equal(data[0].force, [1, 1, 1])
+        assert np.array_equal(data[0].torque, [0, 0, 0])
+
+    def test_processWorkPackages(self):
+        """
+        Distribute Work Packages to Workers according to their capacity, and
+        re-send them if a Worker does not respond in time.
+        """
+        leo = azrael.leonard.LeonardDistributedZeroMQ()
+        leo.wpTimeout = 0.2
+        leo.setup()
+
+        # Six bodies in six Work Packages.
+        objIDs = [str(_) for _ in range(6)]
+        for objID in objIDs:
+            leo.allBodies[objID] = getRigidBody(imass=1)
+        all_WPs = {}
+        for objID in objIDs:
+            wp = leo.createWorkPackage([objID], 1, 60).data
+            all_WPs[wp['wpid']] = wp
+
+        # Fake Workers: one moves all bodies by one unit and quits after six
+        # Work Packages, the other one never responds.
+        addr = 'tcp://127.0.0.1:{}'.format(config.azService['leonard'].port)
+        fast = FakeWorker(addr, capacity=2, quitAfter=6)
+        stall = FakeWorker(addr, capacity=1, stall=True)
+        workers = [fast, stall]
+        [_.start() for _ in workers]
+        time.sleep(0.2)
+
+        try:
+            leo.processWorkPackages(all_WPs)
+
+            # All bodies must have moved exactly once, even though the
+            # stalling Worker never returned its Work Package.
+            for objID in objIDs:
+                assert leo.allBodies[objID].position == (1, 1, 1)
+            assert len(stall.received) == 1
+            assert set(fast.wpids()) == set(all_WPs)
+
+            # The fast Worker asked to quit after six Work Packages. Leonard
+            # must not send it any more.
+            assert len(leo.workers) == 1
+            assert leo.wpStats['dispatch'] > 0 and leo.wpStats['collect'] > 0
+            assert leo.wpStats['bytesOut'] > leo.wpStats['bytesIn'] > 0
+
+            # The load statistics must include the re-sent Work Package.
+            load = leo.wpStats['workers']
+            assert sum(_['wps'] for _ in load.values()) == 7
+            assert sum(_['bodies'] for _ in load.values()) == 7
+            assert max(_['time'] for _ in load.values()) > 0
+            assert leo.wpStats['imbalance'] > 1
+        finally:
+            [_.stop() for _ in workers]
+            [_.join() for _ in workers]
+            leo.shutdown()
+
+    def test_workerAffinity(self):
+        """
+        Send the collision sets back to the Workers that already hold their
+        bodies, and only send the bodies that changed in the meantime.
+        """
+        leo = azrael.leonard.LeonardDistributedZeroMQ()
+        leo.setup()
+        store = leo.allBodies
+        for objID in ['0', '1', '2', '3']:
+            store[objID] = getRigidBody(imass=1)
+        store.markSynced(store.indices())
+
+        def mover():
+            # Return an ``update`` function for a fake Worker. It keeps the
+            # position of all bodies and moves them by one unit along x.
+            bodies = {}
+            layout = wpcodec.retLayout
+
+            def update(wp):
+                for aid in wp['drop']:
+                    del bodies[aid]
+                for aid, row in zip(wp['aids'], wp['state']):
+                    bodies[aid] = row[wpcodec.wpLayout['position']]
+
+                state = np.zeros((len(wp['aids']), wpcodec.retWidth))
+                state[:, layout['rotation']] = [0, 0, 0, 1]
+                for idx, aid in enumerate(wp['aids']):
+                    bodies[aid] = bodies[aid] + [1, 0, 0]
+                    state[idx, layout['position']] = bodies[aid]
+                return state
+            return update
+
+        addr = 'tcp://127.0.0.1:{}'.format(config.azService['leonard'].port)
+        workers = {_: FakeWorker(addr, update=mover()) for _ in 'AB'}
+
+        def step(*collSets):
+            # Process one Work Package per collision set and return the
+            # bodies the Workers loaded and held, and the dropped bodies.
+            num = {k: len(v.received) for k, v in workers.items()}
+            wps = [leo.createWorkPackage(_, 1, 60).data for _ in collSets]
+            leo.processWorkPackages({_['wpid']: _ for _ in wps})
+            out = {}
+            for name, worker in workers.items():
+                for wp in worker.received[num[name]:]:
+                    aids, cnt = wp['aids'], len(wp['state'])
+                    loaded, resident = aids[:cnt], aids[cnt:]
+                    key = tuple(sorted(aids))
+                    out[key] = (name, loaded, resident, wp['drop'])
+            return out
+
+        [_.start() for _ in workers.values()]
+        time.sleep(0.2)
+
+        try:
+            # The Workers do not hold any bodies yet.
+            ret = step(['0', '1'], ['2', '3'])
+            assert leo.wpStats['affinity'] == 0
+            assert leo.wpStats['loaded'] == 4
+            w01, w23 = ret[('0', '1')][0], ret[('2', '3')][0]
+            assert w01 != w23
+
+            # Same collision sets: they must go to the same Workers, which
+            # already hold all bodies.
+            ret = step(['0', '1'], ['2', '3'])
+            assert leo.wpStats['affinity'] == 1
+            assert ret[('0', '1')] == (w01, [], ['0', '1'], [])
+            assert ret[('2', '3')] == (w23, [], ['2', '3'], [])
+            assert store['0'].position == (2, 0, 0)
+
+            # Modify a body: the Worker must receive its new state.
+            store.setFields('0', position=(10, 0, 0))
+            ret = step(['0', '1'], ['2', '3'])
+            assert ret[('0', '1')] == (w01, ['0'], ['1'], [])
+            assert leo.wpStats['resident'] == 3
+            assert store['0'].position == (11, 0, 0)
+            assert store['1'].position == (3, 0, 0)
+
+            # Body '1' joins the other collision set. Its old Worker must
+            # drop it (with this or the next Work Package).
+            ret_1 = step(['0'], ['1', '2', '3'])
+            assert ret_1[('1', '2', '3')] == (w23, ['1'], ['2', '3'], [])
+            assert ret_1[('0', )][:3] == (w01, [], ['0'])
+
+            # Remove body '3'. Its Worker must drop it as well.
+            del store['3']
+            ret_2 = step(['0'], ['1', '2'])
+            assert ret_2[('1', '2')] == (w23, [], ['1', '2'], ['3'])
+            assert ret_1[('0', )][3] + ret_2[('0', )][3] == ['1']
+            assert store['2'].position == (5, 0, 0)
+        finally:
+            [_.stop() for _ in workers.values()]
+            [_.join() for _ in workers.values()]
+            leo.shutdown()
+
+    def test_workerAgents(self):
+        """
+        Track the Workers of several agents via their heartbeats, re-send the
+        Work Packages of dead Workers right away, and size the fleet to the
+        tick duration.
+        """
+        # Use a non-default port. The deadlines must never expire.
+        port = config.azService['leonard'].port + 1
+        leo = azrael.leonard.LeonardDistributedZeroMQ(port=port)
+        leo.wpTimeout = leo.wpMinDeadline = 10
+        leo.setup()
+        objIDs = [str(_) for _ in range(4)]
+        for objID in objIDs:
+            leo.allBodies[objID] = getRigidBody(imass=1)
+
+        # Fake agents: list the Workers in ``alive`` with every heartbeat
+        # (unless ``silent``) and record the number of Workers Leonard wants.
+        ctx = zmq.Context()
+        addr = 'tcp://127.0.0.1:{}'.format(port)
+        alive = {'A': {'A/1'}, 'B': {'B/1'}}
+        silent, targets = set(), {}
+        stop = threading.Event()
+
+        def agent(name):
+            sock = ctx.socket(zmq.DEALER)
+            sock.connect(addr)
+            while not stop.is_set():
+                if name in silent:
+                    time.sleep(0.05)
+                    continue
+                beat = {'name': name, 'workers': sorted(alive[name]),
+                        'min': 1, 'max': 3}
+                sock.send_multipart([b'agent', json.dumps(beat).encode()])
+                if sock.poll(50) != 0:
+                    kind, num = sock.recv_multipart()
+                    assert kind == b'fleet'
+                    targets[name] = int(num)
+            sock.close(linger=0)
+
+        # Fake Workers: 'B/1' moves all bodies by one unit, 'A/1' never
+        # responds.
+        worker_a = FakeWorker(addr, identity=b'A/1', stall=True)
+        worker_b = FakeWorker(addr, identity=b'B/1')
+
+        def waitFor(condition):
+            # Process the heartbeats until ``condition`` holds.
+            for ii in range(100):
+                leo.pollWorkers()
+                if condition():
+                    return True
+                time.sleep(0.02)
+            return False
+
+        def names():
+            return {_['name'] for _ in leo.agents.values()}
+
+        threads = [
+            threading.Thread(target=agent, args=('A', )),
+            threading.Thread(target=agent, args=('B', )),
+            worker_a, worker_b,
+        ]
+        [_.start() for _ in threads]
+
+        try:
+            # Leonard must know both agents and their Workers.
+            assert waitFor(lambda: names() == {'A', 'B'})
+            assert waitFor(lambda: set(leo.workers) == {b'A/1', b'B/1'})
+            assert waitFor(lambda: targets == {'A': 1, 'B': 1})
+
+            # Worker 'A/1' receives Work Packages but dies before it returns
+            # them. Leonard must re-send them once agent 'A' stops listing
+            # the Worker, instead of waiting for the timeout.
+            wps = [leo.createWorkPackage([_], 1, 60).data for _ in objIDs]
+            threading.Timer(0.3, alive['A'].clear).start()
+            t0 = time.time()
+            leo.processWorkPackages({_['wpid']: _ for _ in wps})
+            assert time.time() - t0 < 5
+            assert len(worker_a.received) > 0
+            assert set(worker_b.wpids()) == {_['wpid'] for _ in wps}
+            assert leo.wpStats['orphans'] == len(worker_a.received)
+            assert set(leo.workers) == {b'B/1'}
+            for objID in objIDs:
+                assert leo.allBodies[objID].position == (1, 1, 1)
+
+            # Overrunning ticks must grow the fleet (at most to the sum of
+            # the maximum number of Workers of all agents), and distribute
+            # it among the agents.
+            leo.fleetHold, leo.fleetLoad = 0, 2
+            leo.scheduler.stats['duration'] = 2 * leo.scheduler.stepinterval
+            expected = [(1, 1), (2, 1), (2, 2), (3, 2), (3, 3), (3, 3)]
+            for num_a, num_b in expected:
+                ret = leo.scaleFleet()
+                assert sorted(ret.values()) == sorted([num_a, num_b])
+            assert leo.fleetSize == 6
+            assert waitFor(lambda: targets == {'A': 3, 'B': 3})
+
+            # Short ticks must shrink the fleet, but only after ``fleetHold``
+            # ticks since the last change.
+            leo.fleetHold, leo.fleetLoad = 2, 0
+            leo.scheduler.stats['duration'] = 0
+            sizes = []
+            for ii in range(5):
+                leo.scaleFleet()
+                sizes.append(leo.fleetSize)
+            assert sizes == [5, 5, 5, 4, 4]
+            assert waitFor(lambda: sorted(targets.values()) == [2, 2])
+
+            # Agent 'B' stops its heartbeats. Leonard must remove it and its
+            # Workers.
+            leo.agentTimeout = 0.3
+            silent.add('B')
+            assert waitFor(lambda: names() == {'A'})
+            assert leo.workers == {}
+        finally:
+            stop.set()
+            worker_a.stop()
+            worker_b.stop()
+            [_.join() for _ in threads]
+            ctx.term()
+            leo.shutdown()
+
+    def test_stragglers(self):
+        """
+        Send overdue Work Packages to another Worker, ignore the late
+        duplicates, and blacklist Workers that are persistently slow.
+        """
+        leo = azrael.leonard.LeonardDistributedZeroMQ()
+        leo.wpTimeout, leo.wpMinDeadline = 5, 0.05
+        leo.setup()
+        objIDs = [str(_) for _ in range(6)]
+        for objID in objIDs:
+            leo.allBodies[objID] = getRigidBody(imass=1)
+
+        # Fake Workers: the slow one returns its Work Packages late, and
+        # with a different position for all bodies.
+        addr = 'tcp://127.0.0.1:{}'.format(config.azService['leonard'].port)
+        fast = FakeWorker(addr, identity=b'fast', capacity=2)
+        slow = FakeWorker(addr, identity=b'slow', capacity=1, delay=0.3,
+                          value=-1)
+        workers = [fast, slow]
+
+        def step():
+            # Process one Work Package per body. Then give the slow Worker
+            # time to return its (late) result.
+            wps = [leo.createWorkPackage([_], 1, 60).data for _ in objIDs]
+            leo.processWorkPackages({_['wpid']: _ for _ in wps})
+            for objID in objIDs:
+                assert leo.allBodies[objID].position == (1, 1, 1)
+            time.sleep(0.4)
+            return dict(leo.wpStats)
+
+        [_.start() for _ in workers]
+        time.sleep(0.2)
+
+        try:
+            # The slow Worker misses its deadline in every step. The fast
+            # Worker must process its Work Package as well. Leonard must
+            # ignore the late results.
+            stats = [step() for _ in range(3)]
+            assert [_['speculative'] for _ in stats] == [1, 1, 1]
+            assert len(slow.received) == 3
+            assert len(fast.received) == 3 * len(objIDs)
+            assert leo.wpRate is not None
+            assert sum(_['duplicates'] for _ in stats) == 2
+
+            # The slow Worker missed three deadlines in a row and must not
+            # receive any more Work Packages.
+            assert list(leo.blacklist) == [b'slow']
+            stats = step()
+            assert stats['speculative'] == 0 and stats['duplicates'] == 1
+            assert len(slow.received) == 3
+
+            # The blacklist expires.
+            leo.blacklist[b'slow'] = time.time() - 1
+            step()
+            assert len(slow.received) == 4
+            assert leo.blacklist == {} and leo.strikes == {b'slow': 1}
+
+            # Percentiles of the time spent in ``processWorkPackages``.
+            tail = leo.wpStats['tail']
+            assert list(tail) == [50, 90, 99]
+            assert 0 < tail[50] <= tail[90] <= tail[99]
+        finally:
+            [_.stop() for _ in workers]
+            [_.join() for _ in workers]
+            leo.shutdown()
+
+    def test_packCosts(self):
+        """
+        Pack items into bins with balanced costs.
+        """
+        packCosts = azrael.leonard.packCosts
+        assert packCosts([], 4) == []
+
+        # Never create more bins than items.
+        assert sorted(packCosts([1, 1], 4)) == [[0], [1]]
+
+        # Balance the costs: 5 + 1 + 1 + 1 versus 4 + 4.
+        costs = [1, 4, 1, 5, 4, 1]
+        bins = packCosts(costs, 2)
+        assert sorted(sum(costs[_] for _ in b) for b in bins) == [8, 8]
+        assert sorted(sum(bins, [])) == list(range(len(costs)))
+
+        # An expensive item occupies its own bin.
+        bins = packCosts([10, 1, 1, 1], 2)
+        assert sorted(bins) == [[0], [1, 2, 3]]
+
+        # Items stay in their preferred bin unless this is worse than the
+        # packing without preferences.
+        bins = packCosts([1, 1, 1, 1], 2, preferred=[1, 1, 0, 0])
+        assert bins == [[2, 3], [0, 1]]
+        assert packCosts([1] * 5, 2) == [[0, 2, 4], [1, 3]]
+        bins = packCosts([1] * 5, 2, preferred=[1] * 5)
+        assert bins == [[3, 4], [0, 1, 2]]
+        bins = packCosts([1] * 6, 2, preferred=[1] * 6)
+        assert [len(_) for _ in bins] == [3, 3]
+
+    def test_packCollisionSets(self):
+        """
+        Pack the collision sets into Work Packages based on their cost.
+        """
+        leo = azrael.leonard.LeonardDistributedZeroMQ()
+        leo.wpPerWorker = 2
+        leo.wpCostWeights = {
+            'bodies': 1, 'shapes': 0, 'constraints': 2, 'contacts': 1}
+        for idx in range(8):
+            leo.allBodies[str(idx)] = getRigidBody()
+        collSets = [{str(_)} for _ in range(8)]
+        assert leo.packCollisionSets([], []) == []
+
+        # Eight singletons with identical cost become two groups of four
+        # (there is no Worker yet, ie Leonard assumes one).
+        ret = leo.packCollisionSets(collSets, [])
+        assert sorted(len(_[0]) for _ in ret) == [4, 4]
+        assert [_[1] for _ in ret] == [4, 4]
+
+        # The groups must remain stable.
+        groups = sorted(sorted(_[0]) for _ in ret)
+        ret = leo.packCollisionSets(collSets, [])
+        assert sorted(sorted(_[0]) for _ in ret) == groups
+
+        # Constraints and contacts make bodies more expensive. The group
+        # with body '0' must therefore contain fewer bodies.
+        leo.lastCollisions = [('0', '9', [[0, 0, 0]] * 4)]
+        ret = leo.packCollisionSets(collSets, [('0', '9')])
+        assert sorted((len(_[0]), _[1]) for _ in ret) == [(2, 6), (6, 6)]
+        assert any('0' in _[0] and len(_[0]) == 2 for _ in ret)
+
+        # Add Workers: the sets now go into more Work Packages.
+        leo.workers = {b'1': 1, b'2': 1}
+        ret = leo.packCollisionSets(collSets, [])
+        assert len(ret) == 4
+
     def test_updateLocalCache(self):
         """
         Update the local object cache in Leonard based on a Work Package.
@@ -605,14 +1109,18 @@ class TestLeonardOther:
         assert leoAPI.addCmdSpawn(tmp).ok
         leo.processCommandsAndSync()
 
-        # Create a new State Vector to replace the old one.
-        body_3 = getRigidBody(imass=4, position=[1, 2, 3])
-        newWP = [azrael.aztypes.WPDataRet(id_1, body_3)]
+        # Create a new motion state to replace the old one.
+        body_3 = body_1._replace(position=(1, 2, 3), velocityRot=(0, 1, 0))
+        state = np.zeros((1, wpcodec.retWidth))
+        for name in leo.allBodies.motionFields:
+            state[0, wpcodec.retLayout[name]] = getattr(body_3, name)
 
-        # Check the state variables for objID=id_1 before and after the update.
+        # Check the state variables for objID=id_1 before and after the
+        # update. The other body must not change.
         assert getRigidBody(*leo.allBodies[id_1]) == body_1
-        leo.updateLocalCache(newWP, None)
+        leo.updateLocalCache([id_1], state, None)
         assert getRigidBody(*leo.allBodies[id_1]) == body_3
+        assert getRigidBody(*leo.allBodies[id_2]) == body_2
 
     def test_processCommandQueue(self):
         """
@@ -812,6 +1320,358 @@ class TestLeonardOther:
         leo.processCommandsAndSync()
         assert leo.totalForceAndTorque(objID) == ([1, 2, 3], [4, 5, 6])
 
+    def test_forcesAndTorques(self):
+        """
+        The vectorised 'forcesAndTorques' must match 'totalForceAndTorque'
+        for every object, and optionally add the forces from the grid.
+        """
+        # Get a Leonard instance.
+        leo = getLeonard(azrael.leonard.LeonardDistributedZeroMQ)
+
+        # Spawn three objects with different rotations.
+        rotations = [(0, 0, 0, 1), (1, 0, 0, 0), (0, 1, 0, 0)]
+        objIDs = ['1', '2', '3']
+        for objID, rot in zip(objIDs, rotations):
+            body = getRigidBody(position=[int(objID), 0, 0], rotation=rot)
+            assert leoAPI.addCmdSpawn([(objID, body)]).ok
+        assert leoAPI.addCmdDirectForce('1', [1, 2, 3], [4, 5, 6]).ok
+        assert leoAPI.addCmdBoosterForce('2', [1, 2, 3], [-1, -2, -3]).ok
+        assert leoAPI.addCmdBoosterForce('3', [1, 2, 3], [-1, -2, -3]).ok
+        leo.processCommandsAndSync()
+
+        # Compare the bulk results with those for the individual objects.
+        force, torque = leo.forcesAndTorques(objIDs)
+        assert force.shape == torque.shape == (3, 3)
+        for idx, objID in enumerate(objIDs):
+            ref = leo.totalForceAndTorque(objID)
+            assert (force[idx].tolist(), torque[idx].tolist()) == ref
+        assert np.array_equal(force[2], [-1, 2, -3])
+
+        # The default is to return the values for all objects.
+        assert list(leo.allBodies) == objIDs
+        force_all, torque_all = leo.forcesAndTorques()
+        assert np.array_equal(force_all, force)
+        assert np.array_equal(torque_all, torque)
+
+        # Define a force grid with a constant value. The grid forces must
+        # only affect the forces, not the torques.
+        vg = azrael.vectorgrid
+        assert vg.defineGrid(name='force', vecDim=3, granularity=1).ok
+        ofs = np.array([0, -1, -1], np.float64)
+        assert vg.setRegion('force', ofs, np.ones((5, 3, 3, 3))).ok
+        force_grid, torque_grid = leo.forcesAndTorques(objIDs, grid=True)
+        assert np.array_equal(force_grid, force + 1)
+        assert np.array_equal(torque_grid, torque)
+
+        # 'compileForces' contains the same values as Python lists.
+        forces = leo.compileForces()
+        assert forces['2'] == (force[1].tolist(), torque[1].tolist())
+
+    @pytest.mark.parametrize('method', ['euler', 'verlet', 'rk4'])
+    def test_integrateBodies(self, method):
+        """
+        Advance isolated bodies without Bullet and verify the results against
+        the analytical solutions.
+        """
+        # Convenience.
+        integrate = azrael.leonard.integrateBodies
+        store = azrael.bodystore.BodyStore()
+        zero = np.zeros((1, 3))
+
+        # Unknown integrator.
+        store['0'] = getRigidBody()
+        slots = store.indices()
+        assert not integrate(store, slots, zero, zero, 1, 60, 'foo').ok
+
+        # Constant velocity (the damping slows the body down a bit).
+        store['0'] = getRigidBody(velocityLin=[1, 0, 0])
+        assert integrate(store, slots, zero, zero, 1, 60, method) == (
+            True, None, 1)
+        assert 0.98 < store['0'].position[0] < 1
+        assert store['0'].position[1:] == (0, 0)
+
+        # Constant force: x = 0.5 * F / m * t^2.
+        store['0'] = getRigidBody(imass=2)
+        force = np.array([[1, 0, 0]], np.float64)
+        assert integrate(store, slots, force, zero, 1, 60, method).ok
+        assert abs(store['0'].position[0] - 1) < 0.02
+        assert abs(store['0'].velocityLin[0] - 2) < 0.03
+
+        # Rotate the body by 90 degrees around its centre of mass, which
+        # is one unit away from its position. This must move the position
+        # along a quarter circle.
+        store['0'] = getRigidBody(velocityRot=[0, 0, np.pi / 2], com=[1, 0, 0])
+        assert integrate(store, slots, zero, zero, 1, 60, method).ok
+        body = store['0']
+        angle = 2 * np.arctan2(body.rotation[2], body.rotation[3])
+        assert abs(angle - np.pi / 2) < 0.02
+        assert np.allclose(body.position, [1, -1, 0], atol=0.02)
+
+        # Constant torque: phi = 0.5 * T / I * t^2.
+        store['0'] = getRigidBody(inertia=[1, 1, 2])
+        torque = np.array([[0, 0, 1]], np.float64)
+        assert integrate(store, slots, zero, torque, 1, 60, method).ok
+        angle = 2 * np.arctan2(store['0'].rotation[2], store['0'].rotation[3])
+        assert abs(angle - 0.25) < 0.01
+
+        # Static bodies must not move.
+        body = getRigidBody(imass=0, velocityLin=[1, 0, 0])
+        store['0'] = body
+        assert integrate(store, slots, force, torque, 1, 60, method) == (
+            True, None, 0)
+        assert store['0'] == body
+
+    @mock.patch.object(azrael.datastore, 'getDSHandle')
+    def test_datastoreWriter(self, m_getDSHandle):
+        """
+        The writer must apply the modifications in the background, and drop
+        them if its queue is full.
+        """
+        db = azrael.datastore.DatastoreInMemory(('test1', 'test2'))
+        m_getDSHandle.return_value = db
+        ops = {str(_): {'data': {'foo': 0}} for _ in range(3)}
+        assert db.put(ops).ok
+
+        def _inc(objIDs):
+            return {_: {'inc': {('foo', ): 1}, 'set': {}, 'unset': [],
+                        'exists': {}} for _ in objIDs}
+
+        # Fill the queue before starting the writer. It must drop the third
+        # batch.
+        writer = azrael.leonard.DatastoreWriter(maxsize=2)
+        assert writer.submit(_inc(['0', '1'])) is True
+        assert writer.submit(_inc(['0'])) is True
+        assert writer.submit(_inc(['2'])) is False
+        assert writer.stats['dropped'] == 1
+
+        # Start the writer and wait until it processed all batches.
+        writer.start()
+        writer.flush()
+        writer.stop()
+        assert writer.stats['written'] == 3
+        assert writer.stats['lag'] >= 0
+        ret = db.getAll()
+        assert ret.data == {'0': {'foo': 2}, '1': {'foo': 1}, '2': {'foo': 0}}
+        assert writer.popFailed() == set()
+
+        # Failed writes must neither count as written nor terminate the
+        # thread. Instead, the writer must report the affected documents.
+        writer = azrael.leonard.DatastoreWriter(maxsize=3)
+        with mock.patch.object(db, 'modifyBulk') as m_modifyBulk:
+            m_modifyBulk.side_effect = [
+                RetVal(False, 'error', None),
+                ValueError,
+                RetVal(True, None, 1),
+            ]
+            assert writer.submit(_inc(['0', '1'])) is True
+            assert writer.submit(_inc(['2'])) is True
+            assert writer.submit(_inc(['1'])) is True
+            writer.start()
+            writer.flush()
+            writer.stop()
+        assert writer.stats['written'] == 1
+        assert writer.stats['failed'] == 3
+        assert writer.popFailed() == {'0', '1', '2'}
+        assert writer.popFailed() == set()
+
+        # Stopping the writer must not lose the queued batches.
+        writer = azrael.leonard.DatastoreWriter(maxsize=2)
+        assert writer.submit(_inc(['2'])) is True
+        assert writer.submit(_inc(['2'])) is True
+        writer.stop()
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        assert writer.stats['written'] == 2
+        assert db.getOne('2').data == {'foo': 2}
+
+    @pytest.mark.parametrize('mode', ['realtime', 'adaptive', 'batch'])
+    def test_stepScheduler(self, mode):
+        """
+        Run the scheduler with a fake clock and a few (slow) ticks.
+        """
+        # Fake clock: 'sleep' advances the time.
+        clock = [100.0]
+
+        def _sleep(delay):
+            clock[0] += delay
+
+        m_time = mock.MagicMock()
+        m_time.time.side_effect = lambda: clock[0]
+        m_time.sleep.side_effect = _sleep
+
+        # Tick durations in seconds (the interval is 0.1s).
+        durations = [0.01, 0.15, 0.01, 0.01, 0.35, 0.01]
+        sched = azrael.leonard.StepScheduler(mode, 0.1, 8, len(durations))
+        ticks = []
+        with mock.patch.object(azrael.leonard, 'time', m_time):
+            for duration in durations:
+                t0 = clock[0]
+                ticks.append(sched.wait())
+                ticks[-1] += (clock[0] - t0, )
+                clock[0] += duration
+                sched.done()
+            assert sched.wait() is None
+
+        # Every tick advances the simulation by 0.1s, unless the adaptive
+        # scheduler reduced the sub-steps.
+        stats = sched.stats
+        assert stats['ticks'] == 6
+        assert abs(stats['simTime'] - sum(_[0] for _ in ticks)) < 1E-9
+        if mode != 'adaptive':
+            assert abs(stats['simTime'] - 0.6) < 1E-9
+            assert [_[0] for _ in ticks] == [0.1] * 6
+
+        if mode == 'batch':
+            # Never wait, never count overruns.
+            assert [_[2] for _ in ticks] == [0] * 6
+            assert stats['overruns'] == 0
+            assert [_[1] for _ in ticks] == [8] * 6
+            return
+
+        # The first tick starts immediately and the second one after the
+        # remaining 0.09s. The third tick starts without delay because the
+        # second one overran.
+        assert np.allclose([_[2] for _ in ticks], [0, 0.09, 0, 0.04, 0.09, 0])
+        assert stats['overruns'] == 2
+        assert abs(stats['lag'] - 0.25) < 1E-9
+        assert stats['jitter'] > 0
+        if mode == 'realtime':
+            assert [_[1] for _ in ticks] == [8] * 6
+        else:
+            # Halve the sub-steps after an overrun, then restore them. A
+            # tick needs six sub-steps of 1/60s to cover 0.1s. With fewer
+            # sub-steps it only covers their duration.
+            assert [_[1] for _ in ticks] == [8, 8, 3, 4, 5, 2]
+            dt = [0.1, 0.1, 3 / 60, 4 / 60, 5 / 60, 2 / 60]
+            assert np.allclose([_[0] for _ in ticks], dt)
+
+    def test_stepScheduler_substeps(self):
+        """
+        The simulated time must match the time the integrator actually
+        advances the bodies, even if there are too few sub-steps to cover the
+        entire step interval.
+        """
+        # A tick of 0.05s needs three sub-steps of 1/60s.
+        sched = azrael.leonard.StepScheduler('batch', 0.05, 2)
+        assert sched.needed == 3
+
+        # Advance a body with unit velocity for a few ticks.
+        store = azrael.bodystore.BodyStore()
+        store['0'] = getRigidBody(imass=1, velocityLin=[1, 0, 0])
+        zero = np.zeros((1, 3))
+        for ii in range(3):
+            dt, maxsteps = sched.wait()
+            assert abs(dt - 2 / 60) < 1E-9
+            ret = azrael.leonard.integrateBodies(
+                store, store.indices(), zero, zero, dt, maxsteps)
+            assert ret.ok
+            sched.done()
+
+        # The body must have moved by (almost, due to damping) the simulated
+        # time.
+        simTime = sched.stats['simTime']
+        assert abs(simTime - 6 / 60) < 1E-9
+        assert abs(store['0'].position[0] - simTime) < 1E-3
+
+    def test_removeSleepingSets(self):
+        """
+        Collision sets must fall asleep once all their bodies have been at
+        rest for long enough, and wake up again after a command or force.
+        """
+        leo = azrael.leonard.LeonardBase(sleepTime=1)
+        store = leo.allBodies
+
+        # Two resting bodies in one set, a slowly drifting body in a
+        # second set, and a static body that is part of both.
+        store['1'] = store['2'] = getRigidBody(imass=1)
+        store['3'] = getRigidBody(imass=1, velocityLin=[1E-3, 0, 0])
+        store['4'] = getRigidBody(imass=0, velocityLin=[1, 0, 0])
+        collSets = [{'1', '2', '4'}, {'3', '4'}]
+
+        # The sets must not sleep before the sleep time elapsed.
+        assert leo.removeSleepingSets(collSets, 0.6) == collSets
+        assert leo.removeSleepingSets(collSets, 0.6) == []
+        assert store.velocityLin[store.indices(['3'])].tolist() == [[0, 0, 0]]
+
+        # A force on body '1' wakes up its set only.
+        store.forces['1'] = store.forces['1']._replace(forceDirect=[1, 0, 0])
+        assert leo.removeSleepingSets(collSets, 0.1) == collSets[:1]
+
+        # Bodies that move too fast are awake.
+        store.forces['1'] = store.forces['1']._replace(forceDirect=[0, 0, 0])
+        store.setFields('2', velocityRot=(0, 0.1, 0))
+        assert leo.removeSleepingSets(collSets, 2) == collSets[:1]
+        store.setFields('2', velocityRot=(0, 0, 0))
+        assert leo.removeSleepingSets(collSets, 2) == []
+
+        # So does a force from the 'force' grid on body '3'.
+        grid = np.array([[0, 1, 0] if _ == '3' else [0, 0, 0] for _ in store])
+        with mock.patch.object(azrael.vectorgrid, 'getValues') as m_getValues:
+            m_getValues.return_value = RetVal(True, None, grid)
+            assert leo.removeSleepingSets(collSets, 0.1) == collSets[1:]
+        assert leo.removeSleepingSets(collSets, 2) == []
+
+        # Merging with an awake body wakes up the entire set.
+        store['5'] = getRigidBody(imass=1)
+        collSets = [{'1', '2', '4', '5'}, {'3', '4'}]
+        assert leo.removeSleepingSets(collSets, 0.1) == collSets[:1]
+
+        # A value of *None* disables sleeping sets.
+        leo.sleepTime = None
+        assert leo.removeSleepingSets(collSets, 2) == collSets
+
+    def test_syncObjects_changed(self):
+        """
+        Leonard must only sync the bodies that have changed.
+        """
+        leo = getLeonard(azrael.leonard.LeonardBase)
+
+        # Spawn two objects. Both must be synced.
+        body = getRigidBody(imass=1)
+        tmp = [('1', body), ('2', body._replace(velocityLin=[1, 0, 0]))]
+        assert leoAPI.addCmdSpawn(tmp).ok
+        db = azrael.datastore.getDSHandle('ObjInstances')
+        with mock.patch.object(db, 'modifyBulk', wraps=db.modifyBulk) as m:
+            leo.processCommandsAndSync()
+            assert set(m.call_args[0][0]) == {'1', '2'}
+
+            # Only the second object moves.
+            leo.step(1.0, 60)
+            assert set(m.call_args[0][0]) == {'2'}
+
+            # Nothing moves anymore.
+            leo.allBodies.setFields('2', velocityLin=(0, 0, 0))
+            leo.syncObjects(None)
+            m.reset_mock()
+            leo.step(1.0, 60)
+            assert m.call_count == 0
+
+            # A failed write must not mark the body as synced.
+            leo.allBodies.setFields('1', velocityLin=(0, 0, 1))
+            m.side_effect = lambda ops: RetVal(False, 'error', None)
+            leo.syncObjects(None)
+            assert leo.allBodies.dirty[leo.allBodies.slots['1']]
+            m.side_effect = None
+            leo.syncObjects(None)
+            assert m.call_count == 2
+            assert set(m.call_args[0][0]) == {'1'}
+            assert not leo.allBodies.dirty[leo.allBodies.slots['1']]
+
+        # Leonard must sync the bodies again that the background writer could
+        # not write, unless they do not exist anymore.
+        leo.writer = mock.MagicMock()
+        leo.writer.popFailed.return_value = {'2', '3'}
+        leo.writer.stats = {'written': 0, 'failed': 2, 'dropped': 0, 'lag': 0}
+        leo.syncObjects(None)
+        assert set(leo.writer.submit.call_args[0][0]) == {'2'}
+
+        # Shutting down Leonard must stop the writer and wait for it.
+        writer = leo.writer
+        leo.shutdown()
+        assert writer.stop.call_count == writer.join.call_count == 1
+        assert leo.writer is None
+
     def test_mergeConstraintSets(self):
         """
         Create a few disjoint sets, specify some constraints, and verify that
@@ -892,6 +1752,31 @@ class TestLeonardOther:
         assert igor.addConstraints([getP2P(rb_a='3', rb_b='4')]).ok
         _verify(s, [['1', '2', '3', '6', '4', '5']])
 
+    def test_mergeConstraintSets_order(self):
+        """
+        The merged sets must be appended in the order of their last merge,
+        and all other sets must retain their order and type.
+        """
+        mergeConstraintSets = azrael.leonard.mergeConstraintSets
+
+        # No constraints: the output is the input.
+        s = [['1'], ('2', '3')]
+        assert mergeConstraintSets([], s) == (True, None, s)
+
+        # Constraints between bodies that are in none of the sets produce
+        # an empty set, just like a constraint with only one known body
+        # re-appends the set of that body.
+        s = [['1'], ('2', '3'), ['4']]
+        ret = mergeConstraintSets([('1', '9'), ('8', '9')], s)
+        assert ret == (True, None, [('2', '3'), ['4'], {'1'}, set()])
+        assert ret.data is s
+
+        # Merge a chain of sets. The set of '6' was merged last.
+        s = [['1'], ['2'], ['3'], ['4'], ['5', '6']]
+        pairs = [('1', '3'), ('5', '4'), ('6', '6'), ('3', '2')]
+        ret = mergeConstraintSets(pairs, s)
+        assert ret.data == [{'4', '5', '6'}, {'1', '2', '3'}]
+
     @pytest.mark.parametrize('clsLeonard', [
         azrael.leonard.LeonardBullet,
         azrael.leonard.LeonardSweeping,
@@ -1112,22 +1997,34 @@ class TestBroadphase:
         _verify({0: [[1, 2]], 1: [[10, 11]], 2: [[0, 1.5]]},
                 correct_answer=[['0', '2'], ['1']])
 
-    @mock.patch('azrael.leonard.sweeping')
-    def test_computeCollisionSetsAABB_mocksweeping(self, mock_sweeping):
+    def test_compileAABBTable(self):
         """
-        Create three bodies. Then alter their AABBs to create various
-        combinations of overlap.
+        Compile the world space AABBs for various bodies and verify that each
+        body and AABB ends up in the correct row of the table.
         """
-        # Install a mock for the sweeping algorithm.
-        azrael.leonard.sweeping = mock_sweeping
-        mock_sweeping.return_value = RetVal(True, None, [])
+        def _verify(bodies, aabbs, correct, ignored=[], static=[]):
+            ret = azrael.leonard._compileAABBTable(bodies, aabbs)
+            assert ret.ok
+            table = ret.data
+            assert table.ignored == ignored
+            assert table.static == static
+
+            # Reconstruct the {objID: {'x': [[min, max], ...], ...}} layout
+            # of the AABBs from the table to compare it with ``correct``.
+            computed = {}
+            for row, idx in enumerate(table.rowBody):
+                objID = table.objIDs[idx]
+                if objID not in computed:
+                    computed[objID] = {'x': [], 'y': [], 'z': []}
+                for dim, name in enumerate('xyz'):
+                    tmp = [table.aabbMin[row, dim], table.aabbMax[row, dim]]
+                    computed[objID][name].append(tmp)
+            assert computed == correct
 
         # Single body with no AABBs.
         bodies = {5: getRigidBody(position=(0, 0, 0))}
-        aabbs = {5: []}
-        correct = {5: {'x': [], 'y': [], 'z': []}}
-        azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
-        mock_sweeping.assert_called_with(correct, 'x')
+        aabbs = {5: {}}
+        _verify(bodies, aabbs, {}, ignored=[5])
 
         # Single body with one AABB.
         bodies = {5: getRigidBody(position=(0, 0, 0))}
@@ -1135,8 +2032,7 @@ class TestBroadphase:
         correct = {5: {'x': [[-1, 1]],
                        'y': [[-2, 2]],
                        'z': [[-3, 3]]}}
-        azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
-        mock_sweeping.assert_called_with(correct, 'x')
+        _verify(bodies, aabbs, correct)
 
         # Single body with two AABBs.
         bodies = {5: getRigidBody(position=(0, 0, 0))}
@@ -1145,8 +2041,7 @@ class TestBroadphase:
         correct = {5: {'x': [[-1, 1], [0, 4]],
                        'y': [[-1, 1], [-1, 7]],
                        'z': [[-1, 1], [-4, 12]]}}
-        azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
-        mock_sweeping.assert_called_with(correct, 'x')
+        _verify(bodies, aabbs, correct)
 
         # Single body at an offset with two AABBs.
         bodies = {5: getRigidBody(position=(0, 1, 2))}
@@ -1155,34 +2050,64 @@ class TestBroadphase:
         correct = {5: {'x': [[-1, 1], [0, 4]],
                        'y': [[0, 2], [0, 8]],
                        'z': [[1, 3], [-2, 14]]}}
-        azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
-        mock_sweeping.assert_called_with(correct, 'x')
+        _verify(bodies, aabbs, correct)
 
-        # Three bodies with 0, 1, and 2 AABBs, respectively.
+        # Three bodies with 0, 1, and 2 AABBs, respectively. The fourth body
+        # is static and the fifth has only an AABB with zero extent.
         bodies = {6: getRigidBody(position=(0, 0, 0)),
                   7: getRigidBody(position=(0, 0, 0)),
-                  8: getRigidBody(position=(0, 0, 0))}
+                  8: getRigidBody(position=(0, 0, 0)),
+                  9: getRigidBody(position=(0, 0, 0), imass=0),
+                  10: getRigidBody(position=(0, 0, 0))}
         aabbs = {6: {},
                  7: {'1': (0, 0, 0, 1, 1, 1)},
                  8: {'1': (0, 0, 0, 1, 1, 1),
-                     '2': (2, 3, 4, 2, 4, 8)}}
-        correct = {6: {'x': [],
-                       'y': [],
-                       'z': []},
-                   7: {'x': [[-1, 1]],
+                     '2': (2, 3, 4, 2, 4, 8)},
+                 9: {'1': (0, 0, 0, 1, 1, 1)},
+                 10: {'1': (0, 0, 0, 1, 0, 1)}}
+        correct = {7: {'x': [[-1, 1]],
                        'y': [[-1, 1]],
                        'z': [[-1, 1]]},
                    8: {'x': [[-1, 1], [0, 4]],
                        'y': [[-1, 1], [-1, 7]],
                        'z': [[-1, 1], [-4, 12]]}}
-        azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
-        mock_sweeping.assert_called_with(correct, 'x')
+        _verify(bodies, aabbs, correct, ignored=[6, 10], static=[9])
 
-    def test_computeCollisionSetsAABB_basic(self):
+        # Invalid AABB data.
+        bodies = {5: getRigidBody(position=(0, 0, 0))}
+        aabbs = {5: {'1': (0, 0, 0, 1, 1)}}
+        assert not azrael.leonard._compileAABBTable(bodies, aabbs).ok
+
+    def test_unionFind(self):
+        """
+        Compute the connected components of a few small graphs.
+        """
+        unionFind = azrael.leonard._unionFind
+
+        # No nodes, and nodes without edges.
+        assert unionFind(0, [], []).tolist() == []
+        assert unionFind(3, [], []).tolist() == [0, 1, 2]
+
+        # A chain that links all nodes in reverse order.
+        assert unionFind(4, [3, 2, 1], [2, 1, 0]).tolist() == [0, 0, 0, 0]
+
+        # Two components. Every node must carry the smallest node index of
+        # its component as the label.
+        src, dst = [5, 1, 4, 3], [3, 4, 1, 5]
+        assert unionFind(6, src, dst).tolist() == [0, 1, 2, 3, 1, 3]
+
+        # Self loops and duplicate edges must not matter.
+        src, dst = [2, 2, 0, 0], [2, 0, 2, 2]
+        assert unionFind(3, src, dst).tolist() == [0, 1, 0]
+
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_basic(self, engine):
         """
         Create three bodies. Then alter their AABBs to create various
         combinations of overlap.
         """
+        broadphase = azrael.leonard.broadphaseEngines[engine]()
+
         def testCCS(pos, AABBs, expected_objIDs):
             """
             Compute broadphase results for bodies  at ``pos`` with ``AABBs``
@@ -1205,7 +2130,7 @@ class TestBroadphase:
             AABBs = {str(idx): val for (idx, val) in enumerate(AABBs)}
 
             # Determine the list of broadphase collision sets.
-            ret = azrael.leonard.computeCollisionSetsAABB(bodies, AABBs)
+            ret = broadphase.collisionSets(bodies, AABBs)
             assert ret.ok
 
             # Convert the reference data to a sorted list of sets.
@@ -1259,7 +2184,8 @@ class TestBroadphase:
         correct_answer = (['0', '2'], ['1'])
         testCCS(pos, aabbs, correct_answer)
 
-    def test_computeCollisionSetsAABB_rotate_scale(self):
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_rotate_scale(self, engine):
         """
         Test broadphase when body has a different scale and/or is rotated.
 
@@ -1268,6 +2194,8 @@ class TestBroadphase:
         an offset. Use different scales and rotations to verify it is
         correctly taken into account during the broadphase.
         """
+        broadphase = azrael.leonard.broadphaseEngines[engine]()
+
         # Create the test body at the center. It is a centered unit cube.
         body_a = getRigidBody(position=(0, 0, 0), cshapes={'csbox': getCSBox()})
 
@@ -1292,7 +2220,7 @@ class TestBroadphase:
                      '2': {'1': [cs_ofs[0], cs_ofs[1], cs_ofs[2], 1, 1, 1]}}
 
             # Compute the broadphase collision sets.
-            ret = azrael.leonard.computeCollisionSetsAABB(bodies, aabbs)
+            ret = broadphase.collisionSets(bodies, aabbs)
             assert ret.ok
             coll_sets = ret.data
 
@@ -1415,11 +2343,14 @@ class TestBroadphase:
         # All objects must form one connected set.
         ccsWrapper([str(_) for _ in range(10)], [[str(_) for _ in range(10)]])
 
-    def test_computeCollisionSetsAABB_static(self):
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_static(self, engine):
         """
         Static bodies (ie every body with mass=0) must be added to every
         collision set.
         """
+        broadphase = azrael.leonard.broadphaseEngines[engine]()
+
         def testCCS(pos, AABBs, imasses, expected_objIDs):
             """
             Compute broadphase results for bodies at ``pos`` with ``masses``
@@ -1443,7 +2374,7 @@ class TestBroadphase:
             AABBs = {str(idx): val for (idx, val) in enumerate(AABBs)}
 
             # Determine the list of broadphase collision sets.
-            ret = azrael.leonard.computeCollisionSetsAABB(bodies, AABBs)
+            ret = broadphase.collisionSets(bodies, AABBs)
             assert ret.ok
 
             # Convert the reference data to a sorted list of sets.
@@ -1471,6 +2402,359 @@ class TestBroadphase:
         correct_answer = (['0', '1'], ['1', '2'])
         testCCS(pos, aabbs, imasses, correct_answer)
 
+    def test_broadphaseIncremental(self):
+        """
+        The incremental broadphase must produce the same collision sets as
+        ``computeCollisionSetsAABB`` while bodies move, spawn and disappear.
+        """
+        def canonical(collSets):
+            return sorted([tuple(sorted(_)) for _ in collSets])
+
+        # Create a random world with static bodies and bodies that have
+        # more than one AABB.
+        np.random.seed(1)
+        bodies, AABBs = {}, {}
+        for idx in range(50):
+            objID = str(idx)
+            bodies[objID] = getRigidBody(
+                position=np.random.uniform(-10, 10, 3).tolist(),
+                imass=0 if idx % 10 == 0 else 1)
+            AABBs[objID] = {'1': (0, 0, 0, 0.75, 0.75, 0.75)}
+            if idx % 7 == 0:
+                AABBs[objID]['2'] = (0.5, 0, 0, 0.25, 0.25, 0.25)
+
+        bp = azrael.leonard.BroadphaseIncremental()
+        for step in range(20):
+            # Move every dynamic body a little.
+            for objID, body in bodies.items():
+                if body.imass == 0:
+                    continue
+                pos = np.array(body.position) + np.random.normal(0, 0.3, 3)
+                bodies[objID] = body._replace(position=pos.tolist())
+
+            # Remove one body and spawn a new one.
+            objID = str(step)
+            bp.remove(objID)
+            del bodies[objID], AABBs[objID]
+
+            objID = str(100 + step)
+            bodies[objID] = getRigidBody(
+                position=np.random.uniform(-10, 10, 3).tolist())
+            AABBs[objID] = {'1': (0, 0, 0, 1, 1, 1)}
+            bp.insert(objID, bodies[objID], AABBs[objID])
+
+            # Both engines must agree.
+            ret_ref = azrael.leonard.computeCollisionSetsAABB(bodies, AABBs)
+            ret = bp.collisionSets(bodies, AABBs)
+            assert ret.ok and ret_ref.ok
+            assert canonical(ret.data) == canonical(ret_ref.data)
+
+        # The incremental engine must also pick up bodies it was not told
+        # about and forget those that are not passed to it anymore.
+        bodies = {_: bodies[_] for _ in list(bodies)[:10]}
+        AABBs = {_: AABBs[_] for _ in bodies}
+        ret_ref = azrael.leonard.computeCollisionSetsAABB(bodies, AABBs)
+        bp_inc = azrael.leonard.BroadphaseIncremental()
+        ret = bp_inc.collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == canonical(ret_ref.data)
+        ret = bp.collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == canonical(ret_ref.data)
+
+        # Invalid AABB data must produce an error.
+        objID = list(bodies)[0]
+        AABBs[objID] = {'1': (0, 0, 0)}
+        bp.insert(objID, bodies[objID], AABBs[objID])
+        assert not bp.collisionSets(bodies, AABBs).ok
+
+    def test_broadphaseGrid(self):
+        """
+        The grid broadphase must connect exactly those bodies whose AABBs
+        overlap. The collision sets of the sweeping engine must therefore
+        contain those of the grid engine.
+        """
+        # Create a random world that also contains a few huge bodies.
+        np.random.seed(1)
+        bodies, AABBs = {}, {}
+        for idx in range(200):
+            objID = str(idx)
+            bodies[objID] = getRigidBody(
+                position=np.random.uniform(-20, 20, 3).tolist())
+            size = 10 if idx % 50 == 0 else 1
+            AABBs[objID] = {'1': (0, 0, 0, size, size, 1)}
+
+        # Brute force reference: test all AABB pairs for overlap.
+        edges = []
+        for a in bodies:
+            for b in bodies:
+                pa = np.array(bodies[a].position)
+                pb = np.array(bodies[b].position)
+                ha = np.array(AABBs[a]['1'][3:])
+                hb = np.array(AABBs[b]['1'][3:])
+                if np.all(np.abs(pa - pb) <= ha + hb):
+                    edges.append((int(a), int(b)))
+        src, dst = zip(*edges)
+        labels = azrael.leonard._unionFind(len(bodies), src, dst)
+        ref = {}
+        for objID, label in zip(bodies, labels):
+            ref.setdefault(label, []).append(objID)
+        ref = sorted([tuple(sorted(_)) for _ in ref.values()])
+
+        # Small cells and a small maxCells value force some bodies through
+        # the dedicated code path for large AABBs.
+        for cellSize, maxCells in [(None, 64), (0.5, 8), (20, 64)]:
+            bp = azrael.leonard.BroadphaseGrid(cellSize, maxCells)
+            ret = bp.collisionSets(bodies, AABBs)
+            assert ret.ok
+            assert sorted([tuple(sorted(_)) for _ in ret.data]) == ref
+
+        # Every grid set must be a subset of a sweeping set.
+        ret = azrael.leonard.computeCollisionSetsAABB(bodies, AABBs)
+        for collSet in ref:
+            assert any(set(collSet) <= set(_) for _ in ret.data)
+
+        # Leonard must use the grid broadphase if requested.
+        leo = azrael.leonard.LeonardBase(broadphase='grid')
+        assert isinstance(leo.broadphase, azrael.leonard.BroadphaseGrid)
+
+    def test_broadphaseBVH(self):
+        """
+        The BVH broadphase must produce the same collision sets as the grid
+        broadphase while bodies of very different sizes move, spawn and
+        disappear.
+        """
+        def canonical(collSets):
+            return sorted([tuple(sorted(_)) for _ in collSets])
+
+        # Create a world with tiny, medium and huge bodies.
+        np.random.seed(1)
+        bodies, AABBs = {}, {}
+        for idx in range(100):
+            objID = str(idx)
+            bodies[objID] = getRigidBody(
+                position=np.random.uniform(-20, 20, 3).tolist())
+            size = [0.01, 1, 10][idx % 3] if idx % 10 == 0 else 1
+            AABBs[objID] = {'1': (0, 0, 0, size, size, size)}
+
+        # Only the first step may build the tree from scratch.
+        bp = azrael.leonard.BroadphaseBVH(rebuildFraction=1)
+        for step in range(10):
+            # Move every body a little.
+            for objID, body in bodies.items():
+                pos = np.array(body.position) + np.random.normal(0, 0.1, 3)
+                bodies[objID] = body._replace(position=pos.tolist())
+
+            # Remove one body and spawn a new one.
+            objID = str(step)
+            bp.remove(objID)
+            del bodies[objID], AABBs[objID]
+
+            objID = str(100 + step)
+            bodies[objID] = getRigidBody(
+                position=np.random.uniform(-20, 20, 3).tolist())
+            AABBs[objID] = {'1': (0, 0, 0, 1, 1, 1)}
+            bp.insert(objID, bodies[objID], AABBs[objID])
+
+            bp_ref = azrael.leonard.BroadphaseGrid()
+            ret_ref = bp_ref.collisionSets(bodies, AABBs)
+            ret = bp.collisionSets(bodies, AABBs)
+            assert ret.ok and ret_ref.ok
+            assert canonical(ret.data) == canonical(ret_ref.data)
+
+            # The small movements must not have triggered a rebuild. The
+            # tree must contain every body.
+            assert (step == 0) or (bp.numChanges > 0)
+            assert np.count_nonzero(bp.slotLeaf >= 0) == len(bodies)
+
+        # A static body must leave the tree.
+        objID = list(bodies)[0]
+        bodies[objID] = bodies[objID]._replace(imass=0)
+        ret = bp.collisionSets(bodies, AABBs)
+        assert np.count_nonzero(bp.slotLeaf >= 0) == len(bodies) - 1
+        ret_ref = azrael.leonard.BroadphaseGrid().collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == canonical(ret_ref.data)
+
+    def test_broadphaseReuse(self):
+        """
+        The reuse broadphase must return the previous collision sets as long
+        as all bodies remain inside their fat AABBs, and only recompute the
+        sets of the bodies that escaped.
+        """
+        def canonical(collSets):
+            return sorted([tuple(sorted(_)) for _ in collSets])
+
+        # Three unit cubes in a row. Only the first one moves.
+        bodies = {
+            '1': getRigidBody(position=[0, 0, 0], velocityLin=[1, 0, 0]),
+            '2': getRigidBody(position=[5, 0, 0]),
+            '3': getRigidBody(position=[10, 0, 0]),
+        }
+        AABBs = {_: {'1': (0, 0, 0, 1, 1, 1)} for _ in bodies}
+
+        # The first step computes all sets. The fat AABB of the first body
+        # extends 0.2 in every direction.
+        bp = azrael.leonard.BroadphaseReuse(dt=0.1, lookahead=2)
+        ret = bp.collisionSets(bodies, AABBs)
+        assert ret.ok
+        assert canonical(ret.data) == [('1',), ('2',), ('3',)]
+        assert bp.stats == {'update': 'full', 'reused': 0, 'recomputed': 3}
+
+        # Move the first body inside its fat AABB: reuse all sets.
+        bodies['1'] = bodies['1']._replace(position=[0.1, 0, 0])
+        ret = bp.collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == [('1',), ('2',), ('3',)]
+        assert bp.stats == {'update': 'reuse', 'reused': 3, 'recomputed': 0}
+
+        # Move it next to the second body: only its new set is recomputed.
+        bodies['1'] = bodies['1']._replace(position=[4, 0, 0])
+        ret = bp.collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == [('1', '2'), ('3',)]
+        assert bp.stats == {'update': 'partial', 'reused': 1, 'recomputed': 1}
+
+        # Removing a body does not affect the other sets.
+        bp.remove('3')
+        del bodies['3'], AABBs['3']
+        ret = bp.collisionSets(bodies, AABBs)
+        assert canonical(ret.data) == [('1', '2')]
+        assert bp.stats == {'update': 'reuse', 'reused': 1, 'recomputed': 0}
+
+        # Leonard must use the reuse broadphase by default.
+        leo = azrael.leonard.LeonardBase()
+        assert isinstance(leo.broadphase, azrael.leonard.BroadphaseReuse)
+
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_multiShape(self, engine):
+        """
+        The engines first compare the boxes that enclose all AABBs of a body,
+        and only then the individual AABBs.
+        """
+        broadphase = azrael.leonard.broadphaseEngines[engine]()
+
+        # Body '1' has two AABBs, one on either side of body '2'. Only the
+        # enclosing box of body '1' overlaps with body '2'. Body '3' touches
+        # the right AABB of body '1'.
+        bodies = {
+            '1': getRigidBody(position=(0, 0, 0)),
+            '2': getRigidBody(position=(0, 0, 0)),
+            '3': getRigidBody(position=(6.5, 0, 0)),
+        }
+        AABBs = {
+            '1': {'l': (-5, 0, 0, 1, 1, 1), 'r': (5, 0, 0, 1, 1, 1)},
+            '2': {'1': (0, 0, 0, 0.5, 0.5, 0.5)},
+            '3': {'1': (0, 0, 0, 0.5, 0.5, 0.5)},
+        }
+
+        def verify(expected):
+            ret = broadphase.collisionSets(bodies, AABBs)
+            assert ret.ok
+            computed = sorted([tuple(sorted(_)) for _ in ret.data])
+            assert computed == sorted([tuple(sorted(_)) for _ in expected])
+
+        verify([['1', '3'], ['2']])
+
+        # Move body '2' onto the left AABB of body '1'.
+        bodies['2'] = bodies['2']._replace(position=(-4, 0, 0))
+        verify([['1', '2', '3']])
+
+        # Move body '3' away from body '1' but keep it inside its enclosing
+        # box.
+        bodies['3'] = bodies['3']._replace(position=(2, 0, 0))
+        verify([['1', '2'], ['3']])
+
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_static_planes(self, engine):
+        """
+        Static bodies and planes must only be added to the collision sets
+        they touch.
+        """
+        broadphase = azrael.leonard.broadphaseEngines[engine]()
+
+        # Two dynamic bodies far apart and a static box next to the first.
+        # The ground plane (z=-5) only touches the second body. A static box
+        # far away from everything must not appear in any collision set.
+        plane = getCSPlane(normal=(0, 0, 1), ofs=-5)
+        bodies = {
+            '1': getRigidBody(position=(0, 0, 0)),
+            '2': getRigidBody(position=(10, 0, -4.5)),
+            'box': getRigidBody(position=(1.5, 0, 0), imass=0),
+            'far': getRigidBody(position=(100, 100, 100), imass=0),
+            'plane': getRigidBody(imass=0, cshapes={'csplane': plane}),
+        }
+        AABBs = {
+            '1': {'1': (0, 0, 0, 1, 1, 1)},
+            '2': {'1': (0, 0, 0, 1, 1, 1)},
+            'box': {'1': (0, 0, 0, 1, 1, 1)},
+            'far': {'1': (0, 0, 0, 1, 1, 1)},
+            'plane': {'csplane': (0, 0, 0, 0, 0, 0)},
+        }
+
+        def verify(expected):
+            ret = broadphase.collisionSets(bodies, AABBs)
+            assert ret.ok
+            computed = sorted([tuple(sorted(_)) for _ in ret.data])
+            assert computed == sorted([tuple(sorted(_)) for _ in expected])
+
+        verify([['1', 'box'], ['2', 'plane']])
+
+        # Move the plane body up: now both bodies touch the plane.
+        bodies['plane'] = bodies['plane']._replace(position=(0, 0, 4.5))
+        verify([['1', 'box', 'plane'], ['2', 'plane']])
+
+        # Rotate the plane body 180 degrees around the x-axis and move it
+        # down. The plane now faces down and passes through z=0.5, which means
+        # only body '1' (partially) lies behind it.
+        bodies['plane'] = bodies['plane']._replace(
+            position=(0, 0, -4.5), rotation=(1, 0, 0, 0))
+        verify([['1', 'box', 'plane'], ['2']])
+
+    @pytest.mark.parametrize('engine', allBroadphases)
+    def test_computeCollisionSetsAABB_tight(self, engine):
+        """
+        The 'tight' AABB mode must take the current rotation of each body and
+        collision shape into account, whereas the 'conservative' mode uses
+        the rotation invariant AABBs from ``leoAPI.computeAABBs``.
+        """
+        Engine = azrael.leonard.broadphaseEngines[engine]
+
+        # Two parallel rods (10 units long) that are 1 unit apart.
+        cs = {'rod': getCSBox(dim=(5, 0.1, 0.1))}
+        bodies = {
+            '1': getRigidBody(position=(0, 0, 0), cshapes=cs),
+            '2': getRigidBody(position=(0, 1, 0), cshapes=cs),
+        }
+        AABBs = {_: leoAPI.computeAABBs(cs).data for _ in bodies}
+
+        def verify(aabbMode, expected):
+            ret = Engine(aabbMode=aabbMode).collisionSets(bodies, AABBs)
+            assert ret.ok
+            computed = sorted([tuple(sorted(_)) for _ in ret.data])
+            assert computed == sorted([tuple(sorted(_)) for _ in expected])
+
+        # The conservative AABBs overlap whereas the tight ones do not.
+        verify('conservative', [['1', '2']])
+        verify('tight', [['1'], ['2']])
+
+        # Rotate the second rod 90 degrees around the z-axis. It now points
+        # along the y-axis and crosses the first rod.
+        rot = (0, 0, np.sin(np.pi / 4), np.cos(np.pi / 4))
+        bodies['2'] = bodies['2']._replace(rotation=rot)
+        verify('conservative', [['1', '2']])
+        verify('tight', [['1', '2']])
+
+        # Same, but rotate the collision shape itself instead of the body.
+        cs_rot = {'rod': getCSBox(rot=rot, dim=(5, 0.1, 0.1))}
+        bodies['2'] = getRigidBody(position=(0, 1, 0), cshapes=cs_rot)
+        verify('tight', [['1', '2']])
+
+        # Move the second rod far enough to pass the first rod.
+        bodies['2'] = bodies['2']._replace(position=(0, 5.2, 0))
+        verify('tight', [['1'], ['2']])
+
+        # Collision set statistics.
+        stats = azrael.leonard.collisionSetStats([{'1', '2'}, {'3'}])
+        assert stats == {'num': 2, 'bodies': 3, 'mean': 1.5,
+                         'p95': 1.95, 'max': 2}
+        assert azrael.leonard.collisionSetStats([])['max'] == 0
+
     def test_skipEmpty(self):
         """
         Verify that _skipEmptyBodies removes all bodies that have a) exactly
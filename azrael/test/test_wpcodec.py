@@ -0,0 +1,118 @@
+# Copyright 2016, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+import pytest
+import numpy as np
+import azrael.wpcodec as wpcodec
+
+from IPython import embed as ipshell
+from azrael.bodystore import BodyStore
+from azrael.test.test import getRigidBody, getCSBox, getCSSphere
+
+
+class TestWPCodec:
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def setup_method(self, method):
+        pass
+
+    def teardown_method(self, method):
+        pass
+
+    def test_workpackage(self):
+        """
+        Encode a Work Package and decode it again.
+        """
+        store = BodyStore()
+        body_1 = getRigidBody(imass=2, position=[1, 2, 3], version=5,
+                              cshapes={'cs': getCSBox()})
+        body_2 = getRigidBody(velocityLin=[-1, 0, 1],
+                              cshapes={'cs': getCSSphere()})
+        store['1'], store['2'] = body_1, body_2
+
+        slots = store.indices(['2', '1'])
+        state = wpcodec.packState(store, slots)
+        assert state.shape == (2, wpcodec.wpWidth)
+        forces = np.array([[1, 2, 3, -1, -2, -3], [4, 5, 6, -4, -5, -6]])
+
+        wp = {'wpid': 1, 'wpmeta': (1, 0.1, 60), 'aids': ['2', '1'],
+              'cshapes': [body_2.cshapes, body_1.cshapes], 'state': state,
+              'forces': forces, 'wpconstraints': [], 'drop': []}
+
+        # The Work Package consists of the header and the arrays.
+        frames = wpcodec.encodeWorkPackage(wp)
+        assert len(frames) == 3
+        assert isinstance(frames[0], bytes)
+        assert frames[1].nbytes == state.nbytes
+
+        # Decode the raw bytes again. The arrays must use the memory of the
+        # frames instead of a copy.
+        bufs = [frames[0]] + [bytes(_) for _ in frames[1:]]
+        out = wpcodec.decodeWorkPackage(bufs)
+        assert out['aids'] == wp['aids'] and out['wpmeta'] == wp['wpmeta']
+        assert np.array_equal(out['state'], state)
+        assert np.array_equal(out['forces'], forces)
+        assert not out['state'].flags.writeable
+        assert not out['state'].flags.owndata
+
+        # Unpack the bodies.
+        data = wpcodec.unpackBodies(out)
+        assert [_.aid for _ in data] == ['2', '1']
+        assert data[0].rbs == body_2 and data[1].rbs == body_1
+        assert isinstance(data[1].rbs.version, int)
+        assert data[0].force == [1, 2, 3] and data[1].torque == [-4, -5, -6]
+
+        # The Worker already holds body '1': the Work Package only contains
+        # its forces.
+        wp.update({'state': state[:1], 'cshapes': wp['cshapes'][:1]})
+        out = wpcodec.decodeWorkPackage(wpcodec.encodeWorkPackage(wp))
+        assert out['state'].shape == (1, wpcodec.wpWidth)
+        data = wpcodec.unpackBodies(out)
+        assert len(data) == 1 and data[0].rbs == body_2
+
+    def test_result(self):
+        """
+        Encode a Worker result and decode it again.
+        """
+        state = np.arange(3 * wpcodec.retWidth, dtype=np.float64)
+        state = state.reshape(3, wpcodec.retWidth)
+        ret = {'wpid': 2, 'aids': ['1', '2', '3'], 'state': state,
+               'collisions': [('1', '2', [])]}
+
+        wpid, header, data = wpcodec.encodeResult(ret)
+        frames = [memoryview(wpid), header, memoryview(bytes(data))]
+        out = wpcodec.decodeResult(frames)
+        assert out['wpid'] == 2 and out['collisions'] == ret['collisions']
+
+        # The wpid is available without decoding the rest.
+        assert wpcodec.resultID(frames) == 2
+        assert np.array_equal(out['state'], state)
+
+        # The layout covers the motion state of the bodies.
+        pos = out['state'][:, wpcodec.retLayout['position']]
+        assert pos.shape == (3, 3)
+        assert np.array_equal(pos[0], [0, 1, 2])
+
+        # Empty results are valid as well.
+        ret = {'wpid': 3, 'aids': [], 'state': state[:0], 'collisions': []}
+        out = wpcodec.decodeResult(wpcodec.encodeResult(ret))
+        assert out['state'].shape == (0, wpcodec.retWidth)
@@ -0,0 +1,201 @@
+# Copyright 2016, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary wire format for Work Packages and their results.
+
+A Work Package (see ``LeonardDistributedZeroMQ.createWorkPackage``) keeps
+the numeric state of its bodies in contiguous float64 arrays with one row
+per body: 'state' holds the body fields and 'forces' the total force and
+torque. On the wire it consists of a small pickled header with everything
+else (eg object IDs, collision shapes, constraints), followed by one ZeroMQ
+frame with the raw bytes of every array. The results from the Workers have
+the same layout, except that their state array only contains the motion
+state, and they start with an extra frame that holds the wpid. This allows
+Leonard to discard late duplicates without decoding them (see
+``resultID``).
+
+The Workers keep the bodies they have seen (see ``LeonardWorkerZeroMQ``).
+Work Packages therefore need not contain the state of every body. The
+'aids' list names all bodies in the Work Package, but only the first
+``len(state)`` of them have a row in the 'state' array (and an entry in
+'cshapes'). The Worker already holds the others. The 'forces' array always
+has one row per body, and the 'drop' list names the bodies the Worker can
+forget.
+
+The receiver maps the arrays directly onto the frame buffers instead of
+deserialising them. Send the frames with ``copy=False`` to avoid copies on
+the sender side as well.
+"""
+import pickle
+import numpy as np
+
+from azrael.bodystore import BodyStore
+from azrael.aztypes import RigidBodyData, WPDataOut
+
+
+def _layout(columns):
+    """
+    Return the {name: slice} mapping and total width for ``columns``.
+    """
+    out, ofs = {}, 0
+    for name, width in columns:
+        out[name] = slice(ofs, ofs + max(width, 1))
+        ofs += max(width, 1)
+    return out, ofs
+
+
+# The columns of the state array in Work Packages (ie all numeric body
+# fields), and of the forces array.
+wpColumns = tuple(BodyStore.bodyFields.items())
+wpLayout, wpWidth = _layout(wpColumns)
+forceLayout, forceWidth = _layout((('force', 3), ('torque', 3)))
+
+# The columns of the state array in results (ie the motion state).
+retColumns = tuple((_, BodyStore.bodyFields[_])
+                   for _ in BodyStore.motionFields)
+retLayout, retWidth = _layout(retColumns)
+
+
+def packState(store, slots: np.ndarray):
+    """
+    Return the Work Package state array for the bodies in ``slots``.
+
+    :param BodyStore store: the bodies.
+    :param ndarray slots: the slots of the bodies in ``store``.
+    :return: Nx``wpWidth`` array.
+    :rtype: ndarray
+    """
+    state = np.empty((len(slots), wpWidth), np.float64)
+    for name, _ in wpColumns:
+        value = getattr(store, name)[slots]
+        state[:, wpLayout[name]] = value.reshape(len(slots), -1)
+    return state
+
+
+def unpackBodies(wp: dict):
+    """
+    Return the bodies with a state in ``wp`` as ``WPDataOut`` tuples.
+
+    :param dict wp: Work Package.
+    :return: list of ``WPDataOut`` tuples.
+    :rtype: list
+    """
+    state = wp['state']
+    aids, forces = wp['aids'][:len(state)], wp['forces'][:len(state)]
+    columns = []
+    for name in RigidBodyData._fields:
+        if name == 'cshapes':
+            columns.append(wp['cshapes'])
+            continue
+        values = state[:, wpLayout[name]]
+        if BodyStore.bodyFields[name] > 0:
+            columns.append([tuple(_) for _ in values.tolist()])
+        elif name == 'version':
+            columns.append(values[:, 0].astype(np.int64).tolist())
+        else:
+            columns.append(values[:, 0].tolist())
+    bodies = [RigidBodyData._make(_) for _ in zip(*columns)]
+    force = forces[:, forceLayout['force']].tolist()
+    torque = forces[:, forceLayout['torque']].tolist()
+    return [WPDataOut(*_) for _ in zip(aids, bodies, force, torque)]
+
+
+def _encode(msg: dict):
+    """
+    Return the header and array frames for ``msg``.
+    """
+    names = [k for k, v in msg.items() if isinstance(v, np.ndarray)]
+    header = {k: v for k, v in msg.items() if k not in names}
+    header['arrays'] = [(_, msg[_].shape) for _ in names]
+    arrays = [np.ascontiguousarray(msg[_], np.float64) for _ in names]
+    return [pickle.dumps(header)] + arrays
+
+
+def _decode(frames: list):
+    """
+    Inverse of ``_encode``.
+
+    The arrays share the memory of the frames (ie they are read only).
+    """
+    msg = pickle.loads(frames[0])
+    for (name, shape), buf in zip(msg.pop('arrays'), frames[1:]):
+        msg[name] = np.frombuffer(buf, np.float64).reshape(shape)
+    return msg
+
+
+def encodeWorkPackage(wp: dict):
+    """
+    Return the ZeroMQ frames for the Work Package ``wp``.
+
+    :param dict wp: Work Package.
+    :return: [header, *arrays] where header is bytes and the rest ndarrays.
+    :rtype: list
+    """
+    return _encode(wp)
+
+
+def decodeWorkPackage(frames: list):
+    """
+    Return the Work Package encoded in ``frames``.
+
+    :param list frames: the frames from ``encodeWorkPackage`` (bytes, or
+                        anything else that supports the buffer protocol).
+    :return: Work Package.
+    :rtype: dict
+    """
+    return _decode(frames)
+
+
+def encodeResult(result: dict):
+    """
+    Return the ZeroMQ frames for the Worker ``result``.
+
+    The ``result`` contains the 'wpid', the 'aids' of the bodies, their new
+    motion 'state' (Nx``retWidth`` array) and the 'collisions'.
+
+    :param dict result: the processed Work Package.
+    :return: [wpid, header, *arrays] where wpid and header are bytes and the
+             rest ndarrays.
+    :rtype: list
+    """
+    return [str(result['wpid']).encode('ascii')] + _encode(result)
+
+
+def resultID(frames: list):
+    """
+    Return the wpid of the Worker result encoded in ``frames``.
+
+    This only inspects the first frame, ie it is much cheaper than
+    ``decodeResult``.
+
+    :param list frames: the frames from ``encodeResult``.
+    :return: wpid
+    :rtype: int
+    """
+    return int(bytes(frames[0]))
+
+
+def decodeResult(frames: list):
+    """
+    Return the Worker result encoded in ``frames``.
+
+    :param list frames: the frames from ``encodeResult``.
+    :return: the processed Work Package.
+    :rtype: dict
+    """
+    return _decode(frames[1:])
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the broadphase engines in Leonard.
+
+Every engine processes the same sequence of steps. In each step all bodies
+move a little, and a few bodies disappear and re-spawn elsewhere.
+
+All bodies are randomly oriented rods. This makes the difference between the
+'conservative' and 'tight' AABB modes visible in the collision set sizes.
+Use '--shapes' to assemble each rod from several boxes.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# Import the Azrael package from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import azrael.leonard
+import azrael.leo_api as leoAPI
+from azrael.test.test import getRigidBody, getCSBox
+
+
+def parseCommandLine():
+    """
+    Parse program arguments.
+    """
+    # Create the parser.
+    parser = argparse.ArgumentParser(
+        description=('Benchmark the broadphase engines'),
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # Shorthand.
+    padd = parser.add_argument
+
+    # Add the command line options.
+    padd('--bodies', metavar='N', type=int, default=10000,
+         help='Number of bodies')
+    padd('--steps', metavar='N', type=int, default=20,
+         help='Number of steps')
+    padd('--churn', metavar='N', type=int, default=10,
+         help='Number of bodies to re-spawn in every step')
+    padd('--density', metavar='X', type=float, default=0.02,
+         help='Average number of bodies per unit volume')
+    padd('--engines', metavar='NAME', nargs='+',
+         default=sorted(azrael.leonard.broadphaseEngines),
+         help='Broadphase engines to benchmark')
+    padd('--aabb-mode', metavar='MODE', nargs='+',
+         default=['conservative', 'tight'],
+         choices=['conservative', 'tight'],
+         help='AABB modes to benchmark')
+    padd('--elongation', metavar='X', type=float, default=10,
+         help='Length-to-width ratio of the rods')
+    padd('--shapes', metavar='N', type=int, default=1,
+         help='Number of boxes per rod')
+    padd('--dt', metavar='X', type=float, default=0.05,
+         help='Step size in seconds')
+    padd('--moving', metavar='X', type=float, default=1,
+         help='Fraction of bodies that move')
+
+    # Run the parser.
+    return parser.parse_args()
+
+
+def createWorld(param, rng):
+    """
+    Return the initial bodies and AABBs for the benchmark.
+    """
+    # Edge length of the cube that contains all bodies.
+    size = (param.bodies / param.density) ** (1 / 3)
+
+    # All bodies are rods with the same volume as a unit cube. Every rod
+    # consists of `param.shapes` boxes along its x-axis.
+    width = 0.5 / param.elongation ** (1 / 3)
+    length = width * param.elongation / param.shapes
+    cshapes = {}
+    for idx in range(param.shapes):
+        pos = (2 * idx - param.shapes + 1) * length
+        cshapes[str(idx)] = getCSBox(
+            pos=(pos, 0, 0), dim=(length, width, width))
+    aabbs = leoAPI.computeAABBs(cshapes).data
+
+    # Only the fraction `param.moving` of bodies has a velocity.
+    bodies, AABBs = {}, {}
+    for idx in range(param.bodies):
+        objID = str(idx)
+        pos = rng.uniform(0, size, 3)
+        rot = rng.normal(0, 1, 4)
+        rot /= np.linalg.norm(rot)
+        vel = rng.normal(0, 1, 3) * (rng.uniform() < param.moving)
+        bodies[objID] = getRigidBody(
+            position=pos.tolist(), rotation=rot.tolist(),
+            velocityLin=vel.tolist(), cshapes=cshapes)
+        AABBs[objID] = aabbs
+    return size, bodies, AABBs
+
+
+def runEngine(name, aabbMode, param):
+    """
+    Run the benchmark for the engine ``name`` and return the step times and
+    the collision set statistics of the last step.
+    """
+    rng = np.random.RandomState(1)
+    size, bodies, AABBs = createWorld(param, rng)
+    engine = azrael.leonard.broadphaseEngines[name](aabbMode=aabbMode)
+    if isinstance(engine, azrael.leonard.BroadphaseReuse):
+        engine.dt = param.dt
+    for objID in bodies:
+        engine.insert(objID, bodies[objID], AABBs[objID])
+
+    etime = []
+    objIDs = list(bodies)
+    for step in range(param.steps):
+        # Move all bodies.
+        pos = np.array([_.position for _ in bodies.values()])
+        pos += param.dt * np.array([_.velocityLin for _ in bodies.values()])
+        bodies = {k: v._replace(position=p.tolist())
+                  for (k, v), p in zip(bodies.items(), pos)}
+
+        # Re-spawn a few bodies elsewhere.
+        for objID in rng.choice(objIDs, param.churn, replace=False):
+            engine.remove(objID)
+            pos = rng.uniform(0, size, 3)
+            bodies[objID] = bodies[objID]._replace(position=pos.tolist())
+            engine.insert(objID, bodies[objID], AABBs[objID])
+
+        t0 = time.perf_counter()
+        ret = engine.collisionSets(bodies, AABBs)
+        etime.append(time.perf_counter() - t0)
+        assert ret.ok
+    return np.array(etime), azrael.leonard.collisionSetStats(ret.data)
+
+
+def main():
+    # Parse command line arguments.
+    param = parseCommandLine()
+
+    print('Bodies: {}, Steps: {}'.format(param.bodies, param.steps))
+    print('{:>12}  {:>12}  {:>10}  {:>10}  {:>10}  {:>8}  {:>8}  {:>8}  {:>8}'
+          .format('Engine', 'AABB Mode', 'First (ms)', 'Mean (ms)',
+                  'Min (ms)', 'Sets', 'Mean', 'P95', 'Max'))
+    for name in param.engines:
+        for aabbMode in param.aabb_mode:
+            etime, stats = runEngine(name, aabbMode, param)
+
+            # The first step is special because the incremental engines must
+            # build their state from scratch.
+            etime = 1000 * etime
+            rest = etime[1:] if len(etime) > 1 else etime
+            print('{:>12}  {:>12}  {:10.1f}  {:10.1f}  {:10.1f}  '
+                  '{:8d}  {:8.1f}  {:8.1f}  {:8d}'.format(
+                      name, aabbMode, etime[0], np.mean(rest), np.min(rest),
+                      stats['num'], stats['mean'], stats['p95'],
+                      stats['max']))
+
+
+if __name__ == '__main__':
+    main()
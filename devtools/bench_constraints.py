@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the merging of collision sets via constraints.
+
+The bodies form small collision sets, and the constraints link random bodies
+into chains (eg tethers). Use '--reference' to also time the original
+list based algorithm and verify that both produce the same output. Beware:
+the reference algorithm is quadratic and slow for the default sizes.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+# Import the Azrael package from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import azrael.leonard
+
+
+def parseCommandLine():
+    """
+    Parse program arguments.
+    """
+    # Create the parser.
+    parser = argparse.ArgumentParser(
+        description=('Benchmark mergeConstraintSets'),
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # Shorthand.
+    padd = parser.add_argument
+
+    # Add the command line options.
+    padd('--bodies', metavar='N', type=int, default=50000,
+         help='Number of bodies')
+    padd('--constraints', metavar='N', type=int, default=10000,
+         help='Number of constraints')
+    padd('--chain', metavar='N', type=int, default=20,
+         help='Number of constraints per chain')
+    padd('--repeat', metavar='N', type=int, default=5,
+         help='Number of repetitions')
+    padd('--reference', action='store_true', default=False,
+         help='Also time (and compare with) the original algorithm')
+
+    # Run the parser.
+    return parser.parse_args()
+
+
+def referenceMerge(constraintPairs, collSets):
+    """
+    The original (quadratic) version of ``mergeConstraintSets``.
+    """
+    for (a, b) in constraintPairs:
+        s_a = [collSets.pop(ii) for ii, v in enumerate(collSets) if a in v]
+        s_b = [collSets.pop(ii) for ii, v in enumerate(collSets) if b in v]
+        s_a = s_a[0] if len(s_a) == 1 else []
+        s_b = s_b[0] if len(s_b) == 1 else []
+        collSets.append(set(s_a).union(s_b))
+    return collSets
+
+
+def createWorld(param, rng):
+    """
+    Return the collision sets and constraint pairs for the benchmark.
+    """
+    # Partition the (shuffled) bodies into collision sets with 1-4 members.
+    objIDs = [str(_) for _ in rng.permutation(param.bodies)]
+    sizes = rng.randint(1, 5, param.bodies)
+    stops = np.cumsum(sizes)
+    stops = stops[stops < param.bodies].tolist() + [param.bodies]
+    starts = [0] + stops[:-1]
+    collSets = [set(objIDs[a:b]) for a, b in zip(starts, stops)]
+
+    # Link random bodies into chains.
+    pairs = []
+    while len(pairs) < param.constraints:
+        chain = rng.choice(objIDs, param.chain + 1, replace=False)
+        pairs.extend(zip(chain[:-1], chain[1:]))
+    return collSets, pairs[:param.constraints]
+
+
+def timeMerge(func, pairs, collSets, repeat):
+    """
+    Return the output and the fastest runtime of ``func``.
+    """
+    etime = []
+    for ii in range(repeat):
+        tmp = [set(_) for _ in collSets]
+        t0 = time.perf_counter()
+        out = func(pairs, tmp)
+        etime.append(time.perf_counter() - t0)
+    return out, min(etime)
+
+
+def main():
+    # Parse command line arguments.
+    param = parseCommandLine()
+
+    rng = np.random.RandomState(1)
+    collSets, pairs = createWorld(param, rng)
+    print('Bodies: {}, Sets: {}, Constraints: {}'.format(
+        param.bodies, len(collSets), len(pairs)))
+
+    def _merge(pairs, collSets):
+        ret = azrael.leonard.mergeConstraintSets(pairs, collSets)
+        assert ret.ok
+        return ret.data
+
+    out, etime = timeMerge(_merge, pairs, collSets, param.repeat)
+    print('mergeConstraintSets: {:8.1f}ms  {} sets'.format(
+        1000 * etime, len(out)))
+
+    if param.reference:
+        ref, etime = timeMerge(referenceMerge, pairs, collSets, 1)
+        print('Reference:           {:8.1f}ms  {} sets'.format(
+            1000 * etime, len(ref)))
+        assert ref == out
+        print('Outputs are identical')
+
+
+if __name__ == '__main__':
+    main()
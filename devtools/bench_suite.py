@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scaling benchmarks for the broadphase functions in Leonard.
+
+The suite generates synthetic worlds of different sizes and times
+``sweeping``, ``computeCollisionSetsAABB``, ``mergeConstraintSets`` and
+``getFinalCollisionSets`` on them. The worlds are:
+
+* uniform: unit cubes, uniformly distributed,
+* swarms: unit cubes in dense clusters,
+* chains: like 'uniform', but constraints link the bodies into long chains,
+* statics: like 'uniform', plus large static boxes and a ground plane,
+* ships: bodies that consist of a row of modules, ie several AABBs.
+
+Every benchmark reports the fastest and mean runtime, the peak memory
+allocated during one (separate) run, the number of collision sets and the
+size of the largest one. Use '--output' to also save the results as JSON,
+eg to compare them between releases.
+
+Beware: the large worlds take a while to generate and to process. Use
+'--bodies' to restrict the world sizes.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+# Import the Azrael package from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import azrael.leonard
+from azrael.test.test import getRigidBody, getCSBox, getCSPlane
+
+# All worlds and benchmarks (in the order they run).
+allWorlds = ['uniform', 'swarms', 'chains', 'statics', 'ships']
+allBenchmarks = ['sweeping', 'computeCollisionSetsAABB',
+                 'mergeConstraintSets', 'getFinalCollisionSets']
+
+
+def parseCommandLine():
+    """
+    Parse program arguments.
+    """
+    # Create the parser.
+    parser = argparse.ArgumentParser(
+        description=('Scaling benchmarks for the broadphase'),
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # Shorthand.
+    padd = parser.add_argument
+
+    # Add the command line options.
+    padd('--bodies', metavar='N', type=int, nargs='+',
+         default=[1000, 10000, 100000, 200000],
+         help='Number of bodies in the worlds')
+    padd('--worlds', metavar='NAME', nargs='+', default=allWorlds,
+         choices=allWorlds, help='Worlds to generate')
+    padd('--benchmarks', metavar='NAME', nargs='+', default=allBenchmarks,
+         choices=allBenchmarks, help='Functions to benchmark')
+    padd('--engines', metavar='NAME', nargs='+', default=['sweeping'],
+         choices=sorted(azrael.leonard.broadphaseEngines),
+         help='Broadphase engines for getFinalCollisionSets')
+    padd('--density', metavar='X', type=float, default=0.02,
+         help='Average number of bodies per unit volume')
+    padd('--repeat', metavar='N', type=int, default=3,
+         help='Number of repetitions')
+    padd('--seed', metavar='N', type=int, default=1,
+         help='Seed for the random number generator')
+    padd('--output', metavar='FILE', type=str, default=None,
+         help='Save the results to this JSON file')
+
+    # Run the parser.
+    return parser.parse_args()
+
+
+def createWorld(name, numBodies, density, rng):
+    """
+    Return the bodies, AABBs and constraint pairs of the world ``name``.
+
+    :param str name: name of world (see ``allWorlds``).
+    :param int numBodies: number of dynamic bodies.
+    :param float density: average number of bodies per unit volume.
+    :param RandomState rng: random number generator.
+    :return: (bodies, AABBs, constraintPairs)
+    """
+    # Edge length of the cube that contains all bodies.
+    size = (numBodies / density) ** (1 / 3)
+
+    if name == 'swarms':
+        # Clusters of about 100 bodies that are ten times denser than the
+        # other worlds.
+        num_swarms = max(1, numBodies // 100)
+        centers = rng.uniform(0, size, (num_swarms, 3))
+        spread = (100 / (10 * density)) ** (1 / 3) / 2
+        pos = centers[rng.randint(0, num_swarms, numBodies)]
+        pos += rng.normal(0, spread, (numBodies, 3))
+    else:
+        pos = rng.uniform(0, size, (numBodies, 3))
+
+    # Every ship consists of eight modules along its x-axis. All other bodies
+    # are unit cubes.
+    if name == 'ships':
+        aabbs = {str(_): (2 * _ - 7, 0, 0, 0.5, 0.5, 0.5) for _ in range(8)}
+    else:
+        aabbs = {'1': (0, 0, 0, 0.5, 0.5, 0.5)}
+
+    # Cloning a template is much faster than creating every body from scratch.
+    template = getRigidBody(cshapes={'1': getCSBox()})
+    bodies, AABBs = {}, {}
+    for idx, p in enumerate(pos.tolist()):
+        objID = str(idx)
+        bodies[objID] = template._replace(position=p)
+        AABBs[objID] = aabbs
+
+    # Large static boxes (one for every 1000 bodies) and a ground plane.
+    if name == 'statics':
+        template = template._replace(imass=0)
+        for idx in range(max(1, numBodies // 1000)):
+            objID = 'static-{}'.format(idx)
+            p = rng.uniform(0, size, 3).tolist()
+            bodies[objID] = template._replace(position=p)
+            AABBs[objID] = {'1': (0, 0, 0, 10, 10, 10)}
+        bodies['ground'] = template._replace(
+            cshapes={'1': getCSPlane(normal=[0, 0, 1], ofs=0)})
+        AABBs['ground'] = {}
+
+    # Link random bodies into chains of 20 constraints each. Every body is
+    # constrained at most once per chain.
+    pairs = []
+    if name == 'chains':
+        objIDs = np.array([str(_) for _ in range(numBodies)])
+        num_chains = max(1, numBodies // 40)
+        for idx in range(num_chains):
+            chain = rng.choice(objIDs, min(21, numBodies), replace=False)
+            pairs.extend(zip(chain[:-1].tolist(), chain[1:].tolist()))
+    return bodies, AABBs, pairs
+
+
+def sweepingData(bodies, AABBs):
+    """
+    Return the input for ``sweeping``, ie the world space intervals of the
+    AABBs of all bodies.
+    """
+    data = {}
+    for objID, body in bodies.items():
+        aabbs = np.array(list(AABBs[objID].values()), np.float64)
+        if len(aabbs) == 0:
+            continue
+        pos = aabbs[:, :3] + body.position
+        lo, hi = pos - aabbs[:, 3:], pos + aabbs[:, 3:]
+        data[objID] = {dim: np.column_stack((lo[:, k], hi[:, k])).tolist()
+                       for k, dim in enumerate('xyz')}
+    return data
+
+
+def measure(func, repeat):
+    """
+    Return the result, runtimes and peak memory of ``func``.
+
+    The runtimes are measured without memory tracing because it slows down
+    the function considerably. The peak memory stems from an extra run.
+
+    :param callable func: function without arguments.
+    :param int repeat: number of timed runs.
+    :return: (result, runtimes in seconds, peak memory in bytes)
+    """
+    etime = []
+    for ii in range(repeat):
+        t0 = time.perf_counter()
+        ret = func()
+        etime.append(time.perf_counter() - t0)
+        assert ret.ok
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ret.data, etime, peak
+
+
+def runBenchmarks(world, bodies, AABBs, pairs, param):
+    """
+    Run all benchmarks for one world and return the results.
+
+    :return: list of dicts (one for every benchmark).
+    """
+    leo = azrael.leonard
+    results = []
+
+    def _record(name, engine, out, etime, peak):
+        stats = leo.collisionSetStats(out)
+        results.append({
+            'world': world,
+            'bodies': len(bodies),
+            'constraints': len(pairs),
+            'benchmark': name,
+            'engine': engine,
+            'time_min': min(etime),
+            'time_mean': float(np.mean(etime)),
+            'peak_memory': peak,
+            'sets': stats['num'],
+            'max_set': stats['max'],
+        })
+        print('{:>8}  {:>7}  {:>24}  {:>11}  {:10.1f}  {:10.1f}  {:10.1f}  '
+              '{:8d}  {:8d}'.format(
+                  world, len(bodies), name, engine or '-',
+                  1000 * min(etime), 1000 * np.mean(etime), peak / 2 ** 20,
+                  stats['num'], stats['max']))
+        sys.stdout.flush()
+
+    # The broadphase result is also the input for 'mergeConstraintSets'.
+    collSets = leo.computeCollisionSetsAABB(bodies, AABBs).data
+
+    for name in param.benchmarks:
+        if name == 'sweeping':
+            data = sweepingData(bodies, AABBs)
+            out = measure(lambda: leo.sweeping(data, 'x'), param.repeat)
+            _record(name, None, *out)
+        elif name == 'computeCollisionSetsAABB':
+            out = measure(lambda: leo.computeCollisionSetsAABB(bodies, AABBs),
+                          param.repeat)
+            _record(name, None, *out)
+        elif name == 'mergeConstraintSets':
+            def _merge():
+                tmp = [set(_) for _ in collSets]
+                return leo.mergeConstraintSets(pairs, tmp)
+            _record(name, None, *measure(_merge, param.repeat))
+        elif name == 'getFinalCollisionSets':
+            # Every run uses a new engine, ie the stateful engines must
+            # build their state from scratch.
+            for engine in param.engines:
+                def _final():
+                    bp = leo.broadphaseEngines[engine]()
+                    return leo.getFinalCollisionSets(pairs, bodies, AABBs, bp)
+                _record(name, engine, *measure(_final, param.repeat))
+    return results
+
+
+def main():
+    # Parse command line arguments.
+    param = parseCommandLine()
+
+    print('{:>8}  {:>7}  {:>24}  {:>11}  {:>10}  {:>10}  {:>10}  {:>8}  {:>8}'
+          .format('World', 'Bodies', 'Benchmark', 'Engine', 'Min (ms)',
+                  'Mean (ms)', 'Peak (MB)', 'Sets', 'Max'))
+    results = []
+    for numBodies in param.bodies:
+        for world in param.worlds:
+            rng = np.random.RandomState(param.seed)
+            bodies, AABBs, pairs = createWorld(
+                world, numBodies, param.density, rng)
+            results += runBenchmarks(world, bodies, AABBs, pairs, param)
+
+    if param.output is not None:
+        doc = {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'param': vars(param),
+            'results': results,
+        }
+        with open(param.output, 'w') as fd:
+            json.dump(doc, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -255,6 +255,10 @@ def getAzraelServiceHosts(etchosts: str):
     system/container local /etc/hosts file. If not it must still adhere to the
     same format.
 
+    Some services need more than one port (eg Leonard receives the commands
+    on 'leonard_cmd'). The names of these extra ports start with the name of
+    their service, followed by an underscore, and they share its host.
+
     :param str etchosts: location of hosts file.
     :return: dict eg {'clerk': ('127.0.0.1', 5555)}
     """
@@ -266,6 +270,7 @@ def getAzraelServiceHosts(etchosts: str):
         'clerk': AddrPort('127.0.0.1', 5555),
         'database': AddrPort('127.0.0.1', 27017),
         'leonard': AddrPort('127.0.0.1', 5556),
+        'leonard_cmd': AddrPort('127.0.0.1', 5557),
         'rabbitmq': AddrPort('127.0.0.1', 5672),
         'webapi': AddrPort('127.0.0.1', 8080),
     }
@@ -296,8 +301,9 @@ def getAzraelServiceHosts(etchosts: str):
     # hosts file.
     hosts = {}
     for (name, (addr, port)) in hosts_default.items():
-        if name in hosts_system:
-            addr = hosts_system[name]
+        service = name.split('_')[0]
+        if service in hosts_system:
+            addr = hosts_system[service]
         hosts[name] = AddrPort(addr, port)
     return hosts
 
@@ -90,6 +90,7 @@ class TestClerk:
             'rabbitmq': ('127.0.0.1', 5672),
             'webapi': ('127.0.0.1', 8080),
             'leonard': ('127.0.0.1', 5556),
+            'leonard_cmd': ('127.0.0.1', 5557),
         }
         m_getenv.assert_called_with('INSIDEDOCKER', None)
 
@@ -104,6 +105,7 @@ class TestClerk:
             'clerk': ('127.0.0.1', 5555),
             'database': ('127.0.0.1', 27017),
             'leonard': ('127.0.0.1', 5556),
+            'leonard_cmd': ('127.0.0.1', 5557),
             'rabbitmq': ('127.0.0.1', 5672),
             'webapi': ('127.0.0.1', 8080),
         }
@@ -135,10 +137,12 @@ class TestClerk:
             '127.0.1.2       foo',
             '127.0.1.3       wEbApI',
             '127.0.1.4       Clerk alias1 alias2',
+            '127.0.1.5       leonard',
         ]) + '\n'
 
-        # This time the hosts for 'webapi' and 'clerk' must reflect the
-        # values in the hosts file.
+        # This time the hosts for 'webapi', 'clerk' and 'leonard' must reflect
+        # the values in the hosts file. The command port of Leonard must be
+        # on the same host as Leonard.
         with mock.patch.object(builtins, 'open',
                                mock.mock_open(read_data=lines)) as m_open:
             assert m_open.call_count == 0
@@ -148,7 +152,8 @@ class TestClerk:
         assert ret == {
             'clerk': ('127.0.1.4', 5555),
             'database': ('127.0.0.1', 27017),
-            'leonard': ('127.0.0.1', 5556),
+            'leonard': ('127.0.1.5', 5556),
+            'leonard_cmd': ('127.0.1.5', 5557),
             'rabbitmq': ('127.0.0.1', 5672),
             'webapi': ('127.0.1.3', 8080),
         }